@@ -99,14 +99,26 @@
 
 
 import os
-import glob
 import atexit
 import collections
 from math import sqrt
 from functools import partial
 from multiprocessing import Pool
 from itertools import groupby
+import numpy as np
 import grass.script as gscript
+from grass.pygrass.raster import RasterRow
+from grass.pygrass.vector.table import Link
+
+# number of cells of a block of rows of all the raster maps read at once
+BLOCK_SIZE = 2 ** 20
+# number of raster values kept in memory for percentiles in one pass
+PERCENTILE_SIZE = 2 ** 26
+# number of aggregates per zone kept in memory in one pass
+AGGREGATE_SIZE = 2 ** 25
+CNULL = -2147483648  # null value for CELL maps
+
+PERCENTILE_STATISTICS = ["first_quart", "median", "third_quart", "perc_90"]
 
 
 def cleanup():
@@ -121,16 +133,9 @@ def cleanup():
                 "db.execute", sql="DROP TABLE %s" % temporary_vect, quiet=True
             )
 
-    if insert_sql:
-        os.remove(insert_sql)
-
     if stats_temp_file:
         os.remove(stats_temp_file)
 
-    if rasters:
-        for tempfile in glob.glob(stats_temp_file + ".*"):
-            os.remove(tempfile)
-
 
 # The following two functions come from
 # https://en.wikipedia.org/wiki/Algorithms_for_calculating_variance#Welford%27s_Online_algorithm
@@ -153,26 +158,172 @@ def finalize(existingAggregate):
         return (mean, stddev)
 
 
-def worker(segment_map, stat_temp_file, raster):
+def get_row_or_nan(raster, row_num):
+    row = raster.get_row(row_num)
+    if raster.mtype != "CELL":
+        return row
+    nulls = row == CNULL
+    row = row.astype(np.float64)
+    row[nulls] = np.nan
+    return row
+
+
+def percentiles(zones, values, counts):
+    """Percentiles of the values of each zone, as computed by r.univar -e"""
+    order = np.lexsort((values, zones))
+    values = values[order]
+    starts = np.cumsum(counts) - counts
+    present = counts > 0
+    result = {}
+    for stat, fraction in (
+        ("first_quart", 0.25),
+        ("third_quart", 0.75),
+        ("perc_90", 0.9),
+    ):
+        position = np.trunc(counts * fraction - 0.5).astype(np.int64)
+        result[stat] = np.full(len(counts), np.nan)
+        result[stat][present] = values[(starts + position)[present]]
+    upper = starts + counts // 2
+    lower = np.where(counts % 2, upper, upper - 1)
+    result["median"] = np.full(len(counts), np.nan)
+    result["median"][present] = (values[lower[present]] + values[upper[present]]) / 2.0
+    return result
+
+
+def worker(segment_map, zone_min, num_zones, raster_statistics, shape, rasters):
+    """
+    Calculate the statistics of the rasters for each zone of the segment
+    map in one pass, reading all maps by blocks of rows and updating
+    running aggregates per zone (merged per block with the pairwise form
+    of Welford's algorithm). The aggregates of a block are computed for
+    the zones present in the block only.
+    """
+    need_minmax = set(raster_statistics) & set(["min", "max", "range"])
+    need_values = set(raster_statistics) & set(PERCENTILE_STATISTICS)
+    aggregates = []
+    for raster in rasters:
+        aggregates.append(
+            {
+                "n": np.zeros(num_zones),
+                "sum": np.zeros(num_zones),
+                "m2": np.zeros(num_zones),
+                "sum_abs": np.zeros(num_zones),
+                "min": np.full(num_zones if need_minmax else 0, np.inf),
+                "max": np.full(num_zones if need_minmax else 0, -np.inf),
+                "nulls": 0,
+                "zones": [],
+                "values": [],
+            }
+        )
 
-    rastername = raster.split("@")[0]
-    rastername = rastername.replace(".", "_")
-    temp_file = stat_temp_file + "." + rastername
-    gscript.run_command(
-        "r.univar",
-        map_=raster,
-        zones=segment_map,
-        output=temp_file,
-        flags="et",
-        overwrite=True,
-        quiet=True,
-    )
+    segments = RasterRow(segment_map)
+    segments.open("r")
+    maps = [RasterRow(raster) for raster in rasters]
+    for raster in maps:
+        raster.open("r")
+    rows, cols = shape
+    block_rows = max(1, BLOCK_SIZE // ((len(rasters) + 1) * cols))
+    try:
+        for start in range(0, rows, block_rows):
+            block = range(start, min(start + block_rows, rows))
+            zones = np.concatenate([segments.get_row(row) for row in block])
+            in_zone = zones != CNULL
+            # Index the zones of the block from 0 to the number of zones
+            # present in the block
+            block_zones, local = np.unique(
+                zones[in_zone].astype(np.int64) - zone_min, return_inverse=True
+            )
+            local = local.ravel()
+            num_local = len(block_zones)
+            for raster, agg in zip(maps, aggregates):
+                values = np.concatenate([get_row_or_nan(raster, row) for row in block])
+                values = values[in_zone]
+                valid = ~np.isnan(values)
+                agg["nulls"] += int(np.count_nonzero(~valid))
+                z = local[valid]
+                v = values[valid].astype(np.float64)
+                if not len(z):
+                    continue
+                n = np.bincount(z, minlength=num_local).astype(np.float64)
+                total = np.bincount(z, weights=v, minlength=num_local)
+                block_mean = total / np.maximum(n, 1)
+                m2 = np.bincount(
+                    z, weights=(v - block_mean[z]) ** 2, minlength=num_local
+                )
+                sum_abs = np.bincount(z, weights=np.abs(v), minlength=num_local)
+                # Merge the block aggregates into the running aggregates
+                has = n > 0
+                idx = block_zones[has]
+                n = n[has]
+                old_n = agg["n"][idx]
+                count = old_n + n
+                delta = block_mean[has] - agg["sum"][idx] / np.maximum(old_n, 1)
+                agg["m2"][idx] += m2[has] + delta ** 2 * old_n * n / count
+                agg["n"][idx] = count
+                agg["sum"][idx] += total[has]
+                agg["sum_abs"][idx] += sum_abs[has]
+                if need_minmax:
+                    block_min = np.full(num_local, np.inf)
+                    block_max = np.full(num_local, -np.inf)
+                    np.minimum.at(block_min, z, v)
+                    np.maximum.at(block_max, z, v)
+                    agg["min"][idx] = np.minimum(agg["min"][idx], block_min[has])
+                    agg["max"][idx] = np.maximum(agg["max"][idx], block_max[has])
+                if need_values:
+                    agg["zones"].append(block_zones[z])
+                    agg["values"].append(v)
+    finally:
+        segments.close()
+        for raster in maps:
+            raster.close()
+
+    results = {}
+    for raster, agg in zip(rasters, aggregates):
+        n = agg["n"]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            mean = agg["sum"] / n
+            variance = agg["m2"] / n
+            stats = {
+                "mean": mean,
+                "mean_of_abs": agg["sum_abs"] / n,
+                "stddev": np.sqrt(variance),
+                "variance": variance,
+                "coeff_var": np.sqrt(variance) / mean * 100,
+                "sum": agg["sum"],
+                "sum_abs": agg["sum_abs"],
+            }
+            if need_minmax:
+                stats["min"] = agg["min"]
+                stats["max"] = agg["max"]
+                stats["range"] = agg["max"] - agg["min"]
+        if need_values:
+            zones = np.concatenate(agg["zones"] or [np.zeros(0, np.int64)])
+            values = np.concatenate(agg["values"] or [np.zeros(0)])
+            stats.update(percentiles(zones, values, n.astype(np.int64)))
+            del agg["zones"], agg["values"]
+        results[raster] = (n, agg["nulls"], [stats[x] for x in raster_statistics])
+    return results
+
+
+def raster_groups(rasters, processes, raster_statistics, cells, num_zones):
+    """
+    Split the rasters into groups handled in one pass each, at least one
+    group per process, and small enough to keep the aggregates of all
+    zones and the values needed for percentiles in memory
+    """
+    # n, sum, m2, sum_abs and optionally min and max per zone and raster
+    num_aggregates = 4
+    if set(raster_statistics) & set(["min", "max", "range"]):
+        num_aggregates += 2
+    per_group = max(1, AGGREGATE_SIZE // (num_aggregates * num_zones))
+    if set(raster_statistics) & set(PERCENTILE_STATISTICS):
+        per_group = min(per_group, max(1, PERCENTILE_SIZE // cells))
+    num_groups = max(min(processes, len(rasters)), -(-len(rasters) // per_group))
+    return [rasters[i::num_groups] for i in range(num_groups)]
 
 
 def main():
 
-    global insert_sql
-    insert_sql = None
     global temporary_vect
     temporary_vect = None
     global stats_temp_file
@@ -215,27 +366,6 @@ def main():
     output_header = ["cat"]
     output_dict = collections.defaultdict(list)
 
-    raster_stat_dict = {
-        "zone": 0,
-        "min": 4,
-        "third_quart": 16,
-        "max": 5,
-        "sum": 12,
-        "null_cells": 3,
-        "median": 15,
-        "label": 1,
-        "first_quart": 14,
-        "range": 6,
-        "mean_of_abs": 8,
-        "stddev": 9,
-        "non_null_cells": 2,
-        "coeff_var": 11,
-        "variance": 10,
-        "sum_abs": 13,
-        "perc_90": 17,
-        "mean": 7,
-    }
-
     geometry_stat_dict = {
         "cat": 0,
         "area": 1,
@@ -274,35 +404,46 @@ def main():
                 output_dict[values[0]] = [values[x] for x in stat_indices]
 
     if rasters:
+        rasters_to_remove = []
+        for raster in rasters:
+            if not gscript.find_file(raster, element="cell")["name"]:
+                gscript.message(_("Cannot find raster '%s'" % raster))
+                gscript.message(_("Removing this raster from list."))
+                rasters_to_remove.append(raster)
+        for raster in rasters_to_remove:
+            rasters.remove(raster)
+
+    if rasters:
+        gscript.message(_("Calculating statistics for the following raster maps:"))
+        gscript.message(",".join(rasters))
+
+        # All rasters are read in one pass over the segment map per group
+        # of rasters, the zones are indexed by their category
+        region = gscript.region()
+        shape = (region["rows"], region["cols"])
+        segment_info = gscript.raster_info(segment_map)
+        zone_min = int(segment_info["min"])
+        num_zones = int(segment_info["max"]) - zone_min + 1
+        groups = raster_groups(
+            rasters, processes, raster_statistics, shape[0] * shape[1], num_zones
+        )
+        func = partial(
+            worker, segment_map, zone_min, num_zones, raster_statistics, shape
+        )
+        results = {}
+        if len(groups) > 1:
+            pool = Pool(min(processes, len(groups)))
+            for result in pool.imap_unordered(func, groups):
+                results.update(result)
+            pool.close()
+            pool.join()
+        else:
+            results.update(func(groups[0]))
+
         if not flags["c"]:
-            gscript.message(_("Checking usability of raster maps..."))
             rasters_to_remove = []
             for raster in rasters:
-                null_values_found = False
-                if not gscript.find_file(raster, element="cell")["name"]:
-                    gscript.message(_("Cannot find raster '%s'" % raster))
-                    gscript.message(_("Removing this raster from list."))
-                    rasters_to_remove.append(raster)
-                    continue
-                current_mapset = gscript.gisenv()["MAPSET"]
-                if gscript.find_file("MASK", element="cell", mapset=current_mapset)[
-                    "name"
-                ]:
-
-                    null_test = gscript.read_command(
-                        "r.stats", flags="N", input_=["MASK", raster], quiet=True
-                    ).splitlines()
-                    if "1 *" in null_test:
-                        null_values_found = True
-
-                else:
-                    raster_info = gscript.parse_command(
-                        "r.univar", flags="g", map_=raster, quiet=True
-                    )
-                    if len(raster_info) == 0 or int(raster_info["null_cells"]) > 0:
-                        null_values_found = True
-
-                if null_values_found:
+                if results[raster][1] > 0:
                     message = "Raster <%s> contains null values.\n" % raster
                     message += "This can lead to errors in the calculations.\n"
                     message += "Check region settings and raster extent.\n"
@@ -310,44 +451,20 @@ def main():
                     message += "Removing this raster from list."
                     gscript.warning(message)
                     rasters_to_remove.append(raster)
-
             for raster in rasters_to_remove:
                 rasters.remove(raster)
 
-        if len(rasters) > 0:
-            gscript.message(_("Calculating statistics for the following raster maps:"))
-            gscript.message(",".join(rasters))
-            if len(rasters) < processes:
-                processes = len(rasters)
-                gscript.message(
-                    _(
-                        "Only one process per raster. Reduced number of processes to %i."
-                        % processes
-                    )
-                )
-
-            stat_indices = [raster_stat_dict[x] for x in raster_statistics]
-            pool = Pool(processes)
-            func = partial(worker, segment_map, stats_temp_file)
-            pool.map(func, rasters)
-            pool.close()
-            pool.join()
-
-            for raster in rasters:
-                rastername = raster.split("@")[0]
-                rastername = rastername.replace(".", "_")
-                temp_file = stats_temp_file + "." + rastername
-                output_header += [rastername + "_" + x for x in raster_statistics]
-                firstline = True
-                with open(temp_file, "r") as fin:
-                    for line in fin:
-                        if firstline:
-                            firstline = False
-                            continue
-                        values = line.rstrip().split("|")
-                        output_dict[values[0]] = output_dict[values[0]] + [
-                            values[x] for x in stat_indices
-                        ]
+        for raster in rasters:
+            rastername = raster.split("@")[0]
+            rastername = rastername.replace(".", "_")
+            output_header += [rastername + "_" + x for x in raster_statistics]
+            counts, nulls, stats = results[raster]
+            # Zones without values are not reported, as by r.univar
+            zones = np.flatnonzero(counts > 0)
+            values = np.column_stack([stat[zones] for stat in stats]).tolist()
+            for zone, zone_values in zip((zones + zone_min).tolist(), values):
+                key = str(zone)
+                output_dict[key] = output_dict[key] + ["%.15g" % x for x in zone_values]
 
     # Calculating neighborhood statistics if requested
     if neighborhood:
@@ -425,44 +542,40 @@ def main():
             quiet=True,
         )
 
-        insert_sql = gscript.tempfile()
-        fsql = open(insert_sql, "w")
-        fsql.write("BEGIN TRANSACTION;\n")
-        if gscript.db_table_exist(temporary_vect):
-            if gscript.overwrite():
-                fsql.write("DROP TABLE %s;" % temporary_vect)
-            else:
-                gscript.fatal(
-                    _("Table %s already exists. Use --o to overwrite" % temporary_vect)
-                )
-        create_statement = (
-            "CREATE TABLE " + temporary_vect + " (cat int PRIMARY KEY);\n"
-        )
-        fsql.write(create_statement)
-        for header in output_header[1:]:
-            addcol_statement = "ALTER TABLE %s ADD COLUMN %s double precision;\n" % (
-                temporary_vect,
-                header,
+        if gscript.db_table_exist(temporary_vect) and not gscript.overwrite():
+            gscript.fatal(
+                _("Table %s already exists. Use --o to overwrite" % temporary_vect)
             )
-            fsql.write(addcol_statement)
+        columns = [("cat", "int PRIMARY KEY")]
+        columns += [(header, "double precision") for header in output_header[1:]]
+        rows = []
         for key in output_dict:
             if len(output_dict[key]) + 1 == len(output_header):
-                sql = "INSERT INTO %s VALUES (%s, %s);\n" % (
-                    temporary_vect,
-                    key,
-                    ",".join(output_dict[key]),
-                )
-                sql = sql.replace("inf", "NULL")
-                sql = sql.replace("nan", "NULL")
-                fsql.write(sql)
+                row = [int(key)]
+                for value in output_dict[key]:
+                    value = float(value)
+                    row.append(value if np.isfinite(value) else None)
+                rows.append(row)
             else:
                 if not csvfile:
                     error_objects.append(key)
 
-        fsql.write("END TRANSACTION;")
-        fsql.close()
+        # Write all rows at once into the table of the temporary map
+        connection = gscript.db_connection(force=True)
+        link = Link(
+            layer=1,
+            name=temporary_vect,
+            table=temporary_vect,
+            key="cat",
+            database=connection["database"],
+            driver=connection["driver"],
+        )
+        table = link.table()
+        table.create(columns, overwrite=True)
+        table.insert(rows, many=True)
+        table.conn.commit()
+        table.conn.close()
 
-        gscript.run_command("db.execute", input=insert_sql, quiet=True)
         gscript.run_command(
             "v.db.connect", map_=temporary_vect, table=temporary_vect, quiet=True
         )
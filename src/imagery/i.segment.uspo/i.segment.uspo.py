@@ -251,6 +251,25 @@
 #%end
 #
 #%option
+#% key: search
+#% type: string
+#% description: Strategy used to search the parameter combinations
+#% required: no
+#% options: grid,coarse_to_fine
+#% descriptions: grid;test all parameter combinations;coarse_to_fine;test a coarse grid of parameters and refine it around the best combinations
+#% answer: grid
+#% guisection: Evaluation
+#%end
+#
+#%option
+#% key: cache
+#% type: string
+#% key_desc: name
+#% description: File in which results are cached for reuse in later runs
+#% required: no
+#%end
+#
+#%option
 #% key: memory
 #% type: integer
 #% description: Total memory (in MB) to allocate (will be divided by processes)
@@ -299,9 +318,17 @@ import grass.script as gscript
 import sys
 import os
 import atexit
+import json
+from itertools import product
 from multiprocessing import Process, Queue, current_process
+import numpy as np
+from grass.pygrass.raster import RasterRow
 
-# check requirements
+# number of cells of a block of rows of all the maps read at once, and of
+# new neighbor pairs collected before merging them
+BLOCK_SIZE = 2 ** 20
+
+CNULL = -2147483648  # null value for CELL maps
 
 # for python 3 compatibility
 try:
@@ -318,20 +345,6 @@ def iteritems(dict):
     return dictitems
 
 
-def check_progs():
-    found_missing = False
-    for prog in ["r.neighborhoodmatrix"]:
-        if not gscript.find_program(prog, "--help"):
-
-            found_missing = True
-            gscript.warning(
-                _("'%s' required. Please install '%s' first using 'g.extension %s'")
-                % (prog, prog, prog)
-            )
-    if found_missing:
-        gscript.fatal(_("An ERROR occurred running i.segment.uspo"))
-
-
 def cleanup():
     """Delete temporary maps"""
 
@@ -351,39 +364,54 @@ def drange(start, stop, step):
         r += step
 
 
-def rg_hier_worker(parms, thresholds, minsize_queue, result_queue):
+def run_workers(worker, parms, jobs, processes):
+    """Run the jobs in parallel processes and return their results"""
+
+    results = []
+    if not jobs:
+        return results
+    job_queue = Queue()
+    result_queue = Queue()
+    for job in jobs:
+        job_queue.put(job)
+    processes_list = []
+    for p in xrange(min(processes, len(jobs))):
+        proc = Process(target=worker, args=(parms, job_queue, result_queue))
+        proc.start()
+        processes_list.append(proc)
+        job_queue.put("STOP")
+
+    # Read the results before joining, so that workers are never blocked
+    # on a full queue
+    finished = 0
+    while finished < len(processes_list):
+        result = result_queue.get()
+        if result == "DONE":
+            finished += 1
+        elif len(result) == 3:
+            results.append(result)
+        else:
+            gscript.message("Error in worker function: %s" % result)
+    for p in processes_list:
+        p.join()
+
+    return results
+
+
+def rg_hier_worker(parms, job_queue, result_queue):
     """Launch parallel processes for hierarchical segmentation"""
 
     try:
-        for minsize in iter(minsize_queue.get, "STOP"):
-            map_list = rg_hierarchical_seg(parms, thresholds, minsize)
+        for thresholds, minsize, seed, known in iter(job_queue.get, "STOP"):
+            map_list = rg_hierarchical_seg(parms, thresholds, minsize, seed)
             for mapname, threshold, minsize in map_list:
-                mapinfo = gscript.raster_info(mapname)
-                if mapinfo["max"] > mapinfo["min"]:
-                    variance_per_raster = []
-                    autocor_per_raster = []
-                    neighbordict = get_nb_matrix(mapname)
-                    for raster in parms["rasters"]:
-                        # there seems to be some trouble in ms windows with qualified
-                        # map names
-                        raster = raster.split("@")[0]
-                        var = get_variance(mapname, raster)
-                        variance_per_raster.append(var)
-                        autocor = get_autocorrelation(
-                            mapname, raster, neighbordict, parms["indicator"]
-                        )
-                        autocor_per_raster.append(autocor)
-
-                    mean_lv = sum(variance_per_raster) / len(variance_per_raster)
-                    mean_autocor = sum(autocor_per_raster) / len(autocor_per_raster)
-                    result_queue.put(
-                        [mapname, mean_lv, mean_autocor, threshold, minsize]
-                    )
+                # Levels which are only redone to seed the following ones
+                # are not evaluated again
+                if threshold in known:
+                    quality = None
                 else:
-                    # If resulting map contains only one segment, then give high
-                    # value of variance and 0 for spatial autocorrelation in order
-                    # to give this map a low priority
-                    result_queue.put([mapname, 999999, 0, threshold, minsize])
+                    quality = segmentation_quality(mapname, parms["rasters"])
+                result_queue.put([mapname, quality, (threshold, minsize)])
 
     except:
         exc_info = sys.exc_info()
@@ -394,6 +422,7 @@ def rg_hier_worker(parms, thresholds, minsize_queue, result_queue):
             ]
         )
 
+    result_queue.put("DONE")
     return True
 
 
@@ -403,30 +432,8 @@ def rg_nonhier_worker(parms, parameter_queue, result_queue):
     try:
         for threshold, minsize in iter(parameter_queue.get, "STOP"):
             mapname = rg_non_hierarchical_seg(parms, threshold, minsize)
-            mapinfo = gscript.raster_info(mapname)
-            if mapinfo["max"] > mapinfo["min"]:
-                variance_per_raster = []
-                autocor_per_raster = []
-                neighbordict = get_nb_matrix(mapname)
-                for raster in parms["rasters"]:
-                    # there seems to be some trouble in ms windows with qualified
-                    # map names
-                    raster = raster.split("@")[0]
-                    var = get_variance(mapname, raster)
-                    variance_per_raster.append(var)
-                    autocor = get_autocorrelation(
-                        mapname, raster, neighbordict, parms["indicator"]
-                    )
-                    autocor_per_raster.append(autocor)
-
-                mean_lv = sum(variance_per_raster) / len(variance_per_raster)
-                mean_autocor = sum(autocor_per_raster) / len(autocor_per_raster)
-                result_queue.put([mapname, mean_lv, mean_autocor, threshold, minsize])
-            else:
-                # If resulting map contains only one segment, then give high
-                # value of variance and 0 for spatial autocorrelation in order
-                # to give this map a low priority
-                result_queue.put([mapname, 999999, 0, threshold, minsize])
+            quality = segmentation_quality(mapname, parms["rasters"])
+            result_queue.put([mapname, quality, (threshold, minsize)])
 
     except:
         exc_info = sys.exc_info()
@@ -443,16 +450,21 @@ def rg_nonhier_worker(parms, parameter_queue, result_queue):
             ]
         )
 
+    result_queue.put("DONE")
     return True
 
 
-def rg_hierarchical_seg(parms, thresholds, minsize):
-    """Do hierarchical segmentation for a vector of thresholds and a specific minsize"""
+def rg_hierarchical_seg(parms, thresholds, minsize, seed=None):
+    """Do hierarchical segmentation for a vector of thresholds and a specific minsize
+
+    If seed is given, it is used as seed for the first threshold, which
+    allows to continue an existing hierarchy.
+    """
 
     outputs_prefix = parms["temp_segment_map"] + "__%s" % parms["region"]
     outputs_prefix += "__%.4f"
     outputs_prefix += "__%d" % minsize
-    previous = None
+    previous = seed
     map_list = []
     for threshold in thresholds:
         temp_segment_map_thresh = outputs_prefix % threshold
@@ -525,28 +537,8 @@ def ms_worker(parms, parameter_queue, result_queue):
     try:
         for threshold, hr, radius, minsize in iter(parameter_queue.get, "STOP"):
             mapname = ms_seg(parms, threshold, hr, radius, minsize)
-            variance_per_raster = []
-            autocor_per_raster = []
-            neighbordict = get_nb_matrix(mapname)
-            for raster in parms["rasters"]:
-                var = get_variance(mapname, raster)
-                variance_per_raster.append(var)
-                autocor = get_autocorrelation(
-                    mapname, raster, neighbordict, parms["indicator"]
-                )
-                autocor_per_raster.append(autocor)
-
-            if len(variance_per_raster) > 0:
-                mean_lv = sum(variance_per_raster) / len(variance_per_raster)
-            else:
-                mean_lv = 999999
-            if len(autocor_per_raster) > 0:
-                mean_autocor = sum(autocor_per_raster) / len(autocor_per_raster)
-            else:
-                mean_autocor = 0
-            result_queue.put(
-                [mapname, mean_lv, mean_autocor, threshold, hr, radius, minsize]
-            )
+            quality = segmentation_quality(mapname, parms["rasters"])
+            result_queue.put([mapname, quality, (threshold, hr, radius, minsize)])
 
     except:
         result_queue.put(
@@ -563,6 +555,7 @@ def ms_worker(parms, parameter_queue, result_queue):
             ]
         )
 
+    result_queue.put("DONE")
     return True
 
 
@@ -607,107 +600,365 @@ def ms_seg(parms, threshold, hr, radius, minsize):
     return temp_segment_map_thresh
 
 
-def get_variance(mapname, raster):
-    """Calculate intra-segment variance of the values of the given raster"""
-
-    # current_process name contains '-' which can cause problems so we replace
-    # with '_'
-    temp_map = "isegmentuspo_temp_variance_map_%d_%s" % (
-        os.getpid(),
-        current_process().name.replace("-", "_"),
-    )
-    gscript.run_command(
-        "r.stats.zonal",
-        base=mapname,
-        cover=raster,
-        method="variance",
-        output=temp_map,
-        overwrite=True,
-        quiet=True,
-    )
-    univar = gscript.parse_command("r.univar", map_=temp_map, flags="g", quiet=True)
-    var = float(univar["mean"])
-    gscript.run_command(
-        "g.remove", type_="raster", name=temp_map, flags="f", quiet=True
-    )
-    return var
-
-
-def get_nb_matrix(mapname):
-    """Create a dictionary with neighbors per segment"""
-
-    res = gscript.read_command(
-        "r.neighborhoodmatrix", input_=mapname, output="-", sep="comma", quiet=True
-    )
-
-    neighbordict = {}
-    for line in res.splitlines():
-        n1 = line.split(",")[0]
-        n2 = line.split(",")[1]
-        if n1 in neighbordict:
-            neighbordict[n1].append(n2)
-        else:
-            neighbordict[n1] = [n2]
-
-    return neighbordict
-
-
-def get_autocorrelation(mapname, raster, neighbordict, indicator):
-    """Calculate either Moran's I or Geary's C for values of the given raster"""
-
-    raster_vars = gscript.parse_command("r.univar", map_=raster, flags="g", quiet=True)
-    global_mean = float(raster_vars["mean"])
-
-    univar_res = gscript.read_command(
-        "r.univar",
-        flags="t",
-        map_=raster,
-        zones=mapname,
-        out="-",
-        sep="comma",
-        quiet=True,
-    )
-
-    means = {}
-    mean_diffs = {}
-    firstline = True
-    for line in univar_res.splitlines():
-        l = line.split(",")
-        if firstline:
-            i = l.index("mean")
-            firstline = False
-        else:
-            means[l[0]] = float(l[i])
-            mean_diffs[l[0]] = float(l[i]) - global_mean
-
-    sum_sq_mean_diffs = sum(x ** 2 for x in mean_diffs.values())
-
-    total_nb_neighbors = 0
-    for region in neighbordict:
-        total_nb_neighbors += len(neighbordict[region])
-
-    N = len(means)
-    sum_products = 0
-    sum_squared_differences = 0
-    for region in neighbordict:
-        region_value = means[region] - global_mean
-        neighbors = neighbordict[region]
-        nb_neighbors = len(neighbors)
-        for neighbor in neighbors:
-            neighbor_value = means[neighbor] - global_mean
-            sum_products += region_value * neighbor_value
-            sum_squared_differences = (means[region] - means[neighbor]) ** 2
-
-    if indicator == "morans":
-        autocor = (float(N) / total_nb_neighbors) * (
-            float(sum_products) / sum_sq_mean_diffs
+def segment(parms, parameters):
+    """Redo the segmentation for the given parameters
+
+    Returns the list of the created maps, the segmentation for the given
+    parameters being the last one. Hierarchical segmentation recreates
+    also the maps for the lower thresholds.
+    """
+
+    if parms["hierarchical"]:
+        threshold, minsize = parameters
+        thresholds = [x for x in parms["thresholds"] if x <= threshold]
+        return [result[0] for result in rg_hierarchical_seg(parms, thresholds, minsize)]
+    if parms["method"] == "region_growing":
+        return [rg_non_hierarchical_seg(parms, *parameters)]
+    return [ms_seg(parms, *parameters)]
+
+
+def get_row_or_nan(raster, row_num):
+    row = raster.get_row(row_num)
+    if raster.mtype != "CELL":
+        return row
+    nulls = row == CNULL
+    row = row.astype(np.float64)
+    row[nulls] = np.nan
+    return row
+
+
+def grow(array, size):
+    """Extend the last axis of the array with zeros to at least size"""
+
+    if array.shape[-1] >= size:
+        return array
+    size = max(size, 2 * array.shape[-1])
+    extension = np.zeros(array.shape[:-1] + (size - array.shape[-1],))
+    return np.concatenate((array, extension), axis=-1)
+
+
+def pair_codes(segments, neighbors):
+    """Encode pairs of neighboring segments, independently of their order"""
+
+    return np.minimum(segments, neighbors) << 32 | np.maximum(segments, neighbors)
+
+
+def segmentation_quality(mapname, rasters):
+    """Calculate intra-segment variance and spatial autocorrelation
+
+    The segmentation and the rasters are read in one pass, collecting the
+    statistics of each segment per raster and the pairs of segments sharing
+    an edge. Return the intra-segment variance, Moran's I and Geary's C,
+    each averaged over the rasters.
+    """
+
+    region = gscript.region()
+    rows, cols = region["rows"], region["cols"]
+    nb_rasters = len(rasters)
+    cells = np.zeros(1)
+    counts = np.zeros((nb_rasters, 1))
+    sums = np.zeros((nb_rasters, 1))
+    squares = np.zeros((nb_rasters, 1))
+    global_sums = np.zeros(nb_rasters)
+    global_counts = np.zeros(nb_rasters)
+    pairs = np.zeros(0, dtype=np.int64)
+    new_pairs = []
+    nb_new_pairs = 0
+    previous = None
+
+    segments = RasterRow(mapname)
+    segments.open("r")
+    maps = [RasterRow(raster) for raster in rasters]
+    for raster in maps:
+        raster.open("r")
+    block_rows = max(1, BLOCK_SIZE // ((nb_rasters + 1) * cols))
+    for start in xrange(0, rows, block_rows):
+        block = xrange(start, min(start + block_rows, rows))
+        segment_block = np.array(
+            [segments.get_row(row_num) for row_num in block], dtype=np.int64
         )
-    elif indicator == "geary":
-        autocor = (float(N - 1) / (2 * total_nb_neighbors)) * (
-            float(sum_squared_differences) / sum_sq_mean_diffs
+        in_segment = segment_block != CNULL
+        segment_block[~in_segment] = 0
+
+        # Statistics of the block are calculated for the segments present
+        # in the block only, and then added to those of the segments
+        ids, local = np.unique(segment_block[in_segment], return_inverse=True)
+        local = local.ravel()
+        nb_local = len(ids)
+        if nb_local:
+            size = ids[-1] + 1
+            cells = grow(cells, size)
+            counts = grow(counts, size)
+            sums = grow(sums, size)
+            squares = grow(squares, size)
+            cells[ids] += np.bincount(local, minlength=nb_local)
+        for i, raster in enumerate(maps):
+            values = np.array([get_row_or_nan(raster, row_num) for row_num in block])
+            valid = ~np.isnan(values)
+            global_sums[i] += values[valid].sum()
+            global_counts[i] += np.count_nonzero(valid)
+            values = values[in_segment]
+            valid = valid[in_segment]
+            block_ids = local[valid]
+            values = values[valid]
+            counts[i][ids] += np.bincount(block_ids, minlength=nb_local)
+            sums[i][ids] += np.bincount(block_ids, weights=values, minlength=nb_local)
+            squares[i][ids] += np.bincount(
+                block_ids, weights=values ** 2, minlength=nb_local
+            )
+
+        # Segments are neighbors if they share an edge, as in the default
+        # mode of r.neighborhoodmatrix
+        edge = (
+            in_segment[:, :-1]
+            & in_segment[:, 1:]
+            & (segment_block[:, :-1] != segment_block[:, 1:])
+        )
+        block_pairs = [
+            pair_codes(segment_block[:, :-1][edge], segment_block[:, 1:][edge])
+        ]
+        if previous is not None:
+            previous_row, previous_in_segment = previous
+            segment_block = np.vstack((previous_row, segment_block))
+            in_segment = np.vstack((previous_in_segment, in_segment))
+        edge = (
+            in_segment[:-1] & in_segment[1:] & (segment_block[:-1] != segment_block[1:])
         )
+        block_pairs.append(
+            pair_codes(segment_block[:-1][edge], segment_block[1:][edge])
+        )
+        previous = segment_block[-1:], in_segment[-1:]
+        block_pairs = np.unique(np.concatenate(block_pairs))
+        new_pairs.append(block_pairs)
+        nb_new_pairs += block_pairs.size
+        if nb_new_pairs > BLOCK_SIZE:
+            pairs = np.unique(np.concatenate([pairs] + new_pairs))
+            new_pairs = []
+            nb_new_pairs = 0
+    segments.close()
+    for raster in maps:
+        raster.close()
+
+    if np.count_nonzero(cells) < 2:
+        # If resulting map contains only one segment, then give high
+        # value of variance and 0 for spatial autocorrelation in order
+        # to give this map a low priority
+        return [999999, 0, 0]
+
+    pairs = np.unique(np.concatenate([pairs] + new_pairs))
+    first = pairs >> 32
+    second = pairs & 0xFFFFFFFF
+    variance_per_raster = []
+    morans_per_raster = []
+    geary_per_raster = []
+    for i in xrange(nb_rasters):
+        # Variance is calculated as by r.stats.zonal, the mean of the
+        # variances is weighted by the number of cells of each segment
+        present = counts[i] > 0
+        n = np.where(present, counts[i], 1)
+        means = sums[i] / n
+        variances = np.maximum(squares[i] / n - means ** 2, 0)
+        variance_per_raster.append(
+            (cells[present] * variances[present]).sum() / cells[present].sum()
+        )
+
+        mean_diffs = means - global_sums[i] / global_counts[i]
+        sum_sq_mean_diffs = (mean_diffs[present] ** 2).sum()
+        neighbors = present[first] & present[second]
+        nb_neighbors = np.count_nonzero(neighbors)
+        if nb_neighbors == 0 or sum_sq_mean_diffs == 0:
+            morans_per_raster.append(0)
+            geary_per_raster.append(0)
+            continue
+        N = np.count_nonzero(present)
+        region_value = mean_diffs[first[neighbors]]
+        neighbor_value = mean_diffs[second[neighbors]]
+        sum_products = (region_value * neighbor_value).sum()
+        sum_squared_differences = ((region_value - neighbor_value) ** 2).sum()
+        # Each pair is counted once, so the sums and the number of neighbors
+        # are all half of those over both directions
+        morans_per_raster.append(
+            (float(N) / nb_neighbors) * (sum_products / sum_sq_mean_diffs)
+        )
+        geary_per_raster.append(
+            (float(N - 1) / (2 * nb_neighbors))
+            * (sum_squared_differences / sum_sq_mean_diffs)
+        )
+
+    return [
+        float(np.mean(variance_per_raster)),
+        float(np.mean(morans_per_raster)),
+        float(np.mean(geary_per_raster)),
+    ]
 
-    return autocor
+
+def cache_key(parameters, chain=()):
+    """Key under which the results of a segmentation are cached
+
+    For hierarchical segmentation, chain contains the thresholds of the
+    levels used as seeds.
+    """
+
+    key = ",".join(map(str, parameters))
+    if chain:
+        key = ">".join(map(str, chain)) + ">" + key
+    return key
+
+
+def read_cache(cache_file, settings):
+    """Read cached results, if they were obtained with the same settings"""
+
+    cache = {"settings": settings, "regions": {}}
+    if cache_file and os.path.exists(cache_file):
+        with open(cache_file) as f:
+            cached = json.load(f)
+        if cached["settings"] == settings:
+            cache = cached
+        else:
+            gscript.warning(
+                _("Cache file <%s> was written with other settings, not using it")
+                % cache_file
+            )
+    return cache
+
+
+def write_cache(cache_file, cache):
+    if cache_file:
+        with open(cache_file, "w") as f:
+            json.dump(cache, f, indent=2)
+
+
+def get_region_cache(cache, region):
+    """Return cached results of the region, if its extent did not change"""
+
+    current = gscript.region()
+    extent = dict((key, current[key]) for key in "nsew")
+    extent["nsres"] = current["nsres"]
+    extent["ewres"] = current["ewres"]
+    regions = cache["regions"]
+    if region not in regions or regions[region]["extent"] != extent:
+        regions[region] = {"extent": extent, "results": {}}
+    return regions[region]["results"]
+
+
+def map_exists(mapname):
+    return bool(gscript.find_file(mapname, element="cell")["fullname"])
+
+
+def evaluate_grid(parms, dims, indices, region_cache, processes):
+    """Segment and evaluate the parameter combinations at the grid indices
+
+    Results are stored in region_cache as [map, variance, Moran's I, Geary's
+    C], combinations found there are not segmented again. Return the cache
+    keys of the combinations by parameter tuple.
+    """
+
+    keys = {}
+    jobs = []
+    if parms["hierarchical"]:
+        # The thresholds of each minsize form one hierarchy, which is
+        # continued from its last level available in the cache
+        thresholds = parms["thresholds"]
+        for (index,) in indices:
+            minsize = dims[0][index]
+            chain_keys = [
+                cache_key((threshold, minsize), thresholds[:i])
+                for i, threshold in enumerate(thresholds)
+            ]
+            for threshold, key in zip(thresholds, chain_keys):
+                keys[(threshold, minsize)] = key
+            if all(key in region_cache for key in chain_keys):
+                continue
+            start = 0
+            seed = None
+            for i, key in enumerate(chain_keys):
+                if key not in region_cache:
+                    break
+                if map_exists(region_cache[key][0]):
+                    start = i + 1
+                    seed = region_cache[key][0]
+            known = [
+                threshold
+                for threshold, key in zip(thresholds[start:], chain_keys[start:])
+                if key in region_cache
+            ]
+            jobs.append([thresholds[start:], minsize, seed, known])
+        worker = rg_hier_worker
+    else:
+        for index in indices:
+            parameters = tuple(values[i] for values, i in zip(dims, index))
+            key = cache_key(parameters)
+            keys[parameters] = key
+            if key not in region_cache:
+                jobs.append(parameters)
+        if parms["method"] == "region_growing":
+            worker = rg_nonhier_worker
+        else:
+            worker = ms_worker
+
+    for mapname, quality, parameters in run_workers(worker, parms, jobs, processes):
+        maplist.append(mapname)
+        key = keys[tuple(parameters)]
+        if quality is None:
+            region_cache[key][0] = mapname
+        else:
+            region_cache[key] = [mapname] + quality
+
+    return keys
+
+
+def grid_index(parms, dims, parameters):
+    """Position of a parameter tuple in the grid"""
+
+    if parms["hierarchical"]:
+        return (dims[0].index(parameters[-1]),)
+    return tuple(values.index(x) for values, x in zip(dims, parameters))
+
+
+def search_axis(size, centre, stride, span):
+    """Indices at multiples of stride from centre, at most span away"""
+
+    low = max(centre - span, 0)
+    high = min(centre + span, size - 1)
+    axis = set(range(centre, low - 1, -stride))
+    axis.update(range(centre, high + 1, stride))
+    axis.update([low, high])
+    return axis
+
+
+def coarse_to_fine_search(parms, dims, region_cache, processes, nb_best):
+    """Evaluate a coarse grid of parameters and refine it around the best
+
+    Each step halves the stride between the tested values of each parameter
+    and only tests the values around the nb_best best combinations, until
+    neighboring values are tested.
+    """
+
+    sizes = [len(values) for values in dims]
+    strides = []
+    for size in sizes:
+        stride = 1
+        while stride * 4 < size:
+            stride *= 2
+        strides.append(stride)
+    spans = [size - 1 for size in sizes]
+    centres = [tuple(0 for size in sizes)]
+    keys = {}
+    while True:
+        indices = set()
+        for centre in centres:
+            axes = [search_axis(*axis) for axis in zip(sizes, centre, strides, spans)]
+            indices.update(product(*axes))
+        keys.update(evaluate_grid(parms, dims, indices, region_cache, processes))
+        if max(strides) == 1:
+            return keys
+        parameter_list = [x for x in sorted(keys) if keys[x] in region_cache]
+        optimal_indices = optimal_parameters(
+            parms, [region_cache[keys[x]] for x in parameter_list], nb_best
+        )
+        centres = [grid_index(parms, dims, parameter_list[i]) for i in optimal_indices]
+        spans = strides
+        strides = [max(1, stride // 2) for stride in strides]
 
 
 def normalize_criteria(crit_list, direction):
@@ -763,6 +1014,33 @@ def find_optimal_value_indices(optlist, nb_best):
     return opt_indices
 
 
+def optimization_list(parms, results):
+    """Optimization function values of the cached results, None if they are all equal"""
+
+    variancelist = [result[1] for result in results]
+    autocorlist = [result[parms["autocor_index"]] for result in results]
+    if max(variancelist) > min(variancelist) and max(autocorlist) > min(autocorlist):
+        return create_optimization_list(
+            variancelist,
+            autocorlist,
+            parms["opt_function"],
+            parms["alpha"],
+            parms["direction"],
+        )
+    return None
+
+
+def optimal_parameters(parms, results, nb_best):
+    """Indices of the nb_best cached results"""
+
+    if not results:
+        return []
+    optlist = optimization_list(parms, results)
+    if optlist is None:
+        return [0]
+    return find_optimal_value_indices(optlist, nb_best)
+
+
 def main():
     global maplist
     global keep
@@ -777,15 +1055,15 @@ def main():
         message += "INFO: Note that this leads to less optimal parallization."
         gscript.info(message)
 
-    check_progs()
-
     parms = {}
     group = options["group"]
     parms["group"] = group
     method = options["segmentation_method"]
+    parms["method"] = method
     rg = False
     if method == "region_growing":
         rg = True
+    parms["hierarchical"] = rg and hierarchical_segmentation
     parms["seeds"] = False
     if options["seeds"]:
         parms["seeds"] = options["seeds"]
@@ -794,14 +1072,19 @@ def main():
         output = options["output"]
     indicator = options["autocorrelation_indicator"]
     parms["indicator"] = indicator
-    opt_function = options["optimization_function"]
-    alpha = float(options["f_function_alpha"])
+    parms["opt_function"] = options["optimization_function"]
+    parms["alpha"] = float(options["f_function_alpha"])
     parms["adaptive"] = False
     if flags["a"]:
         parms["adaptive"] = True
+    search = options["search"]
+    cache_file = options["cache"]
 
     # which is "better", higher or lower ?
     directions = {"morans": "low", "geary": "high"}
+    parms["direction"] = directions[indicator]
+    # position of the indicator in the cached results
+    parms["autocor_index"] = {"morans": 2, "geary": 3}[indicator]
 
     if options["segment_map"]:
         segmented_map = options["segment_map"]
@@ -828,6 +1111,10 @@ def main():
         # We want to keep a specific precision, so we go through string
         # representation and back to float
         thresholds = [float(y) for y in ["%.4f" % x for x in iter_thresh]]
+    # Each level of a hierarchy is seeded by the level with the next lower
+    # threshold
+    thresholds = sorted(set(thresholds))
+    parms["thresholds"] = thresholds
 
     if options["minsizes"]:
         minsizes = [int(x) for x in options["minsizes"].split(",")]
@@ -835,7 +1122,7 @@ def main():
         step = int(options["minsize_step"])
         start = int(options["minsize_start"])
         stop = int(options["minsize_stop"])
-        minsizes = range(start, stop, step)
+        minsizes = list(range(start, stop, step))
 
     if options["hrs"]:
         hrs = [float(x) for x in options["hrs"].split(",")]
@@ -859,6 +1146,15 @@ def main():
         # representation and back to float
         radiuses = [float(y) for y in ["%.2f" % x for x in iter_radiuses]]
 
+    # The values which are searched, in the order of the parameter tuples.
+    # For hierarchical segmentation all thresholds are segmented anyway.
+    if parms["hierarchical"]:
+        dims = [minsizes]
+    elif rg:
+        dims = [thresholds, minsizes]
+    else:
+        dims = [thresholds, hrs, radiuses, minsizes]
+
     if options["regions"]:
         regions = options["regions"].split(",")
     else:
@@ -872,6 +1168,17 @@ def main():
     temp_segment_map = "temp_segment_uspo_%d" % os.getpid()
     parms["temp_segment_map"] = temp_segment_map
 
+    # Cached results are only valid for the same input and segmentation type
+    settings = {
+        "group": group,
+        "rasters": rasters,
+        "seeds": parms["seeds"],
+        "method": method,
+        "hierarchical": parms["hierarchical"],
+        "adaptive": parms["adaptive"],
+    }
+    cache = read_cache(cache_file, settings)
+
     # Don't change general mapset region settings when switching regions
     gscript.use_temp_region()
 
@@ -884,147 +1191,59 @@ def main():
         parms["region"] = region.replace("@", "_at_")
 
         gscript.run_command("g.region", region=region, quiet=True)
+        region_cache = get_region_cache(cache, region)
 
         # Launch segmentation and optimization calculation in parallel processes
-        processes_list = []
-        result_queue = Queue()
-        if rg:
-            if hierarchical_segmentation:
-                minsize_queue = Queue()
-                for minsize in minsizes:
-                    minsize_queue.put(minsize)
-                for p in xrange(processes):
-                    proc = Process(
-                        target=rg_hier_worker,
-                        args=(parms, thresholds, minsize_queue, result_queue),
-                    )
-                    proc.start()
-                    processes_list.append(proc)
-                    minsize_queue.put("STOP")
-                for p in processes_list:
-                    p.join()
-                result_queue.put("STOP")
-            else:
-                parameter_queue = Queue()
-                for minsize in minsizes:
-                    for threshold in thresholds:
-                        parameter_queue.put([threshold, minsize])
-                for p in xrange(processes):
-                    proc = Process(
-                        target=rg_nonhier_worker,
-                        args=(parms, parameter_queue, result_queue),
-                    )
-                    proc.start()
-                    processes_list.append(proc)
-                    parameter_queue.put("STOP")
-                for p in processes_list:
-                    p.join()
-                result_queue.put("STOP")
-
+        if search == "coarse_to_fine":
+            keys = coarse_to_fine_search(parms, dims, region_cache, processes, nb_best)
         else:
-            parameter_queue = Queue()
-            for minsize in minsizes:
-                for threshold in thresholds:
-                    for hr in hrs:
-                        for radius in radiuses:
-                            parameter_queue.put([threshold, hr, radius, minsize])
-            for p in xrange(processes):
-                proc = Process(
-                    target=ms_worker, args=(parms, parameter_queue, result_queue)
-                )
-                proc.start()
-                processes_list.append(proc)
-                parameter_queue.put("STOP")
-            for p in processes_list:
-                p.join()
-            result_queue.put("STOP")
+            indices = product(*[range(len(values)) for values in dims])
+            keys = evaluate_grid(parms, dims, indices, region_cache, processes)
+        write_cache(cache_file, cache)
 
         # Construct result lists
-        regional_maplist = []
-        threshlist = []
-        minsizelist = []
-        variancelist = []
-        autocorlist = []
-
-        if rg:
-            for result in iter(result_queue.get, "STOP"):
-                if len(result) == 5:
-                    mapname, lv, autocor, threshold, minsize = result
-                    regional_maplist.append(mapname)
-                    variancelist.append(lv)
-                    autocorlist.append(autocor)
-                    threshlist.append(threshold)
-                    minsizelist.append(minsize)
-                else:
-                    gscript.message("Error in worker function: %s" % result)
-        else:
-            hrlist = []
-            radiuslist = []
-            for result in iter(result_queue.get, "STOP"):
-                if len(result) == 7:
-                    mapname, lv, autocor, threshold, hr, radius, minsize = result
-                    regional_maplist.append(mapname)
-                    variancelist.append(lv)
-                    autocorlist.append(autocor)
-                    threshlist.append(threshold)
-                    hrlist.append(hr)
-                    radiuslist.append(radius)
-                    minsizelist.append(minsize)
-                else:
-                    gscript.message("Error in worker function: %s" % result)
+        parameter_list = [x for x in sorted(keys) if keys[x] in region_cache]
+        if not parameter_list:
+            gscript.fatal(_("No segmentation succeeded in region <%s>") % region)
+        results = [region_cache[keys[x]] for x in parameter_list]
+        regional_maplist = [result[0] for result in results]
+        variancelist = [result[1] for result in results]
+        autocorlist = [result[parms["autocor_index"]] for result in results]
 
-        maplist += regional_maplist
         # Calculate optimization function values and get indices of best values
-        if max(variancelist) > min(variancelist) and max(autocorlist) > min(
-            autocorlist
-        ):
-            optlist = create_optimization_list(
-                variancelist, autocorlist, opt_function, alpha, directions[indicator]
-            )
-            if rg:
-                regiondict[region] = zip(
-                    threshlist, minsizelist, variancelist, autocorlist, optlist
-                )
-            else:
-                regiondict[region] = zip(
-                    threshlist,
-                    hrlist,
-                    radiuslist,
-                    minsizelist,
-                    variancelist,
-                    autocorlist,
-                    optlist,
+        optlist = optimization_list(parms, results)
+        regional_best = []
+        if optlist is not None:
+            regiondict[region] = [
+                parameters + (variance, autocor, opt)
+                for parameters, variance, autocor, opt in zip(
+                    parameter_list, variancelist, autocorlist, optlist
                 )
+            ]
 
             optimal_indices = find_optimal_value_indices(optlist, nb_best)
             best_values[region] = []
             rank = 1
             for optind in optimal_indices:
-                if rg:
-                    best_values[region].append(
-                        [threshlist[optind], minsizelist[optind], optlist[optind]]
-                    )
-                else:
-                    best_values[region].append(
-                        [
-                            threshlist[optind],
-                            hrlist[optind],
-                            radiuslist[optind],
-                            minsizelist[optind],
-                            optlist[optind],
-                        ]
-                    )
-                maps_to_keep.append([regional_maplist[optind], rank, parms["region"]])
-                rank += 1
-        else:
-            best_values[region] = []
-            if rg:
-                best_values[region].append([threshlist[0], minsizelist[0], -1])
-            else:
                 best_values[region].append(
-                    [threshlist[0], hrlist[0], radiuslist[0], minsizelist[0], -1]
+                    list(parameter_list[optind]) + [optlist[optind]]
                 )
-            maps_to_keep.append([regional_maplist[0], -1, parms["region"]])
+                regional_best.append([optind, rank])
+                rank += 1
+        else:
+            best_values[region] = [list(parameter_list[0]) + [-1]]
+            regional_best.append([0, -1])
+
+        for optind, rank in regional_best:
+            mapname = regional_maplist[optind]
+            # Segmentations taken from the cache might have been removed
+            if segmented_map and not map_exists(mapname):
+                mapnames = segment(parms, parameter_list[optind])
+                maplist.extend(mapnames)
+                mapname = mapnames[-1]
+                region_cache[keys[parameter_list[optind]]][0] = mapname
+            maps_to_keep.append([mapname, rank, parms["region"]])
+        write_cache(cache_file, cache)
 
     # Create output
 
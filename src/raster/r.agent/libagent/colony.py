@@ -0,0 +1,362 @@
+"""
+MODULE:       r.agent.*
+AUTHOR(S):    michael lustenberger inofix.ch
+PURPOSE:      library file for the r.agent.* suite
+COPYRIGHT:    (C) 2015 by Michael Lustenberger and the GRASS Development Team
+
+              This program is free software under the GNU General Public
+              License (>=v2). Read the file COPYING that comes with GRASS
+              for details.
+"""
+
+import numpy
+
+from libagent import anthill, playground
+
+
+class Colony(anthill.Anthill):
+    """
+    An array based Anthill.
+
+    Instead of one Ant object per agent, the state of all the ants is
+    kept in a structured numpy array (one record per ant), and the paths
+    walked are kept in a second structured array (one row per ant). Each
+    round advances all the living ants at once with vectorised operations,
+    following the same rules and using the same parameters as the ants
+    of the Anthill:
+
+     - one ant is born per round on a random site as long as there are
+       not more than maxants ants around
+     - every ant ages by one round and dies when its time is over
+     - an ant without a next step looks around, heads back home when it
+       smells a site (other than its own home), or otherwise chooses the
+       neighbour with the best mix of pheromone, randomness and cost
+     - an ant waits as long as the penalty of its steps is positive
+     - walking around, ants mark every step, walking home, they mark
+       the path they came along
+
+    As all the ants of a round decide at the same time, they only see
+    the pheromone as it was at the beginning of the round.
+    """
+
+    # record layout of the ants
+    ANT = numpy.dtype(
+        [
+            ("alive", numpy.bool_),
+            ("ttl", numpy.int64),
+            ("homerow", numpy.int64),
+            ("homecol", numpy.int64),
+            ("row", numpy.int64),
+            ("col", numpy.int64),
+            ("diagonal", numpy.bool_),
+            ("nextrow", numpy.int64),
+            ("nextcol", numpy.int64),
+            ("nextdiagonal", numpy.bool_),
+            ("penalty", numpy.float64),
+            ("homing", numpy.bool_),
+            ("pathlength", numpy.int64),
+        ]
+    )
+
+    # record layout of a step on the paths
+    STEP = numpy.dtype(
+        [("row", numpy.int64), ("col", numpy.int64), ("diagonal", numpy.bool_)]
+    )
+
+    def __init__(self, pg=None, seed=None):
+        """
+        Create an array based world following the natural laws of ACO.
+        @param playground optional, if playground already exists
+        @param int optional, seed for the random number generator
+        """
+        super(Colony, self).__init__(pg)
+        self.random = numpy.random.RandomState(seed)
+        self.ants = numpy.zeros(0, dtype=Colony.ANT)
+        self.paths = numpy.zeros((0, 0), dtype=Colony.STEP)
+
+    def countants(self):
+        """
+        Return the number of living ants
+        @return int number of ants
+        """
+        return int(numpy.count_nonzero(self.ants["alive"]))
+
+    def reserve(self):
+        """
+        Make sure the arrays have room for as many ants as may live at
+        the same time: one is born per round and each lives at most
+        antslife + 1 rounds.
+        """
+        capacity = int(min(self.maxants, self.antslife + 1)) + 1
+        if self.ants.shape[0] < capacity:
+            ants = numpy.zeros(capacity, dtype=Colony.ANT)
+            ants[: self.ants.shape[0]] = self.ants
+            paths = numpy.zeros((capacity, self.paths.shape[1]), dtype=Colony.STEP)
+            paths[: self.paths.shape[0]] = self.paths
+            self.ants = ants
+            self.paths = paths
+
+    def extendpaths(self, length):
+        """
+        Make sure every ant can remember at least length steps
+        @param int number of steps
+        """
+        width = self.paths.shape[1]
+        if width < length:
+            width = max(length, 2 * width, 16)
+            paths = numpy.zeros((self.ants.shape[0], width), dtype=Colony.STEP)
+            paths[:, : self.paths.shape[1]] = self.paths
+            self.paths = paths
+
+    def bear(self):
+        """
+        Set a new ant on a random site
+        @return int index of the newly born ant
+        """
+        self.reserve()
+        free = numpy.flatnonzero(~self.ants["alive"])
+        i = free[0]
+        site = self.sites[self.random.randint(0, len(self.sites))]
+        ant = self.ants[i : i + 1]
+        ant["alive"] = True
+        ant["ttl"] = self.antslife
+        ant["homerow"] = site[0]
+        ant["homecol"] = site[1]
+        ant["row"] = site[0]
+        ant["col"] = site[1]
+        ant["diagonal"] = False
+        ant["nextrow"] = -1
+        ant["nextcol"] = -1
+        ant["nextdiagonal"] = False
+        ant["penalty"] = 0
+        ant["homing"] = False
+        ant["pathlength"] = 0
+        return i
+
+    def kill(self, indices):
+        """
+        Remove the ants from the colony
+        @param array indices of the ants to be terminated
+        """
+        self.ants["alive"][indices] = False
+
+    def getneighbours(self, rows, cols):
+        """
+        Collect the neighbour cells of a set of cells
+        @param array row indices of the cells
+        @param array column indices of the cells
+        @return tuple of arrays neighbour rows, columns, diagonal flags and
+                validity, each shaped (cells, freedom)
+        """
+        return self.playground.getneighbourcells(rows, cols, Colony.FREEDOM)
+
+    def choose(self, indices):
+        """
+        Let the ants without a next step decide where to go to.
+        @param array indices of the deciding ants
+        """
+        ants = self.ants
+        rows = ants["row"][indices]
+        cols = ants["col"][indices]
+        nrows, ncols, diagonal, valid = self.getneighbours(rows, cols)
+        # the home site does not count as a goal
+        home = (nrows == ants["homerow"][indices, None]) & (
+            ncols == ants["homecol"][indices, None]
+        )
+        sites = self.getlayer(anthill.Anthill.SITE)
+        found = (valid & ~home & (sites[nrows, ncols] < 0)).any(axis=1)
+
+        # the lucky ones found a goal and head back home..
+        if found.any():
+            self.numberofpaths += int(numpy.count_nonzero(found))
+            finders = indices[found]
+            ants["homing"][finders] = True
+            lost = finders[ants["pathlength"][finders] == 0]
+            self.kill(lost)
+            finders = finders[ants["pathlength"][finders] > 0]
+            self.popstep(finders)
+
+        # ..the others pick a next step
+        deciders = ~found
+        if not deciders.any():
+            return
+        indices = indices[deciders]
+        nrows = nrows[deciders]
+        ncols = ncols[deciders]
+        diagonal = diagonal[deciders]
+        valid = valid[deciders]
+
+        pheromone = self.getlayer(anthill.Anthill.RESULT)
+        scores = (
+            pheromone[nrows, ncols] * self.pheroweight
+            + self.random.uniform(self.minrandom, self.maxrandom, nrows.shape)
+            * self.randomweight
+        )
+        if self.decisionbase == "costlymarked":
+            penalties = self.getlayer(anthill.Anthill.COST)[nrows, ncols]
+            valid &= (penalties >= self.minpenalty) & (penalties <= self.maxpenalty)
+            scores -= penalties * self.costweight
+        scores = numpy.where(valid, scores, -numpy.inf)
+
+        # die as there is nowhere to go to
+        stuck = ~valid.any(axis=1)
+        self.kill(indices[stuck])
+
+        # pick the best neighbour, breaking ties by chance
+        best = valid & (scores == scores.max(axis=1)[:, None])
+        pick = numpy.argmax(best * self.random.random_sample(best.shape), axis=1)
+        movers = ~stuck
+        indices = indices[movers]
+        pick = pick[movers]
+        rowidx = numpy.flatnonzero(movers)
+        ants["nextrow"][indices] = nrows[rowidx, pick]
+        ants["nextcol"][indices] = ncols[rowidx, pick]
+        ants["nextdiagonal"][indices] = diagonal[rowidx, pick]
+        self.addsteppenalty(indices)
+
+    def addsteppenalty(self, indices):
+        """
+        Add the penalty of the next step to the ants waiting time
+        @param array indices of the ants
+        """
+        ants = self.ants
+        penalties = self.getlayer(anthill.Anthill.COST)
+        ants["penalty"][indices] += (
+            ants["nextdiagonal"][indices] * playground.Playground.DIAGONAL
+            + penalties[ants["nextrow"][indices], ants["nextcol"][indices]]
+        )
+
+    def popstep(self, indices):
+        """
+        Take the last step from the paths of the ants as their next step
+        @param array indices of the ants
+        """
+        ants = self.ants
+        last = ants["pathlength"][indices] - 1
+        steps = self.paths[indices, last]
+        ants["nextrow"][indices] = steps["row"]
+        ants["nextcol"][indices] = steps["col"]
+        ants["nextdiagonal"][indices] = steps["diagonal"]
+        ants["pathlength"][indices] = last
+        self.addsteppenalty(indices)
+
+    def forgetloops(self, indices):
+        """
+        Shorten the paths of the ants to the first visit of their last
+        position, i.e. forget the loop inbetween.
+        @param array indices of the ants
+        """
+        if not indices.size:
+            return
+        ants = self.ants
+        length = ants["pathlength"][indices]
+        paths = self.paths[indices]
+        last = paths[numpy.arange(indices.size), length - 1]
+        same = (
+            (paths["row"] == last["row"][:, None])
+            & (paths["col"] == last["col"][:, None])
+            & (numpy.arange(paths.shape[1]) < length[:, None])
+        )
+        ants["pathlength"][indices] = numpy.argmax(same, axis=1) + 1
+
+    def mark(self, rows, cols, intensity):
+        """
+        Mark the positions with pheromone (multiple marks on the same
+        position add up)
+        @param array row indices of the positions
+        @param array column indices of the positions
+        @param numeric intensity of each mark
+        """
+        if not rows.size:
+            return
+        layer = self.getlayer(anthill.Anthill.RESULT)
+        numpy.add.at(layer, (rows, cols), intensity)
+        layer[rows, cols] = numpy.minimum(layer[rows, cols], self.maxpheromone)
+
+    def walkaround(self, indices):
+        """
+        Perform a regular step for all the ants walking around
+        @param array indices of the ants
+        """
+        if not indices.size:
+            return
+        ants = self.ants
+        length = ants["pathlength"][indices]
+        self.extendpaths(int(length.max()) + 1)
+        self.paths["row"][indices, length] = ants["row"][indices]
+        self.paths["col"][indices, length] = ants["col"][indices]
+        self.paths["diagonal"][indices, length] = ants["diagonal"][indices]
+        ants["pathlength"][indices] = length + 1
+        self.movetonext(indices)
+        self.mark(ants["row"][indices], ants["col"][indices], self.stepintensity)
+
+    def walkhome(self, indices):
+        """
+        Perform a regular step for all the ants walking back home
+        @param array indices of the ants
+        """
+        ants = self.ants
+        self.movetonext(indices)
+        rows = ants["row"][indices]
+        cols = ants["col"][indices]
+        # retire after work..
+        walking = ants["pathlength"][indices] > 1
+        self.kill(indices[~walking])
+        # ..or walk only up to the gates of the hometown
+        indices = indices[walking]
+        if self.antavoidsloops:
+            self.forgetloops(indices)
+        self.popstep(indices)
+        self.mark(rows, cols, self.pathintensity)
+
+    def movetonext(self, indices):
+        """
+        Put the ants on their next step
+        @param array indices of the ants
+        """
+        ants = self.ants
+        ants["row"][indices] = ants["nextrow"][indices]
+        ants["col"][indices] = ants["nextcol"][indices]
+        ants["diagonal"][indices] = ants["nextdiagonal"][indices]
+        ants["nextrow"][indices] = -1
+        ants["nextcol"][indices] = -1
+        ants["nextdiagonal"][indices] = False
+
+    def work(self):
+        """
+        Let all the ants perform one round of work.
+        """
+        ants = self.ants
+        alive = numpy.flatnonzero(ants["alive"])
+        # we are all only getting older..
+        dying = ants["ttl"][alive] <= 0
+        self.kill(alive[dying])
+        alive = alive[~dying]
+        ants["ttl"][alive] -= 1
+        # at this point either we already know where to go to next..
+        undecided = alive[ants["nextrow"][alive] < 0]
+        if undecided.size:
+            # ..or we'll have to decide it now if it was not clear yet
+            self.choose(undecided)
+        alive = alive[ants["alive"][alive]]
+        # if penalty is positive, wait one round
+        waiting = ants["penalty"][alive] > 0
+        ants["penalty"][alive[waiting]] -= 1
+        walking = alive[~waiting]
+        homing = ants["homing"][walking]
+        self.walkaround(walking[~homing])
+        self.walkhome(walking[homing])
+
+    def letantsdance(self, rounds):
+        """
+        Let the agents do their job. The actual main loop in such a world.
+        """
+        while rounds > 0:
+            if self.countants() <= self.maxants:
+                # as there is still space on the pg, produce another ant
+                self.bear()
+            self.work()
+            # let the pheromone evaporate
+            self.volatilize()
+            # count down
+            rounds -= 1
@@ -10,7 +10,10 @@ COPYRIGHT:    (C) 2015 by Michael Lustenberger and the GRASS Development Team
 """
 
 import grass.script as grass
-from grass.script import array as garray
+from grass.pygrass.raster import RasterRow
+from grass.pygrass.raster.buffer import Buffer
+
+import numpy
 
 from libagent import error, playground
 
@@ -45,9 +48,17 @@ class Grassland(playground.Playground):
         @param string name of an existing GRASS map layer
         @param boolean optional, whether to overwrite values if key exists
         """
-        # fill the new grass array with the contents from the map (must exist)
+        # fill the new layer with the contents from the map (must exist)
         if grassmapname in grass.list_strings("rast"):
-            layer = garray.array(grassmapname)
+            layer = self.newlayer()
+            name, mapset = (grassmapname.split("@") + [""])[:2]
+            with RasterRow(name, mapset) as rast:
+                for i in range(self.region["rows"]):
+                    row = rast.get_row(i)
+                    layer[i] = row
+                    if rast.mtype == "CELL":
+                        # integer maps mark null cells with the smallest int
+                        layer[i][row == numpy.iinfo(numpy.int32).min] = numpy.nan
             self.grassmapnames[layername] = grassmapname
             self.setlayer(layername, layer, force)
         else:
@@ -62,7 +73,7 @@ class Grassland(playground.Playground):
         @param string optional name of a GRASS map layer (False if only local)
         @param boolean optional, whether to overwrite an existing layer
         """
-        layer = garray.array()
+        layer = self.newlayer()
         if grassmapname:
             self.grassmapnames[layername] = grassmapname
         self.setlayer(layername, layer, force)
@@ -95,7 +106,18 @@ class Grassland(playground.Playground):
                     force = "force"
                 else:
                     raise error.DataError(Grassland.ME, "Grass map already exists.")
-            self.layers[layername].write(grassmapname, overwrite=force)
+            layer = self.layers[layername]
+            # new maps are always written to the current mapset
+            name = grassmapname.split("@")[0]
+            rast = RasterRow(name)
+            rast.open("w", mtype="DCELL", overwrite=bool(force))
+            try:
+                row = Buffer((self.region["cols"],), mtype="DCELL")
+                for i in range(self.region["rows"]):
+                    row[:] = layer[i]
+                    rast.put_row(row)
+            finally:
+                rast.close()
         else:
             raise error.DataError(Grassland.ME, "Layer is not in list.")
 
@@ -122,22 +144,21 @@ class Grassland(playground.Playground):
                     p[0] = int(round((self.region["n"] - p[0]) / self.region["nsres"]))
                     p[1] = int(round((p[1] - self.region["w"]) / self.region["ewres"]))
                     vectors.append(p)
-                    self.layers[layername][p[0]][p[1]] = value
+                    self.layers[layername][p[0], p[1]] = value
         return vectors
 
     def decaycellvalues(self, layername, halflife, minimum=0):
         """
         Let the values in each cell decay, volatilize or evaporate over time.
-        This method is optimized for numpy arrays, see playground for plain
-        arrays.
+        Unlike in the playground, all the values are kept at or above the
+        minimum. The layer is modified in place.
         @param string layername name of the layer to work on
         @param long halflife or number of years when to reach half of the value
         @param long minimum value to keep on cell
         """
+        layer = self.layers[layername]
         if halflife > 0:
-            self.layers[layername] = self.layers[layername] * 0.5 ** (1.0 / halflife)
-            # TODO find out why 'filename' is lost - numpy vs. garray..
+            numpy.multiply(layer, 0.5 ** (1.0 / halflife), out=layer)
         # TODO think about moving 'minimum' to a predifined matrix in anthill
         if minimum > 0:
-            mask = garray.numpy.ones_like(self.layers[layername]) - 1 + minimum
-            self.layers[layername] = garray.numpy.maximum(self.layers[layername], mask)
+            numpy.maximum(layer, minimum, out=layer)
@@ -10,6 +10,7 @@ COPYRIGHT:    (C) 2015 by Michael Lustenberger and the GRASS Development Team
 """
 
 import random
+import tempfile
 from math import sqrt
 
 from libagent import error
@@ -27,6 +28,24 @@ class Playground(object):
     STRAIGHT = 0
     DIAGONAL = sqrt(2) - 1
 
+    # neighbour offsets (row, column, diagonal) in the order of
+    # getorderedneighbourpositions
+    OFFSETS = numpy.array(
+        [
+            [-1, 0, 0],
+            [1, 0, 0],
+            [0, -1, 0],
+            [0, 1, 0],
+            [-1, -1, 1],
+            [1, -1, 1],
+            [-1, 1, 1],
+            [1, 1, 1],
+        ]
+    )
+
+    # layers with more cells than this are memory-mapped to a temporary file
+    MEMMAPCELLS = 100000000
+
     def __init__(self):
         """Create a Playground"""
         self.layers = dict()
@@ -117,6 +136,20 @@ class Playground(object):
             )
         self.layers[layername] = layer
 
+    def newlayer(self, dtype=numpy.float64):
+        """
+        Create a new, empty layer covering the region, i.e. a 2D numpy array,
+        memory-mapped to a temporary file if the region is very large
+        @param dtype optional, numpy type of the cell values
+        @return array the new layer
+        """
+        shape = (self.region["rows"], self.region["cols"])
+        if shape[0] * shape[1] > Playground.MEMMAPCELLS:
+            return numpy.memmap(
+                tempfile.TemporaryFile(), dtype=dtype, mode="w+", shape=shape
+            )
+        return numpy.zeros(shape, dtype=dtype)
+
     def createlayer(self, layername, filename=False, force=False):
         """
         Create a new layer and add it to the layer collection
@@ -124,9 +157,7 @@ class Playground(object):
         @param string optional name, whether to create it from an existing file
         @param boolean optional, whether to overwrite an existing layer
         """
-        r = self.region["rows"]
-        c = self.region["cols"]
-        layer = numpy.zeros(r * c).reshape((r, c))
+        layer = self.newlayer()
 
         if filename:
             # TODO import from file
@@ -246,6 +277,32 @@ class Playground(object):
             )
         return positions
 
+    def getneighbourcells(self, rows, cols, freedom):
+        """
+        Get the neighbour cells of many cells at once, ordered like in
+        getorderedneighbourpositions
+        @param array row indices of the cells
+        @param array column indices of the cells
+        @param int number of potentially reachable neighbours
+        @return tuple of arrays neighbour rows, columns, diagonal flags and
+                validity, each shaped (cells, freedom); invalid neighbours
+                are moved onto the playground so they may still be used as
+                indices
+        """
+        offsets = Playground.OFFSETS[:freedom]
+        nrows = numpy.asarray(rows)[:, None] + offsets[:, 0]
+        ncols = numpy.asarray(cols)[:, None] + offsets[:, 1]
+        diagonal = numpy.broadcast_to(offsets[:, 2] == 1, nrows.shape)
+        valid = (
+            (nrows >= 0)
+            & (nrows < self.region["rows"])
+            & (ncols >= 0)
+            & (ncols < self.region["cols"])
+        )
+        nrows = numpy.clip(nrows, 0, self.region["rows"] - 1)
+        ncols = numpy.clip(ncols, 0, self.region["cols"] - 1)
+        return nrows, ncols, diagonal, valid
+
     def getneighbourpositions(self, position, freedom):
         """
         Get all the positions reachable from a certain position and shuffle
@@ -265,7 +322,7 @@ class Playground(object):
         @param position the exact position of the cell in question
         @return the value stored in the cell
         """
-        return self.layers[layername][position[0]][position[1]]
+        return self.layers[layername][position[0], position[1]]
 
     def setcellvalue(self, layername, position, value):
         """
@@ -273,23 +330,19 @@ class Playground(object):
         @param layername the name of the layer to be edited
         @param position the exact position of the cell in question
         """
-        self.layers[layername][position[0]][position[1]] = value
+        self.layers[layername][position[0], position[1]] = value
 
     def decaycellvalues(self, layername, halflife, minimum=0):
         """
         Let the values in each cell decay, volatilize or evaporate over time.
-        This method is intended for relatively small 2D python arrays, see
-        grassland.Grassland.decaycellvalues for numpy arrays.
+        Only the values above the minimum decay, and never below it. The
+        layer is modified in place.
         @param string layername name of the layer to work on
         @param long halflife or number of years when to reach half of the value
         @param long minimum value to keep on cell
         """
         if halflife > 0:
-            for i in range(self.region["rows"]):
-                for j in range(self.region["cols"]):
-                    if self.layers[layername][i][j] > minimum:
-                        v = self.layers[layername][i][j] * 0.5 ** (1.0 / halflife)
-                        if v > minimum:
-                            self.layers[layername][i][j] = v
-                        else:
-                            self.layers[layername][i][j] = minimum
+            layer = self.layers[layername]
+            above = layer > minimum
+            numpy.multiply(layer, 0.5 ** (1.0 / halflife), out=layer, where=above)
+            numpy.maximum(layer, minimum, out=layer, where=above)
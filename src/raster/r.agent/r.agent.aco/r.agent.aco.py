@@ -217,6 +217,13 @@ COPYRIGHT:    (C) 2011 by Michael Lustenberger and the GRASS Development Team
 #% options: 0-99999
 #% required : yes
 #%end
+#%option
+#% key: seed
+#% type: integer
+#% gisprompt: number
+#% description: Seed for the random number generator (for reproducible runs)
+#% required : no
+#%end
 
 import sys
 from sys import exit, maxsize
@@ -232,7 +239,7 @@ except ImportError:
 from grass.pygrass.utils import set_path
 
 set_path("r.agent", "libagent", "..")
-from libagent import error, grassland, anthill
+from libagent import error, grassland, anthill, colony
 
 
 def setmaps(site, cost, wastecosts, inphero, outphero, wastephero):
@@ -271,9 +278,6 @@ def setmaps(site, cost, wastecosts, inphero, outphero, wastephero):
             inphero = inphero + "@" + grass.gisenv()["MAPSET"]
         world.playground.setgrasslayer(anthill.Anthill.RESULT, inphero, True)
     world.playground.grassmapnames[anthill.Anthill.RESULT] = outphero
-    # TODO hopefully not really needed - workaround for broken(?) garray
-    world.playground.createlayer("copy", outphero, True)
-    world.playground.grassmapnames["copy"] = outphero
     world.overwritepheormone = wastephero
 
 
@@ -305,15 +309,9 @@ def letantsdance(rounds, outrounds):
         # Print the number of found paths
         grass.info("Number of found paths: " + str(world.numberofpaths))
         # export the value maps
-        # TODO hopefully not really needed - workaround for broken(?) garray
-        for i in range(len(world.playground.layers[anthill.Anthill.RESULT])):
-            for j in range(len(world.playground.layers[anthill.Anthill.RESULT][0])):
-                world.playground.layers["copy"][i][j] = world.playground.layers[
-                    anthill.Anthill.RESULT
-                ][i][j]
-        world.playground.writelayer("copy", outputmapname, world.overwritepheormone)
-        # TODO world.playground.writelayer(anthill.Anthill.RESULT, False,
-        # TODO                                    world.overwritepheormone)
+        world.playground.writelayer(
+            anthill.Anthill.RESULT, outputmapname, world.overwritepheormone
+        )
         #        print "nrofpaths:", world.nrop
         # count down outer
         run += 1
@@ -387,5 +385,9 @@ def main():
 
 if __name__ == "__main__":
     options, flags = grass.parser()
-    world = anthill.Anthill(grassland.Grassland())
+    if options["seed"]:
+        seed = int(options["seed"])
+    else:
+        seed = None
+    world = colony.Colony(grassland.Grassland(), seed)
     main()
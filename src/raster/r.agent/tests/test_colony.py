@@ -0,0 +1,73 @@
+import unittest2 as unittest
+
+# import unittest
+
+import numpy
+
+from libagent import playground, anthill, colony
+
+
+class TestColony(unittest.TestCase):
+    def setUp(self):
+        self.pg = playground.Playground()
+        self.pg.setregion(3, 3)
+        self.world = colony.Colony(self.pg, 1)
+        self.world.sites = [[1, 1]]
+        self.world.antslife = 5
+
+    def test_bear(self):
+        i = self.world.bear()
+        self.assertEqual(1, self.world.countants())
+        self.assertTrue(self.world.ants["alive"][i])
+        self.assertEqual(1, self.world.ants["row"][i])
+        self.assertEqual(1, self.world.ants["col"][i])
+        self.assertEqual(5, self.world.ants["ttl"][i])
+
+    def test_kill(self):
+        i = self.world.bear()
+        self.world.kill([i])
+        self.assertEqual(0, self.world.countants())
+
+    def test_getneighbours(self):
+        rows, cols, diagonal, valid = self.world.getneighbours(
+            numpy.array([1, 2]), numpy.array([1, 2])
+        )
+        self.assertEqual((2, 8), rows.shape)
+        self.assertEqual(8, valid[0].sum())
+        self.assertEqual(3, valid[1].sum())
+        self.assertEqual(4, diagonal[0].sum())
+
+    def test_work(self):
+        self.world.pheroweight = 1
+        self.world.randomweight = 0
+        self.pg.layers[anthill.Anthill.RESULT][0][1] = 999
+        i = self.world.bear()
+        self.world.work()
+        self.assertEqual(0, self.world.ants["row"][i])
+        self.assertEqual(1, self.world.ants["col"][i])
+        self.assertEqual(1, self.world.ants["pathlength"][i])
+        self.assertEqual(
+            999 + self.world.stepintensity, self.world.getpheromone([0, 1])
+        )
+
+    def test_findpath(self):
+        self.world.sites = [[2, 2]]
+        self.world.randomweight = 0
+        self.pg.layers[anthill.Anthill.SITE][2][2] = -1
+        self.pg.layers[anthill.Anthill.SITE][0][1] = -1
+        self.pg.layers[anthill.Anthill.RESULT][1][2] = 999
+        self.world.bear()
+        # first step away from home..
+        self.world.work()
+        self.assertEqual(0, self.world.numberofpaths)
+        # ..then the other site is in sight and the ant walks back home
+        self.world.work()
+        self.assertEqual(1, self.world.numberofpaths)
+        self.assertEqual(self.world.pathintensity, self.world.getpheromone([2, 2]))
+
+    def test_letantsdance(self):
+        self.world.letantsdance(10)
+        self.assertTrue(self.world.countants() <= self.world.antslife + 1)
+
+
+#    def tearDown(self):
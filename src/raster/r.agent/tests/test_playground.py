@@ -127,6 +127,31 @@ class TestPlayground(unittest.TestCase):
         self.assertEqual(0, ps[3][3])
         self.assertEqual(sqrt(2) - 1, ps[6][3])
 
+    def test_getneighbourcells(self):
+        self.pg.setregion(3, 3)
+        rows, cols, diagonal, valid = self.pg.getneighbourcells([1, 2], [1, 2], 8)
+        self.assertEqual((2, 8), rows.shape)
+        self.assertEqual(8, valid[0].sum())
+        self.assertEqual(3, valid[1].sum())
+        self.assertEqual([2, 1], [rows[0][1], cols[0][1]])
+        self.assertTrue(diagonal[0][7])
+        self.assertFalse(diagonal[0][3])
+        rows, cols, diagonal, valid = self.pg.getneighbourcells([2], [2], 4)
+        self.assertEqual(2, valid.sum())
+
+    def test_newlayer(self):
+        self.pg.setregion(3, 2)
+        layer = self.pg.newlayer()
+        self.assertEqual((3, 2), layer.shape)
+        limit = playground.Playground.MEMMAPCELLS
+        playground.Playground.MEMMAPCELLS = 4
+        try:
+            layer = self.pg.newlayer()
+        finally:
+            playground.Playground.MEMMAPCELLS = limit
+        self.assertEqual((3, 2), layer.shape)
+        self.assertEqual(0, layer.sum())
+
     def test_getneighbourpositions(self):
         self.pg.setregion(3, 3)
         ps = self.pg.getneighbourpositions([2, 2], 4)
@@ -159,6 +184,8 @@ class TestPlayground(unittest.TestCase):
         self.assertEqual(int(round(self.pg.layers[l][0][0])), 63)
         self.pg.decaycellvalues(l, 3)
         self.assertEqual(int(round(self.pg.layers[l][0][0])), 50)
+        self.pg.decaycellvalues(l, 3, 45)
+        self.assertEqual(int(round(self.pg.layers[l][0][0])), 45)
 
 
 #    def tearDown(self):
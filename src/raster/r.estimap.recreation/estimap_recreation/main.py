@@ -113,6 +113,7 @@ def main(options, flags):
     average_filter = flags["f"]
     landuse_extent = flags["e"]
     print_only = flags["p"]
+    zonal_supply = flags["z"]
 
     timestamp = options["timestamp"]
 
@@ -713,6 +714,7 @@ def main(options, flags):
             ns_resolution=population_ns_resolution,
             ew_resolution=population_ew_resolution,
             print_only=print_only,
+            zonal=zonal_supply,
             **supply_parameters
         )
 
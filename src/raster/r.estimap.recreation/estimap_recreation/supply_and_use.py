@@ -71,6 +71,168 @@ def compile_use_table(supply):
     return uses
 
 
+def parse_scores(rules):
+    """Parse the labels of reclassification rules in the form of
+    'low thru high = category label' (or 'low = category label') into
+    scores for each category of the input map
+
+    Parameters
+    ----------
+    rules :
+        Reclassification rules, one per line, whose labels are scores
+
+    Returns
+    -------
+    scores :
+        A dictionary of the scores (float) keyed by each category (string)
+        covered by the rules
+
+    Examples
+    --------
+    >>> parse_scores("1 thru 2 = 1 0.5")
+    {'1': 0.5, '2': 0.5}
+    """
+    scores = {}
+    for rule in rules.strip().splitlines():
+        if "=" not in rule:
+            continue
+        source, target = rule.split("=", 1)
+        target = target.split()
+        if len(target) < 2:
+            continue
+        source = source.split()
+        low = int(source[0])
+        high = int(source[-1])
+        for category in range(low, high + 1):
+            scores[str(category)] = float(target[1])
+    return scores
+
+
+def compute_supply_statistics(
+    base,
+    reclassified_base,
+    flow_in_base,
+    aggregation,
+    scores,
+):
+    """Compute the supply statistics for all categories of the aggregation
+    map from a single cross-tabulation of the aggregation, the base and the
+    reclassified base maps
+
+    The MASK of the areas of highest recreational value is expected to be
+    set and the computational region to match the aggregation map.
+
+    Parameters
+    ----------
+    base :
+        Base land types map
+
+    reclassified_base :
+        Reclassified base map (i.e. MAES ecosystem types)
+
+    flow_in_base :
+        Map of the base land types, labelled with the sum of the flow within
+        each category
+
+    aggregation :
+        Map of zones for which to compute the supply
+
+    scores :
+        Dictionary of land suitability scores keyed by base category
+
+    Returns
+    -------
+    dictionary :
+        A nested dictionary in the form returned by get_raster_statistics()
+        for the aggregation map and the flow in the reclassified base map.
+    """
+    categories = grass.parse_command("r.category", map=aggregation, delimiter="\t")
+    flow_sums = grass.parse_command("r.category", map=flow_in_base, delimiter="\t")
+
+    # area and count of cells for each aggregation, base, reclassified base
+    statistics = grass.read_command(
+        "r.stats",
+        input=(aggregation, base, reclassified_base),
+        output="-",
+        flags="ca",
+        separator="|",
+        quiet=True,
+    )
+    extents = {}
+    cells = {}
+    for row in statistics.splitlines():
+        category, land, ecosystem, area, count = row.split("|")
+        if category == "*" or land == "*":
+            continue
+        area = float(area)
+        count = int(count)
+        extent = extents.setdefault(category, {})
+        extent[land] = extent.get(land, 0) + area
+        if ecosystem == "*":
+            continue
+        cell = cells.setdefault(category, {}).setdefault(ecosystem, {})
+        cell[land] = cell.get(land, [0, 0])
+        cell[land][0] += area
+        cell[land][1] += count
+
+    dictionary = {}
+    for category, label in categories.items():
+
+        msg = "\n>>> Processing category '{c}' of aggregation map '{a}'"
+        grass.verbose(_(msg.format(c=category, a=aggregation)))
+
+        if category not in extents:
+            continue
+
+        # Weighted extents of land types
+        weighted_extents = {
+            land: extent * scores[land]
+            for land, extent in extents[category].items()
+            if land in scores
+        }
+        category_sum = sum(
+            [x if not math.isnan(x) else 0 for x in weighted_extents.values()]
+        )
+        if not category_sum:
+            msg = "Sum of weighted extents in category '{c}' is 0, skipping"
+            grass.warning(_(msg.format(c=category)))
+            continue
+
+        # Weighted fractions of land types
+        fractions = {
+            land: value / category_sum for land, value in weighted_extents.items()
+        }
+        msg = "*** Fractions: {f}".format(f=fractions)
+        grass.debug(_(msg))
+
+        # Flow, area, count and percentage of cells in each ecosystem type
+        ecosystems = cells.get(category, {})
+        total = sum(
+            [count for lands in ecosystems.values() for _area, count in lands.values()]
+        )
+        inner_dictionary = {}
+        for ecosystem in sorted(ecosystems, key=int):
+            lands = ecosystems[ecosystem]
+            flow = sum(
+                [
+                    count * fractions[land] * float(flow_sums[land])
+                    for land, (_area, count) in lands.items()
+                    if land in fractions and land in flow_sums
+                ]
+            )
+            area = sum([area for area, _count in lands.values()])
+            count = sum([count for _area, count in lands.values()])
+            inner_dictionary[ecosystem] = [
+                "{:f}".format(flow),
+                "{:f}".format(area),
+                str(count),
+                "{:.2f}%".format(100.0 * count / total),
+            ]
+        dictionary[(category, label)] = inner_dictionary
+
+    return dictionary
+
+
 def compute_supply(
     base,
     recreation_spectrum,
@@ -87,6 +249,7 @@ def compute_supply(
     vector=None,
     supply_filename=None,
     use_filename=None,
+    zonal=False,
 ):
     """
     Parameters
@@ -139,6 +302,11 @@ def compute_supply(
         If 'vector' is given, a vector map of the 'flow' along with appropriate
         attributes will be produced.
 
+    zonal :
+        If True, compute the supply for all categories of the aggregation map
+        from a single cross-tabulation, instead of one MASK and set of
+        intermediate maps per category. Ignored if 'vector' is given.
+
     ? :
         Land cover class percentages in ROS9 (this is: relative percentage)
 
@@ -201,6 +369,46 @@ def compute_supply(
     # Set colors for "flow" map
     r.colors(map=flow_in_base, color=MOBILITY_COLORS, quiet=True)
 
+    if zonal and vector:
+        msg = "Vector output requires the flow maps of each category, "
+        msg += "computing the supply one category after the other"
+        grass.warning(_(msg))
+        zonal = False
+
+    if zonal:
+        g.region(
+            raster=aggregation,
+            nsres=ns_resolution,
+            ewres=ew_resolution,
+            flags="a",
+            quiet=True,
+        )
+        statistics_dictionary = compute_supply_statistics(
+            base=base,
+            reclassified_base=reclassified_base,
+            flow_in_base=flow_in_base,
+            aggregation=aggregation,
+            scores=parse_scores(SUITABILITY_SCORES_LABELS),
+        )
+        r.mask(flags="r", quiet=True)
+        remove_map_at_exit(reclassified_base)
+
+        if print_only:
+            for (category, _label), inner_dictionary in statistics_dictionary.items():
+                grass.verbose(" * Flow in category {c}:".format(c=category))
+                for inner_key, inner_value in inner_dictionary.items():
+                    print(",".join([inner_key] + inner_value))
+
+        else:
+            if supply_filename:
+                nested_dictionary_to_csv(supply_filename, statistics_dictionary)
+
+            if use_filename:
+                uses = compile_use_table(statistics_dictionary)
+                dictionary_to_csv(use_filename, uses)
+
+        return flows
+
     # Parse aggregation raster categories and labels
     categories = grass.parse_command("r.category", map=aggregation, delimiter="\t")
 
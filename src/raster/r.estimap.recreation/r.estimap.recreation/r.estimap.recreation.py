@@ -79,6 +79,11 @@ from __future__ import print_function
 #%  description: Print out results (i.e. supply table), don't export to file
 #%end
 
+#%flag
+#%  key: z
+#%  description: Compute the supply of all aggregation categories in a single pass
+#%end
+
 """
 exclusive: at most one of the options may be given
 required: at least one of the options must be given
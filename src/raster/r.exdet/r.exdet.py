@@ -91,17 +91,28 @@
 #% description: Keep layer Mahalanobis distance in reference domain?
 #%end
 
+#%option
+#% key: nprocs
+#% type: integer
+#% description: Number of processes used for the computations
+#% options: 1-
+#% answer: 1
+#%end
+
 # import libraries
 import os
 import sys
 import atexit
 import numpy as np
 import grass.script as gs
-import grass.script.array as garray
 import tempfile
 import uuid
-import string
+from collections import deque
+from multiprocessing import Pool
+from grass.pygrass.gis.region import Region
 from grass.pygrass.modules import Module
+from grass.pygrass.raster import RasterRow
+from grass.pygrass.raster.buffer import Buffer
 from subprocess import PIPE
 
 # for Python 3 compatibility
@@ -119,6 +130,10 @@ COLORS_EXDET = """\
 100% 219:65:0
 """
 
+# Number of cells of a block of rows of all the layers processed at once
+BLOCK_SIZE = 2 ** 20
+CNULL = -2147483648  # null value for CELL maps
+
 # Functions
 CLEAN_LAY = []
 
@@ -148,26 +163,210 @@ def tmpname(prefix):
     return tmpf
 
 
-def CoVar(maps):
-    """Compute the covariance matrix over reference layers"""
-    tmpcov = tempfile.mkstemp()[1]
-    with open(tmpcov, "w") as text_file:
-        text_file.write(gs.read_command("r.covar", quiet=True, map=maps))
-    covar = np.loadtxt(tmpcov, skiprows=1)
-    os.remove(tmpcov)
-    VI = np.linalg.inv(covar)
-    return VI
+def raster_window():
+    """Set the raster window of this process to the current region
+
+    The region is changed by g.region while the module runs, so it is
+    read again from g.region.
+    """
+    current = gs.region()
+    region = Region()
+    region.north = current["n"]
+    region.south = current["s"]
+    region.east = current["e"]
+    region.west = current["w"]
+    region.nsres = current["nsres"]
+    region.ewres = current["ewres"]
+    region.adjust()
+    region.set_raster_region()
+    return region
+
+
+def get_row_or_nan(raster, row_num):
+    """Get a row of a raster map as floats, with null cells as NaN"""
+    row = raster.get_row(row_num)
+    if raster.mtype != "CELL":
+        return row.astype(np.float64)
+    nans = row == CNULL
+    row = row.astype(np.float64)
+    row[nans] = np.nan
+    return row
+
+
+def stack_blocks(maps, region):
+    """Iterate over a stack of raster maps in blocks of rows
+
+    Yield the index of the first row of each block and the block as an
+    array of shape (layers, rows, cols), with null cells as NaN.
+    """
+    block_rows = max(1, BLOCK_SIZE // (len(maps) * region.cols))
+    rasters = [RasterRow(name) for name in maps]
+    for raster in rasters:
+        raster.open("r")
+    try:
+        for start in range(0, region.rows, block_rows):
+            rows = range(start, min(start + block_rows, region.rows))
+            yield start, np.array(
+                [[get_row_or_nan(r, i) for i in rows] for r in rasters]
+            )
+    finally:
+        for raster in rasters:
+            raster.close()
+
+
+def map_blocks(function, blocks, args=(), nprocs=1):
+    """Apply function(block, *args) to the blocks and yield the results
+
+    With nprocs > 1, the blocks are processed by worker processes, but
+    the results are still yielded in the order of the blocks, keeping at
+    most two blocks per process in memory.
+    """
+    if nprocs <= 1:
+        for start, block in blocks:
+            yield function(block, *args)
+        return
+    pool = Pool(nprocs)
+    try:
+        pending = deque()
+        for start, block in blocks:
+            pending.append(pool.apply_async(function, (block,) + tuple(args)))
+            if len(pending) >= 2 * nprocs:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+    finally:
+        pool.terminate()
+
+
+def put_rows(raster, rows):
+    """Write the rows of a 2D array to a raster map, NaN as null"""
+    if raster.mtype == "CELL":
+        nulls = np.isnan(rows)
+        rows = np.where(nulls, 0, rows).astype(np.int32)
+        rows[nulls] = CNULL
+    else:
+        rows = rows.astype(np.float32 if raster.mtype == "FCELL" else np.float64)
+    for row in rows:
+        raster.put_row(Buffer(row.shape, raster.mtype, row))
+
+
+def nanargmin(values):
+    """Index of the minimum over the first axis, ignoring NaN
+
+    Like r.series method=min_raster, NaN where all values are NaN.
+    """
+    nulls = np.isnan(values).all(axis=0)
+    index = np.argmin(np.where(np.isnan(values), np.inf, values), axis=0)
+    return np.where(nulls, np.nan, index)
+
+
+def reference_stats(block):
+    """Compute the statistics of a block of reference layers
+
+    Return the minimum, maximum, sum and count of the non-null values of
+    each layer, and the number of cells, mean and sum of the cross
+    products of the deviations of the cells where all layers have values.
+    """
+    with np.errstate(invalid="ignore"):
+        stat_min = np.nanmin(block, axis=(1, 2))
+        stat_max = np.nanmax(block, axis=(1, 2))
+    stat_sum = np.nansum(block, axis=(1, 2))
+    stat_count = np.sum(~np.isnan(block), axis=(1, 2))
+    cells = block.reshape(block.shape[0], -1)
+    cells = cells[:, ~np.isnan(cells).any(axis=0)]
+    n = cells.shape[1]
+    mean = cells.mean(axis=1) if n else np.zeros(block.shape[0])
+    delta = cells - mean[:, None]
+    return stat_min, stat_max, stat_sum, stat_count, n, mean, delta.dot(delta.T)
+
+
+def CoVar(maps, nprocs=1):
+    """Compute the statistics and covariance matrix of the reference layers
+
+    The maps are read once, by blocks of rows. The covariance matrix is
+    computed over the cells where all layers have values, like r.covar.
+    """
+    s = len(maps)
+    stat_min = np.full(s, np.inf)
+    stat_max = np.full(s, -np.inf)
+    stat_sum = np.zeros(s)
+    stat_count = np.zeros(s)
+    n = 0
+    mean = np.zeros(s)
+    cross = np.zeros((s, s))
+    region = raster_window()
+    blocks = stack_blocks(maps, region)
+    for bmin, bmax, bsum, bcount, bn, bmean, bcross in map_blocks(
+        reference_stats, blocks, nprocs=nprocs
+    ):
+        stat_min = np.fmin(stat_min, bmin)
+        stat_max = np.fmax(stat_max, bmax)
+        stat_sum += bsum
+        stat_count += bcount
+        if bn:
+            # pairwise update of the mean and cross products
+            delta = bmean - mean
+            cross += bcross + np.outer(delta, delta) * n * bn / (n + bn)
+            mean += delta * bn / (n + bn)
+            n += bn
+    if n < 2:
+        gs.fatal(_("Not enough cells with values in all reference layers"))
+    stat_mean = stat_sum / stat_count
+    covar = cross / (n - 1)
+    return stat_min, stat_mean, stat_max, covar
 
 
 def mahal(v, m, VI):
-    """Compute the Mahalanobis distance over reference layers"""
+    """Compute the Mahalanobis distance of a block of layers"""
     delta = v - m[:, None, None]
-    mahdist = np.sum(
-        np.sum(delta[None, :, :, :] * VI[:, :, None, None], axis=1) * delta, axis=0
-    )
-    stat_mahal = garray.array()
-    stat_mahal[...] = mahdist
-    return stat_mahal
+    return np.einsum("irc,ij,jrc->rc", delta, VI, delta)
+
+
+def projection_block(block, stat_min, stat_max, stat_mean, VI, VI_drop, mahal_ref_max):
+    """Compute the novelty metrics of a block of projected layers
+
+    Returns a dict with the NT1 (sum of the univariate distances outside
+    of the reference range), the index of the layer with the smallest
+    univariate distance, the Mahalanobis distance, NT2 and, if VI_drop is
+    given, the index of the layer whose removal gives the smallest
+    Mahalanobis distance (most influential covariate).
+    """
+    with np.errstate(invalid="ignore", divide="ignore"):
+        rng = (stat_max - stat_min)[:, None, None]
+        dij = np.fmin(
+            np.fmin(block - stat_min[:, None, None], stat_max[:, None, None] - block),
+            0,
+        )
+        dij[np.isnan(block)] = np.nan
+        dij /= rng
+        dij[np.isinf(dij)] = np.nan
+        # small negative values are rounding errors
+        dij[dij > -0.00000000001] = 0
+        nulls = np.isnan(dij).all(axis=0)
+        nt1 = np.where(nulls, np.nan, np.nansum(dij, axis=0))
+        mahal_pro = mahal(block, stat_mean, VI)
+        result = {
+            "nt1": nt1,
+            "mic1": nanargmin(dij),
+            "mahal": mahal_pro,
+            "nt2": mahal_pro / mahal_ref_max,
+        }
+        if VI_drop is not None:
+            # in Mesgaran et al, the MIC2 is the max icp, but that is the
+            # same as the minimum Mahalanobis distance (ymap)
+            # icp = (mahal_pro - ymap) / mahal_pro * 100
+            ymaps = np.array(
+                [
+                    mahal(
+                        np.delete(block, i, axis=0),
+                        np.delete(stat_mean, i, axis=0),
+                        VI_drop[i],
+                    )
+                    for i in range(block.shape[0])
+                ]
+            )
+            result["mic2"] = nanargmin(ymaps)
+    return result
 
 
 def main(options, flags):
@@ -191,10 +390,7 @@ def main(options, flags):
     flag_d = flags["d"]
     flag_e = flags["e"]
     flag_p = flags["p"]
-
-    # get current region settings, to compare to new ones later
-    regbu1 = tmpname("region")
-    gs.parse_command("g.region", save=regbu1)
+    nprocs = int(options["nprocs"])
 
     # Check if region, projected layers or mask is given
     if region:
@@ -226,36 +422,31 @@ def main(options, flags):
     with open(tmphist, "w") as text_file:
         text_file.write(hist)
 
-    # Create covariance table
-    VI = CoVar(maps=REF)
-
-    # Import reference data & compute univar stats per reference layer
-    s = len(REF)
-    dat_ref = stat_mean = stat_min = stat_max = None
-
-    for i, map in enumerate(REF):
-        layer = garray.array(map, null=np.nan)
-        r, c = layer.shape
-        if dat_ref is None:
-            dat_ref = np.empty((s, r, c), dtype=np.double)
-        if stat_mean is None:
-            stat_mean = np.empty((s), dtype=np.double)
-        if stat_min is None:
-            stat_min = np.empty((s), dtype=np.double)
-        if stat_max is None:
-            stat_max = np.empty((s), dtype=np.double)
-        stat_min[i] = np.nanmin(layer)
-        stat_mean[i] = np.nanmean(layer)
-        stat_max[i] = np.nanmax(layer)
-        dat_ref[i, :, :] = layer
-        del layer
+    # Compute univar stats per reference layer and the covariance table
+    stat_min, stat_mean, stat_max, covar = CoVar(maps=REF, nprocs=nprocs)
+    VI = np.linalg.inv(covar)
 
     # Compute Mahalanobis over full set of reference layers
-    mahal_ref = mahal(v=dat_ref, m=stat_mean, VI=VI)
-    mahal_ref_max = max(mahal_ref[np.isfinite(mahal_ref)])
+    region_ref = raster_window()
+    mahal_ref_max = -np.inf
+    mahalref = "{}_mahalref".format(out)
+    mahal_out = None
+    if flag_e:
+        mahal_out = RasterRow(mahalref)
+        mahal_out.open("w", "DCELL", overwrite=gs.overwrite())
+    try:
+        blocks = stack_blocks(REF, region_ref)
+        for mahal_ref in map_blocks(mahal, blocks, (stat_mean, VI), nprocs):
+            if np.isfinite(mahal_ref).any():
+                mahal_ref_max = max(
+                    mahal_ref_max, mahal_ref[np.isfinite(mahal_ref)].max()
+                )
+            if mahal_out is not None:
+                put_rows(mahal_out, mahal_ref)
+    finally:
+        if mahal_out is not None:
+            mahal_out.close()
     if flag_e:
-        mahalref = "{}_mahalref".format(out)
-        mahal_ref.write(mapname=mahalref)
         gs.info(_("Mahalanobis distance map saved: {}").format(mahalref))
         gs.run_command(
             "r.support",
@@ -265,7 +456,6 @@ def main(options, flags):
             description="Mahalanobis distance map in reference " "domain",
             loadhistory=tmphist,
         )
-    del mahal_ref
 
     # Remove mask and set new region based on user-defined region or
     # otherwise based on projection layers
@@ -279,22 +469,59 @@ def main(options, flags):
         # TODO: only set region to PRO[0] when different from current region
         gs.info(_("The region has set to match the proj raster layers"))
 
-    # Import projected layers in numpy array
-    s = len(PRO)
-    dat_pro = None
-    for i, map in enumerate(PRO):
-        layer = garray.array(map, null=np.nan)
-        r, c = layer.shape
-        if dat_pro is None:
-            dat_pro = np.empty((s, r, c), dtype=np.double)
-        dat_pro[i, :, :] = layer
-        del layer
-
-    # Compute mahalanobis distance
-    mahal_pro = mahal(v=dat_pro, m=stat_mean, VI=VI)
+    # Inverse covariance matrices without each of the layers, for the
+    # most influential covariate of NT2
+    VI_drop = None
+    if flag_p:
+        VI_drop = [
+            np.linalg.inv(np.delete(np.delete(covar, i, axis=0), i, axis=1))
+            for i in range(len(REF))
+        ]
+
+    # Compute NT1, NT2, the Mahalanobis distance and the most influential
+    # covariates (MIC) in one pass over the projected layers, and
+    # nt1, nt2, and nt1and2 novelty maps
+    nt1 = "{}_NT1".format(out)
+    nt2 = "{}_NT2".format(out)
+    nt12 = "{}_NT1NT2".format(out)
+    mahalpro = "{}_mahalpro".format(out)
+    mic12 = "{}_MICNT1and2".format(out)
+    outputs = {nt1: "DCELL", nt2: "DCELL", nt12: "DCELL"}
+    if flag_d:
+        outputs[mahalpro] = "DCELL"
+    if flag_p:
+        outputs[mic12] = "CELL"
+    region_pro = raster_window()
+    rasters = {}
+    try:
+        for name, mtype in outputs.items():
+            rasters[name] = RasterRow(name)
+            rasters[name].open("w", mtype, overwrite=gs.overwrite())
+        args = (stat_min, stat_max, stat_mean, VI, VI_drop, mahal_ref_max)
+        blocks = stack_blocks(PRO, region_pro)
+        for result in map_blocks(projection_block, blocks, args, nprocs):
+            tmplay = result["nt1"]
+            tmpla2 = result["nt2"]
+            nulls = np.isnan(tmplay)
+            with np.errstate(invalid="ignore"):
+                novel = tmplay < 0
+                similar = tmplay >= 0
+                put_rows(rasters[nt12], np.where(nulls | novel, tmplay, tmpla2))
+                put_rows(rasters[nt2], np.where(similar, tmpla2, np.nan))
+                put_rows(rasters[nt1], np.where(novel, tmplay, np.nan))
+                if flag_d:
+                    put_rows(rasters[mahalpro], result["mahal"])
+                if flag_p:
+                    mic = np.where(tmpla2 > 1, result["mic2"], -1)
+                    mic[np.isnan(tmpla2)] = np.nan
+                    mic = np.where(novel, result["mic1"], mic)
+                    mic[nulls] = np.nan
+                    put_rows(rasters[mic12], mic)
+    finally:
+        for raster in rasters.values():
+            raster.close()
+
     if flag_d:
-        mahalpro = "{}_mahalpro".format(out)
-        mahal_pro.write(mapname=mahalpro)
         gs.info(_("Mahalanobis distance map saved: {}").format(mahalpro))
         gs.run_command(
             "r.support",
@@ -306,87 +533,6 @@ def main(options, flags):
             "domain estimated using covariance of reference data",
         )
 
-    # Compute NT1
-    tmplay = tmpname(out)
-    mnames = [None] * len(REF)
-    for i in range(len(REF)):
-        tmpout = tmpname("exdet")
-        # TODO: computations below sometimes result in very small negative
-        # numbers, which are not 'real', but rather due to some differences
-        # in handling digits in grass and Python, hence second mapcalc
-        # statement. Need to figure out how to handle this better.
-        gs.mapcalc(
-            "eval("
-            "tmp = min(($prolay - $refmin), ($refmax - $prolay),0) / "
-            "($refmax - $refmin))\n"
-            "$Dij = if(tmp > -0.00000000001, 0, tmp)",
-            Dij=tmpout,
-            prolay=PRO[i],
-            refmin=stat_min[i],
-            refmax=stat_max[i],
-            quiet=True,
-        )
-        mnames[i] = tmpout
-    gs.run_command("r.series", quiet=True, input=mnames, output=tmplay, method="sum")
-
-    # Compute most influential covariate (MIC) metric for NT1
-    if flag_p:
-        tmpla1 = tmpname(out)
-        gs.run_command(
-            "r.series", quiet=True, output=tmpla1, input=mnames, method="min_raster"
-        )
-
-    # Compute NT2
-    tmpla2 = tmpname(out)
-    nt2map = garray.array()
-    nt2map[...] = mahal_pro / mahal_ref_max
-    nt2map.write(mapname=tmpla2)
-
-    # Compute  most influential covariate (MIC) metric for NT2
-    if flag_p:
-        tmpla3 = tmpname(out)
-        laylist = []
-        layer = garray.array()
-        for i, map in enumerate(opn):
-            gs.use_temp_region()
-            gs.run_command("g.region", quiet=True, region=regbu1)
-            REFtmp = [x for num, x in enumerate(REF) if not num == i]
-            stattmp = np.delete(stat_mean, i, axis=0)
-            VItmp = CoVar(maps=REFtmp)
-            gs.del_temp_region()
-            dat_protmp = np.delete(dat_pro, i, axis=0)
-            ymap = mahal(v=dat_protmp, m=stattmp, VI=VItmp)
-            # in Mesgaran et al, the MIC2 is the max icp, but that is the
-            # same as the minimum Mahalanobis distance (ymap)
-            # icp = (mahal_pro - ymap) / mahal_pro * 100
-            layer[:, :] = ymap
-            tmpmahal = tmpname(out)
-            layer.write(tmpmahal)
-            laylist.append(tmpmahal)
-        gs.run_command(
-            "r.series",
-            quiet=True,
-            output=tmpla3,
-            input=laylist,
-            method="min_raster",
-            overwrite=True,
-        )
-
-    # Compute nt1, nt2, and nt1and2 novelty maps
-    nt1 = "{}_NT1".format(out)
-    nt2 = "{}_NT2".format(out)
-    nt12 = "{}_NT1NT2".format(out)
-    expr = ";".join(
-        [
-            "$nt12 = if($tmplay < 0, $tmplay, $tmpla2)",
-            "$nt2 = if($tmplay >= 0, $tmpla2, null())",
-            "$nt1 = if($tmplay < 0, $tmplay, null())",
-        ]
-    )
-    gs.mapcalc(
-        expr, nt12=nt12, nt1=nt1, nt2=nt2, tmplay=tmplay, tmpla2=tmpla2, quiet=True
-    )
-
     # Write metadata nt1, nt2, nt1and2  maps
     gs.run_command(
         "r.support",
@@ -413,20 +559,8 @@ def main(options, flags):
         loadhistory=tmphist,
     )
 
-    # Compute MIC maps
+    # Write MIC maps metadata
     if flag_p:
-        mic12 = "{}_MICNT1and2".format(out)
-        expr = "$mic12 = if($tmplay < 0, $tmpla1, " "if($tmpla2>1, $tmpla3, -1))"
-        gs.mapcalc(
-            expr,
-            tmplay=tmplay,
-            tmpla1=tmpla1,
-            tmpla2=tmpla2,
-            tmpla3=tmpla3,
-            mic12=mic12,
-            quiet=True,
-        )
-
         # Write category labels to MIC maps
         tmpcat = tempfile.mkstemp()
         with open(tmpcat[1], "w") as text_file:
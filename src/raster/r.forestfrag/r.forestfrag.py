@@ -100,7 +100,13 @@ import sys
 import uuid
 import atexit
 import tempfile
+from itertools import islice
+
+import numpy as np
 import grass.script as gs
+from grass.pygrass.gis.region import Region
+from grass.pygrass.raster import RasterRow
+from grass.pygrass.raster.buffer import Buffer
 
 # Neutral naming for better compatibility between 2D and 3D version
 from grass.script.raster import mapcalc
@@ -126,6 +132,10 @@ COLORS_SAMBALE = """\
 6 145:207:96
 """
 
+# Number of cells in a block of rows of the moving window
+FOCAL_BLOCK_SIZE = 2 ** 20
+CNULL = -2147483648  # null value for CELL maps
+
 # Create set to store names of temporary maps to be deleted upon exit
 CLEAN_RAST = []
 
@@ -156,29 +166,153 @@ def tmpname(prefix):
     return tmpf
 
 
-def pairs_expression(map_name, max_index, combine_op, aggregate_op="+"):
-    """Generate window (matrix) expression
+def raster_window():
+    """Set the raster window of this process to the current region
+
+    Modules run since this process started (such as g.region with the -r
+    flag) may have changed the computational region, so it is read again.
+
+    :return: the current computational region
+    """
+    current = gs.region()
+    region = Region()
+    region.north = current["n"]
+    region.south = current["s"]
+    region.east = current["e"]
+    region.west = current["w"]
+    region.nsres = current["nsres"]
+    region.ewres = current["ewres"]
+    region.adjust()
+    region.set_raster_region()
+    return region
+
+
+def get_row_or_nan(raster, row_num):
+    """Get a row of a raster map as floats, with null cells as NaN"""
+    row = raster.get_row(row_num)
+    if raster.mtype != "CELL":
+        return row.astype(np.float64)
+    nans = row == CNULL
+    row = row.astype(np.float64)
+    row[nans] = np.nan
+    return row
+
+
+def focal_blocks(name, radius, region):
+    """Iterate over a raster map in blocks of rows surrounded by a halo
+
+    Each block holds a number of rows of the map and a halo of radius
+    rows and columns on each side, so that a moving window of this radius
+    can be applied to all the cells of the block. Cells outside of the
+    region and null cells are NaN. Successive blocks overlap by their
+    halo rows, but every row of the map is read only once.
+
+    :param name: name of the raster map
+    :param radius: radius of the moving window in cells
+    :param region: the computational region as returned by raster_window()
+    :return: generator of the index of the first row of each block in
+             the map and of the block as an array of shape
+             (rows + 2 * radius, region.cols + 2 * radius)
+    """
+    # At least four times as many rows as the halo, so that the halo rows
+    # computed with each block stay a small part of it
+    block_rows = max(8 * radius, 1, FOCAL_BLOCK_SIZE // (region.cols + 2 * radius))
+    pad = np.full(region.cols + 2 * radius, np.nan)
+
+    def padded_rows(src):
+        for i in range(radius):
+            yield pad
+        for row_num in range(region.rows):
+            row = pad.copy()
+            row[radius : radius + region.cols] = get_row_or_nan(src, row_num)
+            yield row
+        for i in range(radius):
+            yield pad
+
+    with RasterRow(name) as src:
+        rows = padded_rows(src)
+        halo = list(islice(rows, 2 * radius))
+        for start in range(0, region.rows, block_rows):
+            halo.extend(islice(rows, block_rows))
+            yield start, np.array(halo)
+            del halo[: len(halo) - 2 * radius]
+
+
+def box_sum(values, height, width):
+    """Sum values over all windows of height x width cells
+
+    Uses a summed-area table, so the cost does not depend on the size
+    of the window.
+
+    :param values: 2D array of numbers or booleans (no NaN)
+    :param height: number of rows of the window
+    :param width: number of columns of the window
+    :return: 2D array of shape (rows - height + 1, cols - width + 1) with
+             the sum of the window whose upper left cell is at each position
+    """
+    sat = np.zeros(
+        (values.shape[0] + 1, values.shape[1] + 1),
+        dtype=np.result_type(values.dtype, np.int64),
+    )
+    np.cumsum(values, axis=0, out=sat[1:, 1:])
+    np.cumsum(sat[1:, 1:], axis=1, out=sat[1:, 1:])
+    return (
+        sat[height:, width:]
+        - sat[:-height, width:]
+        - sat[height:, :-width]
+        + sat[:-height, :-width]
+    )
+
+
+def put_rows(raster, rows):
+    """Write the rows of a 2D array to a FCELL or DCELL raster map"""
+    dtype = np.float32 if raster.mtype == "FCELL" else np.float64
+    for row in rows.astype(dtype):
+        raster.put_row(Buffer(row.shape, raster.mtype, row))
 
-    :param map_name: name of the map to index
-    :param max_index: the maximum positive index to use;
+
+def proportions(block, max_index, start, region):
+    """Compute Pf and Pff for the cells of a block
+
+    Pf is the proportion of non-null cells in the window which are forest.
+    Pff is the number of forest-forest pairs of adjacent cells (cardinal
+    directions only) divided by the number of pairs with at least one
+    forest cell, null cells being considered as non-forest. It is null
+    where the window does not fit into the region.
+
+    :param block: block of the forest map with a halo of max_index cells
+    :param max_index: the maximum positive index of the window;
                       usually (window_size - 1) / 2
-    :param combine_op: operator used to combine values in the pair
-    :param aggregate_op: operator used to combine all pairs together
+    :param start: index of the first row of the block in the map
+    :param region: the computational region
+    :return: tuple of 2D arrays of Pf and Pff
     """
     s = max_index  # just to be brief
-    base_expr = "({m}[{a},{b}] {o} {m}[{c},{d}])"
-    expr = []
-    for j in range(-s, s + 1):
-        for i in range(-s, s):
-            expr.append(
-                base_expr.format(m=map_name, o=combine_op, a=i, b=j, c=i + 1, d=j)
-            )
-    for i in range(-s, s + 1):
-        for j in range(-s, s):
-            expr.append(
-                base_expr.format(m=map_name, o=combine_op, a=i, b=j, c=i, d=j + 1)
-            )
-    return aggregate_op.join(expr)
+    size = 2 * s + 1
+    valid = ~np.isnan(block)
+    forest = np.nan_to_num(block).astype(bool)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        pf = box_sum(forest, size, size) / box_sum(valid, size, size)
+
+        # pairs in the columns and in the rows of the window
+        and_pairs = box_sum(forest[:-1] & forest[1:], 2 * s, size) + box_sum(
+            forest[:, :-1] & forest[:, 1:], size, 2 * s
+        )
+        or_pairs = box_sum(forest[:-1] | forest[1:], 2 * s, size) + box_sum(
+            forest[:, :-1] | forest[:, 1:], size, 2 * s
+        )
+        pff = np.where(or_pairs > 0, and_pairs / or_pairs, np.nan)
+
+    rows = np.arange(start, start + pf.shape[0])
+    cols = np.arange(region.cols)
+    pff[(rows < s) | (rows >= region.rows - s)] = np.nan
+    pff[:, (cols < s) | (cols >= region.cols - s)] = np.nan
+
+    nulls = ~valid[s:-s, s:-s]
+    pf[nulls] = np.nan
+    pff[nulls] = np.nan
+    return pf, pff
 
 
 def main(options, flags):
@@ -248,66 +382,34 @@ def main(options, flags):
     # Let forested pixels be x and number of all pixels in moving window
     # be y, then pf=x/y"
 
-    gs.info(_("Step 1: Computing Pf values..."))
-
-    # Generate grid with pixel-value=number of forest-pixels in window
-    # Generate grid with pixel-value=number of pixels in moving window:
-    tmpA2 = tmpname("tmpA01_")
-    tmpC3 = tmpname("tmpA02_")
-    gs.run_command(
-        "r.neighbors",
-        quiet=True,
-        input=ipl,
-        output=[tmpA2, tmpC3],
-        method=["sum", "count"],
-        size=wz,
-    )
-
-    # Create pf map
-    if user_pf:
-        pf = user_pf
-    else:
-        pf = tmpname("tmpA03_")
-    mapcalc(
-        "$pf = if( $ipl >=0, float($tmpA2) / float($tmpC3))",
-        ipl=ipl,
-        pf=pf,
-        tmpA2=tmpA2,
-        tmpC3=tmpC3,
-    )
-
     # Computing pff values
     # Considering pairs of pixels in cardinal directions in
     # a 3x3 window, the total number of adjacent pixel pairs is 12.
     # Assuming that x pairs include at least one forested pixel, and
     # y of those pairs are forest-forest pairs, so pff equals y/x.
 
-    gs.info(_("Step 2: Computing Pff values..."))
-
-    # Create copy of forest map and convert NULL to 0 (if any)
-    tmpC4 = tmpname("tmpA04_")
-    gs.run_command("g.copy", raster=[ipl, tmpC4], quiet=True)
-    gs.run_command("r.null", map=tmpC4, null=0, quiet=True)
+    gs.info(_("Step 1: Computing Pf and Pff values..."))
 
     # Window dimensions
     max_index = int((wz - 1) / 2)
-    # Number of 'forest-forest' pairs
-    expr1 = pairs_expression(map_name=tmpC4, max_index=max_index, combine_op="&")
-    # Number of 'nonforest-forest' pairs
-    expr2 = pairs_expression(map_name=tmpC4, max_index=max_index, combine_op="|")
-    # Create pff map
+    if user_pf:
+        pf = user_pf
+    else:
+        pf = tmpname("tmpA03_")
     if user_pff:
         pff = user_pff
     else:
         pff = tmpname("tmpA07_")
-    # Potentially this can be split and parallelized
-    mapcalc(
-        "$pff = if($ipl >= 0, float($tmpl4) / float($tmpl5))",
-        ipl=ipl,
-        tmpl4=expr1,
-        tmpl5=expr2,
-        pff=pff,
-    )
+
+    # Both are computed with the same moving window over blocks of rows
+    region = raster_window()
+    overwrite = gs.overwrite()
+    with RasterRow(pf, mode="w", mtype="FCELL", overwrite=overwrite) as pf_out:
+        with RasterRow(pff, mode="w", mtype="FCELL", overwrite=overwrite) as pff_out:
+            for start, block in focal_blocks(ipl, max_index, region):
+                pf_block, pff_block = proportions(block, max_index, start, region)
+                put_rows(pf_out, pf_block)
+                put_rows(pff_out, pff_block)
 
     # Computing fragmentation index
     # (a b) name, condition
@@ -321,7 +423,7 @@ def main(options, flags):
     # (5 1) patch, if Pf < 0.4
     # (6 2) transitional, if 0.4 < Pf < 0.6
 
-    gs.info(_("Step 3: Computing fragmentation index..."))
+    gs.info(_("Step 2: Computing fragmentation index..."))
 
     if clip_output:
         indexfin2 = tmpname("tmpA16_")
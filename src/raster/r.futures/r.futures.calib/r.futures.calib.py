@@ -91,6 +91,23 @@
 #% guisection: Calibration
 #%end
 #%option
+#% key: checkpoint
+#% type: string
+#% key_desc: name
+#% label: File recording finished simulation runs
+#% description: Runs already recorded in an existing file are skipped, so that an interrupted calibration can be resumed
+#% required: no
+#% guisection: Calibration
+#%end
+#%option
+#% key: prune_factor
+#% type: double
+#% label: Skip remaining runs of parameter combinations worse than the best one by this factor
+#% description: A combination is skipped when both its mean area and compactness errors exceed the lowest mean errors times this factor
+#% required: no
+#% guisection: Calibration
+#%end
+#%option
 #% key: nprocs
 #% type: integer
 #% description: Number of parallel processes
@@ -261,6 +278,8 @@
 #% exclusive: -l,compactness_mean
 #% exclusive: -l,repeat
 #% exclusive: -l,memory
+#% exclusive: -l,checkpoint
+#% exclusive: -l,prune_factor
 #% required: -l,demand
 #% required: -l,scaling_factor
 #% required: -l,gamma
@@ -281,9 +300,12 @@
 import sys
 import os
 import atexit
+import json
 import numpy as np
 from io import StringIO
-from multiprocessing import Process, Queue
+from collections import deque
+from multiprocessing import Pool
+from queue import Queue
 
 import grass.script.core as gcore
 import grass.script.raster as grast
@@ -292,6 +314,21 @@ from grass.exceptions import CalledModuleError
 
 
 TMP = []
+# options which do not change the result of a simulation run,
+# runs are matched with checkpoint records by parameter values and repeat index,
+# so the parameter grid and number of repeats can change between runs
+CHECKPOINT_IGNORED = [
+    "calibration_results",
+    "checkpoint",
+    "compactness_mean",
+    "compactness_range",
+    "discount_factor",
+    "nprocs",
+    "patch_sizes",
+    "prune_factor",
+    "repeat",
+    "separator",
+]
 
 
 def cleanup(tmp=None):
@@ -314,9 +351,11 @@ def check_addon_installed(addon, fatal=True):
         )
 
 
-def run_one_combination(
+def run_one_repeat(
+    comb_index,
     comb_count,
     comb_all,
+    repeat_index,
     repeat,
     seed,
     development_start,
@@ -334,12 +373,15 @@ def run_one_combination(
     histogram_area_orig,
     histogram_compactness_orig,
     tmp_name,
-    queue,
 ):
     TMP_PROCESS = []
     # unique name, must be sql compliant
     suffix = (
-        str(discount_factor) + str(compactness_mean) + str(compactness_range)
+        str(discount_factor)
+        + str(compactness_mean)
+        + str(compactness_range)
+        + "_"
+        + str(repeat_index)
     ).replace(".", "")
     simulation_dev_end = tmp_name + "simulation_dev_end_" + suffix
     simulation_dev_diff = tmp_name + "simulation_dev_diff" + suffix
@@ -348,68 +390,176 @@ def run_one_combination(
     TMP_PROCESS.append(simulation_dev_end)
     TMP_PROCESS.append(tmp_clump)
 
-    sum_dist_area = 0
-    sum_dist_compactness = 0
     # offset seed
-    seed *= 10000
-    for i in range(repeat):
-        f_seed = seed + i
-        gcore.message(
-            _(
-                "Running calibration combination {comb_count}/{comb_all}"
-                " of simulation attempt {i}/{repeat} with random seed {s}...".format(
-                    comb_count=comb_count,
-                    comb_all=comb_all,
-                    i=i + 1,
-                    repeat=repeat,
-                    s=f_seed,
-                )
+    f_seed = seed * 10000 + repeat_index
+    gcore.message(
+        _(
+            "Running calibration combination {comb_count}/{comb_all}"
+            " of simulation attempt {i}/{repeat} with random seed {s}...".format(
+                comb_count=comb_count,
+                comb_all=comb_all,
+                i=repeat_index + 1,
+                repeat=repeat,
+                s=f_seed,
             )
         )
-        try:
-            run_simulation(
-                development_start=development_start,
-                development_end=simulation_dev_end,
-                compactness_mean=compactness_mean,
-                compactness_range=compactness_range,
-                discount_factor=discount_factor,
-                patches_file=patches_file,
-                seed=f_seed,
-                fut_options=fut_options,
-            )
-        except CalledModuleError as e:
-            queue.put(None)
-            cleanup(tmp=TMP_PROCESS)
-            gcore.error(_("Running r.futures.pga failed. Details: {e}").format(e=e))
-            return
-        new_development(simulation_dev_end, simulation_dev_diff)
-
-        data = patch_analysis(simulation_dev_diff, threshold, tmp_clump)
-        sim_hist_area, sim_hist_compactness = create_histograms(
-            data,
-            hist_bins_area_orig,
-            hist_range_area_orig,
-            hist_bins_compactness_orig,
-            hist_range_compactness_orig,
-            cell_size,
-        )
-
-        sum_dist_area += compare_histograms(histogram_area_orig, sim_hist_area)
-        sum_dist_compactness += compare_histograms(
-            histogram_compactness_orig, sim_hist_compactness
+    )
+    try:
+        run_simulation(
+            development_start=development_start,
+            development_end=simulation_dev_end,
+            compactness_mean=compactness_mean,
+            compactness_range=compactness_range,
+            discount_factor=discount_factor,
+            patches_file=patches_file,
+            seed=f_seed,
+            fut_options=fut_options,
         )
-
-    mean_dist_area = sum_dist_area / repeat
-    mean_dist_compactness = sum_dist_compactness / repeat
+    except CalledModuleError as e:
+        cleanup(tmp=TMP_PROCESS)
+        gcore.error(_("Running r.futures.pga failed. Details: {e}").format(e=e))
+        return None
+    new_development(simulation_dev_end, simulation_dev_diff)
+
+    data = patch_analysis(simulation_dev_diff, threshold, tmp_clump)
+    sim_hist_area, sim_hist_compactness = create_histograms(
+        data,
+        hist_bins_area_orig,
+        hist_range_area_orig,
+        hist_bins_compactness_orig,
+        hist_range_compactness_orig,
+        cell_size,
+    )
 
     data = {}
-    data["input_discount_factor"] = discount_factor
-    data["input_compactness_mean"] = compactness_mean
-    data["input_compactness_range"] = compactness_range
-    data["area_distance"] = mean_dist_area
-    data["compactness_distance"] = mean_dist_compactness
-    queue.put(data)
+    data["combination"] = comb_index
+    data["repeat"] = repeat_index
+    data["area_distance"] = compare_histograms(histogram_area_orig, sim_hist_area)
+    data["compactness_distance"] = compare_histograms(
+        histogram_compactness_orig, sim_hist_compactness
+    )
     cleanup(tmp=TMP_PROCESS)
+    return data
+
+
+class CalibrationProgress(object):
+    """Keeps track of finished simulation runs of all parameter combinations.
+
+    Finished runs are recorded one per line in an optional checkpoint file,
+    which is read again to resume an interrupted calibration. The first line
+    of the file records the inputs of the calibration, a checkpoint written
+    for other inputs is refused.
+    """
+
+    header = ",".join(
+        [
+            "discount_factor",
+            "compactness_mean",
+            "compactness_range",
+            "repeat",
+            "area_distance",
+            "compactness_distance",
+        ]
+    )
+
+    def __init__(self, combinations, repeat, checkpoint=None, inputs=None):
+        self.combinations = combinations
+        self.repeat = repeat
+        self.area = np.full((len(combinations), repeat), np.nan)
+        self.compactness = np.full((len(combinations), repeat), np.nan)
+        self.file = None
+        if not checkpoint:
+            return
+        index = {comb: i for i, comb in enumerate(combinations)}
+        inputs_line = "# inputs: " + json.dumps(inputs, sort_keys=True)
+        if os.path.exists(checkpoint):
+            with open(checkpoint) as f:
+                if f.readline().rstrip("\n") != inputs_line:
+                    gcore.fatal(
+                        _(
+                            "Checkpoint file <{}> was written for other inputs,"
+                            " remove it or use another file"
+                        ).format(checkpoint)
+                    )
+                for line in f:
+                    if not line.strip() or line.startswith("discount_factor"):
+                        continue
+                    values = line.strip().split(",")
+                    comb = (float(values[0]), float(values[1]), float(values[2]))
+                    repeat_index = int(values[3])
+                    if comb in index and repeat_index < repeat:
+                        self.area[index[comb], repeat_index] = float(values[4])
+                        self.compactness[index[comb], repeat_index] = float(values[5])
+            self.file = open(checkpoint, "a")
+        else:
+            self.file = open(checkpoint, "w")
+            self.file.write(inputs_line + "\n")
+            self.file.write(self.header + "\n")
+            self.file.flush()
+
+    def close(self):
+        if self.file:
+            self.file.close()
+
+    def finished(self, comb_index, repeat_index):
+        return not np.isnan(self.area[comb_index, repeat_index])
+
+    def add(self, data):
+        """Record a finished run"""
+        comb_index = data["combination"]
+        repeat_index = data["repeat"]
+        self.area[comb_index, repeat_index] = data["area_distance"]
+        self.compactness[comb_index, repeat_index] = data["compactness_distance"]
+        if self.file:
+            discount_factor, compactness_mean, compactness_range = self.combinations[
+                comb_index
+            ]
+            self.file.write(
+                ",".join(
+                    [
+                        str(discount_factor),
+                        str(compactness_mean),
+                        str(compactness_range),
+                        str(repeat_index),
+                        str(data["area_distance"]),
+                        str(data["compactness_distance"]),
+                    ]
+                )
+            )
+            self.file.write("\n")
+            self.file.flush()
+            os.fsync(self.file.fileno())
+
+    def pruned(self, comb_index, factor):
+        """Test if mean errors of a combination are both worse than the
+        lowest mean errors of all combinations by given factor"""
+        if not factor:
+            return False
+        runs = ~np.isnan(self.area)
+        started = runs.any(axis=1)
+        if not started[comb_index]:
+            return False
+        with np.errstate(invalid="ignore"):
+            area = np.nanmean(self.area[started], axis=1)
+            compactness = np.nanmean(self.compactness[started], axis=1)
+        index = np.flatnonzero(started).tolist().index(comb_index)
+        return (
+            area[index] > factor * area.min()
+            and compactness[index] > factor * compactness.min()
+        )
+
+    def results(self):
+        """Mean errors of combinations with all runs finished"""
+        for comb_index, comb in enumerate(self.combinations):
+            if np.isnan(self.area[comb_index]).any():
+                continue
+            # sum in order of runs
+            area = 0
+            compactness = 0
+            for repeat_index in range(self.repeat):
+                area += self.area[comb_index, repeat_index]
+                compactness += self.compactness[comb_index, repeat_index]
+            yield comb, area / self.repeat, compactness / self.repeat
 
 
 def run_simulation(
@@ -751,69 +901,116 @@ def main():
 
     seed = int(options["random_seed"])
     nprocs = int(options["nprocs"])
-    count = 0
-    proc_count = 0
-    queue_list = []
-    proc_list = []
-    num_all = len(compactness_means) * len(compactness_ranges) * len(discount_factors)
+    prune_factor = float(options["prune_factor"]) if options["prune_factor"] else None
+    combinations = []
+    for com_mean in compactness_means:
+        for com_range in compactness_ranges:
+            for discount_factor in discount_factors:
+                combinations.append((discount_factor, com_mean, com_range))
+    num_all = len(combinations)
+    # development maps, seed, simulation options and region
+    # for which the checkpoint is valid
+    inputs = {
+        key: value for key, value in options.items() if key not in CHECKPOINT_IGNORED
+    }
+    inputs["flags"] = sorted(key for key, value in flags.items() if value)
+    inputs["region"] = [region[key] for key in ("n", "s", "e", "w", "nsres", "ewres")]
+    progress = CalibrationProgress(combinations, repeat, options["checkpoint"], inputs)
+
+    # first runs of all combinations are scheduled first,
+    # so that poor combinations can be recognized early
+    tasks = deque(
+        (comb_index, repeat_index)
+        for repeat_index in range(repeat)
+        for comb_index in range(num_all)
+        if not progress.finished(comb_index, repeat_index)
+    )
+    if len(tasks) < num_all * repeat:
+        gcore.message(
+            _("Resuming calibration, {n} of {a} runs already finished").format(
+                n=num_all * repeat - len(tasks), a=num_all * repeat
+            )
+        )
+
+    # keep all processes busy, new runs are started as soon as one finishes
+    finished = Queue()
+    running = 0
+    pruned = set()
+    pool = Pool(nprocs)
+    try:
+        while tasks or running:
+            while tasks and running < nprocs:
+                comb_index, repeat_index = tasks.popleft()
+                if comb_index in pruned:
+                    continue
+                if progress.pruned(comb_index, prune_factor):
+                    pruned.add(comb_index)
+                    continue
+                discount_factor, com_mean, com_range = combinations[comb_index]
+                pool.apply_async(
+                    run_one_repeat,
+                    args=(
+                        comb_index,
+                        comb_index + 1,
+                        num_all,
+                        repeat_index,
+                        repeat,
+                        seed + comb_index,
+                        dev_start,
+                        com_mean,
+                        com_range,
+                        discount_factor,
+                        patches_file,
+                        options,
+                        threshold,
+                        hist_bins_area_orig,
+                        hist_range_area_orig,
+                        hist_bins_compactness_orig,
+                        hist_range_compactness_orig,
+                        cell_size,
+                        histogram_area_orig,
+                        histogram_compactness_orig,
+                        tmp_name,
+                    ),
+                    callback=finished.put,
+                    error_callback=lambda error: finished.put(None),
+                )
+                running += 1
+            if not running:
+                break
+            data = finished.get()
+            running -= 1
+            if data:
+                progress.add(data)
+    except KeyboardInterrupt:
+        pool.terminate()
+        progress.close()
+        raise
+    pool.close()
+    pool.join()
+    progress.close()
+    if pruned:
+        gcore.message(
+            _("{n} of {a} parameter combinations skipped as poor").format(
+                n=len(pruned), a=num_all
+            )
+        )
+
     with open(options["calibration_results"], "w") as f:
-        for com_mean in compactness_means:
-            for com_range in compactness_ranges:
-                for discount_factor in discount_factors:
-                    count += 1
-                    q = Queue()
-                    p = Process(
-                        target=run_one_combination,
-                        args=(
-                            count,
-                            num_all,
-                            repeat,
-                            seed,
-                            dev_start,
-                            com_mean,
-                            com_range,
-                            discount_factor,
-                            patches_file,
-                            options,
-                            threshold,
-                            hist_bins_area_orig,
-                            hist_range_area_orig,
-                            hist_bins_compactness_orig,
-                            hist_range_compactness_orig,
-                            cell_size,
-                            histogram_area_orig,
-                            histogram_compactness_orig,
-                            tmp_name,
-                            q,
-                        ),
-                    )
-                    p.start()
-                    queue_list.append(q)
-                    proc_list.append(p)
-                    proc_count += 1
-                    seed += 1
-                    if proc_count == nprocs or count == num_all:
-                        for i in range(proc_count):
-                            proc_list[i].join()
-                            data = queue_list[i].get()
-                            if not data:
-                                continue
-                            f.write(
-                                ",".join(
-                                    [
-                                        str(data["input_discount_factor"]),
-                                        str(data["area_distance"]),
-                                        str(data["input_compactness_mean"]),
-                                        str(data["input_compactness_range"]),
-                                        str(data["compactness_distance"]),
-                                    ]
-                                )
-                            )
-                            f.write("\n")
-                        f.flush()
-                        proc_count = 0
-                        proc_list = []
-                        queue_list = []
+        for comb, area_distance, compactness_distance in progress.results():
+            discount_factor, com_mean, com_range = comb
+            f.write(
+                ",".join(
+                    [
+                        str(discount_factor),
+                        str(area_distance),
+                        str(com_mean),
+                        str(com_range),
+                        str(compactness_distance),
+                    ]
+                )
+            )
+            f.write("\n")
     # compute combined normalized error
     process_calibration(options["calibration_results"])
 
@@ -84,6 +84,8 @@ class TestPGACalib(TestCase):
             "data/out_library_subregion.csv",
             "data/out_calib.csv",
             "data/out_calib_subregion.csv",
+            "data/out_calib_resumed.csv",
+            "data/out_checkpoint.csv",
         ):
             try:
                 os.remove(each)
@@ -183,6 +185,59 @@ class TestPGACalib(TestCase):
             "Calibration results differ",
         )
 
+    def test_pga_calib_resume(self):
+        """Test if calibration resumed from checkpoint matches the reference"""
+        params = dict(
+            development_start="urban_1987",
+            development_end="urban_2002",
+            patch_threshold=0,
+            patch_sizes="data/out_library.txt",
+            compactness_mean=[0.1, 0.8],
+            compactness_range=[0.1],
+            discount_factor=[0.1],
+            checkpoint="data/out_checkpoint.csv",
+            nprocs=2,
+            repeat=2,
+            random_seed=1,
+        )
+        params.update(self.pga_params)
+        self.assertModule(
+            "r.futures.calib", calibration_results="data/out_calib.csv", **params
+        )
+        self.assertTrue(
+            filecmp.cmp("data/out_calib.csv", "data/ref_calib.csv", shallow=False),
+            "Calibration results differ",
+        )
+        with open("data/out_checkpoint.csv") as f:
+            self.assertEqual(len(f.read().strip().splitlines()), 6)
+        # all runs are finished, nothing is simulated again
+        self.assertModule(
+            "r.futures.calib",
+            calibration_results="data/out_calib_resumed.csv",
+            **params
+        )
+        self.assertTrue(
+            filecmp.cmp(
+                "data/out_calib_resumed.csv", "data/ref_calib.csv", shallow=False
+            ),
+            "Resumed calibration results differ",
+        )
+        # records are matched by parameter values, all runs are finished
+        params["compactness_mean"] = [0.8]
+        params["repeat"] = 1
+        self.assertModule(
+            "r.futures.calib",
+            calibration_results="data/out_calib_resumed.csv",
+            **params
+        )
+        # checkpoint written for other inputs is refused
+        params["random_seed"] = 2
+        self.assertModuleFail(
+            "r.futures.calib",
+            calibration_results="data/out_calib_resumed.csv",
+            **params
+        )
+
 
 if __name__ == "__main__":
     test()
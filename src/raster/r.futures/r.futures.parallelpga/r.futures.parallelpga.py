@@ -33,6 +33,12 @@
 #% description: r.futures.pga runs for each subregion and after all subregions are completed, the results are patched together
 #% guisection: Parallel
 #%end
+#%flag
+#% key: a
+#% label: Keep only aggregated results
+#% description: Results of individual runs are removed as soon as they are aggregated
+#% guisection: Aggregate
+#%end
 #%option
 #% key: nprocs
 #% type: integer
@@ -93,6 +99,39 @@
 #% guisection: Output
 #%end
 #%option
+#% key: output_probability
+#% type: string
+#% required: no
+#% multiple: no
+#% key_desc: name
+#% label: Probability of development across repeats
+#% description: Fraction of repeats in which a cell is developed at the end of simulation
+#% gisprompt: new,cell,raster
+#% guisection: Aggregate
+#%end
+#%option
+#% key: output_mean
+#% type: string
+#% required: no
+#% multiple: no
+#% key_desc: name
+#% label: Mean step of development across repeats
+#% description: Only repeats in which a cell is developed are considered, initial development has value 0
+#% gisprompt: new,cell,raster
+#% guisection: Aggregate
+#%end
+#%option
+#% key: output_variance
+#% type: string
+#% required: no
+#% multiple: no
+#% key_desc: name
+#% label: Variance of step of development across repeats
+#% description: Only repeats in which a cell is developed are considered
+#% gisprompt: new,cell,raster
+#% guisection: Aggregate
+#%end
+#%option
 #% key: output_series
 #% type: string
 #% required: no
@@ -280,13 +319,22 @@
 import os
 import sys
 import atexit
+import shutil
 from multiprocessing import Pool
 
+import numpy as np
+
 import grass.script as gscript
 from grass.exceptions import CalledModuleError
+from grass.pygrass.raster import RasterRow
+from grass.pygrass.raster.buffer import Buffer
+from grass.pygrass.gis.region import Region
 
 TMP_RASTERS = []
+TMP_DIRS = []
 PREFIX = "tmprfuturesparallelpga"
+CELL_NULL = -2147483648
+AGGREGATES = ("output_probability", "output_mean", "output_variance")
 
 
 def cleanup():
@@ -294,6 +342,108 @@ def cleanup():
         gscript.run_command(
             "g.remove", type="raster", name=TMP_RASTERS, flags="f", quiet=True
         )
+    for directory in TMP_DIRS:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+class Aggregate(object):
+    """Aggregates results of simulation runs as soon as they are available.
+
+    For every cell, the number of runs with data, the number of runs
+    in which the cell is developed and the sum and sum of squares of the step
+    of development are accumulated in arrays memory-mapped to files
+    in a temporary directory, so that memory consumption does not depend
+    on the number of runs.
+    """
+
+    def __init__(self, directory):
+        self.region = Region()
+        shape = (self.region.rows, self.region.cols)
+        self.runs = np.memmap(
+            os.path.join(directory, "runs"), dtype=np.int32, mode="w+", shape=shape
+        )
+        self.developed = np.memmap(
+            os.path.join(directory, "developed"), dtype=np.int32, mode="w+", shape=shape
+        )
+        self.step_sum = np.memmap(
+            os.path.join(directory, "step_sum"),
+            dtype=np.float64,
+            mode="w+",
+            shape=shape,
+        )
+        self.step_sum2 = np.memmap(
+            os.path.join(directory, "step_sum2"),
+            dtype=np.float64,
+            mode="w+",
+            shape=shape,
+        )
+
+    def add(self, name):
+        """Add result of a run (or of a subregion of a run)"""
+        raster = RasterRow(name)
+        raster.open("r")
+        buff = Buffer((self.region.cols,), mtype=raster.mtype)
+        try:
+            for row in range(self.region.rows):
+                raster.get_row(row, buff)
+                values = np.asarray(buff)
+                if raster.mtype == "CELL":
+                    valid = values != CELL_NULL
+                else:
+                    valid = ~np.isnan(values)
+                developed = valid & (values >= 0)
+                steps = np.where(developed, values, 0).astype(np.float64)
+                self.runs[row] += valid
+                self.developed[row] += developed
+                self.step_sum[row] += steps
+                self.step_sum2[row] += steps * steps
+        finally:
+            raster.close()
+
+    def write(self, probability=None, mean=None, variance=None):
+        """Write aggregated results to raster maps"""
+        outputs = [
+            (name, method)
+            for name, method in (
+                (probability, self.probability),
+                (mean, self.mean),
+                (variance, self.variance),
+            )
+            if name
+        ]
+        for name, method in outputs:
+            raster = RasterRow(name)
+            raster.open("w", mtype="FCELL", overwrite=gscript.overwrite())
+            buff = Buffer((self.region.cols,), mtype="FCELL")
+            try:
+                for row in range(self.region.rows):
+                    buff[:] = method(row)
+                    raster.put_row(buff)
+            finally:
+                raster.close()
+
+    def probability(self, row):
+        """Fraction of runs in which cells of a row are developed"""
+        runs = self.runs[row]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return np.where(runs > 0, self.developed[row] / runs, np.nan)
+
+    def mean(self, row):
+        """Mean step of development of cells of a row"""
+        developed = self.developed[row]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return np.where(developed > 0, self.step_sum[row] / developed, np.nan)
+
+    def variance(self, row):
+        """Variance of step of development of cells of a row"""
+        developed = self.developed[row]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            mean = self.step_sum[row] / developed
+            return np.where(
+                developed > 0,
+                np.maximum(self.step_sum2[row] / developed - mean * mean, 0),
+                np.nan,
+            )
 
 
 def futures_process(params):
@@ -317,6 +467,7 @@ def futures_process(params):
             gscript.run_command("r.futures.pga", **options)
     except (KeyboardInterrupt, CalledModuleError):
         return
+    return options["output"]
 
 
 def split_subregions(expr):
@@ -331,6 +482,15 @@ def main():
     nprocs = int(options.pop("nprocs"))
     subregions = options["subregions"]
     tosplit = flags["d"]
+    aggregate_only = flags["a"]
+    aggregates = {key: options.pop(key) for key in AGGREGATES}
+    aggregate = any(aggregates.values())
+    if aggregate_only and not aggregate:
+        gscript.fatal(
+            _("Flag -a requires at least one of the options {}").format(
+                ", ".join("<{}>".format(key) for key in AGGREGATES)
+            )
+        )
     # filter unused optional params
     for key in list(options.keys()):
         if options[key] == "":
@@ -354,7 +514,21 @@ def main():
                 " To overwrite, use the --overwrite flag"
             ).format(r=options["output"] + "_run1")
         )
-    global TMP_RASTERS
+    for key in AGGREGATES:
+        if (
+            aggregates[key]
+            and not gscript.overwrite()
+            and gscript.find_file(
+                aggregates[key], element="cell", mapset=gscript.gisenv()["MAPSET"]
+            )["file"]
+        ):
+            gscript.fatal(
+                _(
+                    "Raster map <{r}> already exists."
+                    " To overwrite, use the --overwrite flag"
+                ).format(r=aggregates[key])
+            )
+    global TMP_RASTERS, TMP_DIRS
     cats = []
     if tosplit:
         gscript.message(_("Splitting subregions"))
@@ -404,14 +578,34 @@ def main():
             op["output"] += "_run" + str(i + 1)
             options_list.append((repeat, i + 1, None, op))
 
+    if aggregate:
+        TMP_DIRS.append(gscript.tempdir())
+        results = Aggregate(TMP_DIRS[-1])
+
     pool = Pool(nprocs)
-    p = pool.map_async(futures_process, options_list)
     try:
-        p.wait()
+        # aggregate results as soon as each run finishes
+        for output in pool.imap_unordered(futures_process, options_list):
+            if output is None or not aggregate:
+                continue
+            results.add(output)
+            if aggregate_only:
+                gscript.run_command(
+                    "g.remove", type="raster", name=output, flags="f", quiet=True
+                )
     except (KeyboardInterrupt, CalledModuleError):
         return
+    pool.close()
+
+    if aggregate:
+        gscript.message(_("Writing aggregated results"))
+        results.write(
+            probability=aggregates["output_probability"],
+            mean=aggregates["output_mean"],
+            variance=aggregates["output_variance"],
+        )
 
-    if cats:
+    if cats and not aggregate_only:
         gscript.message(_("Patching subregions"))
         for i in range(repeat):
             patch_input = [
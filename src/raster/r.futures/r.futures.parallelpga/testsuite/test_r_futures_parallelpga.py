@@ -165,6 +165,45 @@ class TestParallelPGA(TestCase):
             actual=self.actual_output, reference=self.result_split, precision=1e-6
         )
 
+    def test_aggregate_parallelpga_run(self):
+        """Test aggregating results of multiple runs"""
+        self.assertModule(
+            "r.futures.parallelpga",
+            developed="urban_2002",
+            development_pressure="devpressure",
+            compactness_mean=0.4,
+            compactness_range=0.05,
+            discount_factor=0.1,
+            patch_sizes="data/patches.txt",
+            predictors=["slope", "lakes_dist_km", "streets_dist_km"],
+            n_dev_neighbourhood=15,
+            devpot_params="data/potential.csv",
+            num_neighbors=4,
+            seed_search="random",
+            development_pressure_approach="gravity",
+            gamma=1.5,
+            scaling_factor=1,
+            subregions="zipcodes",
+            demand="data/demand.csv",
+            output=self.output,
+            output_probability="pga_probability",
+            output_mean="pga_mean",
+            output_variance="pga_variance",
+            repeat=3,
+            nprocs=2,
+            flags="da",
+        )
+        self.assertRasterDoesNotExist(self.actual_output)
+        self.assertRasterMinMax("pga_probability", refmin=0, refmax=1)
+        self.assertRasterMinMax("pga_mean", refmin=0, refmax=100)
+        self.assertRasterMinMax("pga_variance", refmin=0, refmax=10000)
+        self.runModule(
+            "g.remove",
+            flags="f",
+            type="raster",
+            name=["pga_probability", "pga_mean", "pga_variance"],
+        )
+
 
 if __name__ == "__main__":
     test()
@@ -68,6 +68,15 @@
 #% guisection: Optional
 #%end
 
+#%option
+#% key: nprocs
+#% type: integer
+#% label: Number of processes used for prediction
+#% description: Number of processes that apply the estimator to blocks of rows while the rasters are being read and written. Only used when the region is read in several blocks
+#% answer: 1
+#% guisection: Optional
+#%end
+
 
 import grass.script as gs
 import numpy as np
@@ -107,6 +116,10 @@ def main():
     probability = flags["p"]
     prob_only = flags["z"]
     chunksize = int(options["chunksize"])
+    nprocs = int(options["nprocs"])
+
+    if nprocs < 1:
+        gs.fatal("Number of processes must be at least 1")
 
     # remove @ from output in case overwriting result
     if "@" in output:
@@ -138,6 +151,7 @@ def main():
             output=output,
             height=row_incr,
             overwrite=gs.overwrite(),
+            n_jobs=nprocs,
         )
 
     if probability is True:
@@ -148,6 +162,7 @@ def main():
             class_labels=np.unique(y),
             overwrite=gs.overwrite(),
             height=row_incr,
+            n_jobs=nprocs,
         )
 
     # assign categories for classification map
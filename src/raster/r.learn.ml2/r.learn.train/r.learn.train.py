@@ -328,10 +328,19 @@
 #% guisection: Optional
 #%end
 
+#%option G_OPT_M_DIR
+#% key: training_cache
+#% label: Directory used to cache extracted training data
+#% description: Extracted training data is stored in this directory as memory-mappable binary arrays, keyed by the rasters, the training map and the computational region, and reused by later runs with the same inputs
+#% required: no
+#% guisection: Optional
+#%end
+
 #%rules
 #% required: training_map,training_points,load_training
 #% exclusive: training_map,training_points,load_training
 #% exclusive: load_training,save_training
+#% exclusive: load_training,training_cache
 #% requires: training_points,field
 #%end
 
@@ -436,6 +445,9 @@ def main():
         predefined_estimators,
         load_training_data,
         save_training_data,
+        training_cache_key,
+        load_training_cache,
+        save_training_cache,
         option_to_list,
         scoring_metrics,
         check_class_weights,
@@ -491,6 +503,7 @@ def main():
     random_state = int(options["random_state"])
     load_training = options["load_training"]
     save_training = options["save_training"]
+    training_cache = options["training_cache"]
     n_jobs = int(options["n_jobs"])
     balance = flags["b"]
     category_maps = option_to_list(options["category_maps"])
@@ -573,60 +586,131 @@ def main():
             class_labels = {k: v for (k, v) in a}
 
     else:
-        gs.message("Extracting training data")
+        cache_dir = None
 
-        if group_raster != "":
-            stack.append(group_raster)
+        if training_cache != "":
+            if group_raster != "":
+                cache_names = stack.names + [group_raster]
+            else:
+                cache_names = stack.names
 
-        if training_map != "":
-            X, y, cat = stack.extract_pixels(training_map)
-            y = y.flatten()
+            cache_dir = os.path.join(
+                training_cache,
+                training_cache_key(cache_names, training_map, training_points, field),
+            )
 
-            with RasterRow(training_map) as src:
+        if cache_dir is not None and os.path.isdir(cache_dir):
+            gs.message("Loading cached training data")
+            (
+                X,
+                y,
+                cat,
+                class_labels,
+                group_id,
+                names,
+                categorical,
+                shuffled_with,
+            ) = load_training_cache(cache_dir)
+
+            if names != stack.names or categorical != list(stack.categorical):
+                gs.fatal(
+                    "Cached training data in {} does not match the imagery "
+                    "group".format(cache_dir)
+                )
 
-                if mode == "classification":
-                    src_cats = {v: k for (k, v, m) in src.cats}
-                    class_labels = {k: k for k in np.unique(y)}
-                    class_labels.update(src_cats)
-                else:
-                    class_labels = None
+        else:
+            gs.message("Extracting training data")
 
-        elif training_points != "":
-            X, y, cat = stack.extract_points(training_points, field)
-            y = y.flatten()
+            if group_raster != "":
+                stack.append(group_raster)
 
-            if y.dtype in (np.object_, np.object):
-                from sklearn.preprocessing import LabelEncoder
+            if training_map != "":
+                X, y, cat = stack.extract_pixels(training_map)
+                y = y.flatten()
 
-                le = LabelEncoder()
-                y = le.fit_transform(y)
-                class_labels = {k: v for (k, v) in enumerate(le.classes_)}
-            else:
-                class_labels = None
+                with RasterRow(training_map) as src:
 
-        # take group id from last column and remove from predictors
-        if group_raster != "":
-            group_id = X[:, -1]
-            X = np.delete(X, -1, axis=1)
-            stack.drop(group_raster)
-        else:
-            group_id = None
+                    if mode == "classification":
+                        src_cats = {v: k for (k, v, m) in src.cats}
+                        class_labels = {k: k for k in np.unique(y)}
+                        class_labels.update(src_cats)
+                    else:
+                        class_labels = None
 
-        # check for labelled pixels and training data
-        if y.shape[0] == 0 or X.shape[0] == 0:
-            gs.fatal(
-                "No training pixels or pixels in imagery group ...check "
-                "computational region"
-            )
+            elif training_points != "":
+                X, y, cat = stack.extract_points(training_points, field)
+                y = y.flatten()
 
-        from sklearn.utils import shuffle
+                if y.dtype in (np.object_, np.object):
+                    from sklearn.preprocessing import LabelEncoder
 
-        if group_id is None:
-            X, y, cat = shuffle(X, y, cat, random_state=random_state)
-        else:
-            X, y, cat, group_id = shuffle(
-                X, y, cat, group_id, random_state=random_state
-            )
+                    le = LabelEncoder()
+                    y = le.fit_transform(y)
+                    class_labels = {k: v for (k, v) in enumerate(le.classes_)}
+                else:
+                    class_labels = None
+
+            # take group id from last column and remove from predictors
+            if group_raster != "":
+                group_id = X[:, -1]
+                X = np.delete(X, -1, axis=1)
+                stack.drop(group_raster)
+            else:
+                group_id = None
+
+            # check for labelled pixels and training data
+            if y.shape[0] == 0 or X.shape[0] == 0:
+                gs.fatal(
+                    "No training pixels or pixels in imagery group ...check "
+                    "computational region"
+                )
+
+            # the samples are shuffled while they are in memory, and cached
+            # in shuffled order
+            from sklearn.utils import shuffle
+
+            if group_id is None:
+                X, y, cat = shuffle(X, y, cat, random_state=random_state)
+            else:
+                X, y, cat, group_id = shuffle(
+                    X, y, cat, group_id, random_state=random_state
+                )
+            shuffled_with = random_state
+
+            if cache_dir is not None:
+                os.makedirs(training_cache, exist_ok=True)
+                save_training_cache(
+                    cache_dir,
+                    X,
+                    y,
+                    cat,
+                    class_labels,
+                    group_id,
+                    stack.names,
+                    stack.categorical,
+                    random_state,
+                )
+
+        # cached samples that were shuffled with another random state are
+        # reordered as if they were shuffled with this one, which copies the
+        # memory-mapped arrays into memory
+        if shuffled_with != random_state:
+            from sklearn.utils import shuffle
+
+            gs.message("Reordering cached training data for the random state")
+            index = np.arange(y.shape[0])
+
+            # position of each sample in the cache, which holds the samples
+            # in extraction order if they were not shuffled
+            position = index
+            if shuffled_with is not None:
+                position = np.argsort(shuffle(index, random_state=shuffled_with))
+
+            index = position[shuffle(index, random_state=random_state)]
+            X, y, cat = X[index], y[index], cat[index]
+
+            if group_id is not None:
+                group_id = group_id[index]
 
         if save_training != "":
             save_training_data(
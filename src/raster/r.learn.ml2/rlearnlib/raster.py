@@ -1,6 +1,7 @@
 #!/usr/bin/env python
-import itertools
 import os
+from collections import deque
+from multiprocessing import Pool
 from subprocess import PIPE
 
 import grass.script as gs
@@ -9,7 +10,6 @@ from grass.pygrass.gis.region import Region
 from grass.pygrass.modules.shortcuts import general as g
 from grass.pygrass.modules.shortcuts import imagery as im
 from grass.pygrass.modules.shortcuts import raster as r
-from grass.pygrass.modules.shortcuts import vector as v
 from grass.pygrass.raster import RasterRow, numpy2raster
 from grass.pygrass.raster.buffer import Buffer
 from grass.pygrass.utils import get_mapset_raster
@@ -32,6 +32,20 @@ def import_pandas():
     return module
 
 
+# estimator held by each prediction worker process, set once by the pool
+# initializer so that it is not pickled again for every block
+_worker_estimator = None
+
+
+def _init_predict_worker(estimator):
+    global _worker_estimator
+    _worker_estimator = estimator
+
+
+def _predict_worker(func, img):
+    return func(img, _worker_estimator)
+
+
 class RasterStack(StatisticsMixin):
     def __init__(self, rasters=None, group=None):
         """A RasterStack enables a collection of raster layers to be bundled
@@ -62,6 +76,9 @@ class RasterStack(StatisticsMixin):
 
         count : int
             Number of RasterRow objects within the RasterStack.
+
+        dtype : numpy.dtype
+            Native data type used when reading the RasterStack.
         """
         self.loc = _LocIndexer(self)
         self.iloc = _ILocIndexer(self, self.loc)
@@ -71,6 +88,7 @@ class RasterStack(StatisticsMixin):
         self.count = 0
         self._categorical_idx = []
         self._cell_nodata = -2147483648
+        self._readers = None
 
         # some checks
         if rasters and group:
@@ -158,6 +176,67 @@ class RasterStack(StatisticsMixin):
 
         return list(names)
 
+    @property
+    def dtype(self):
+        """Return the numpy data type used to read the RasterStack
+
+        CELL maps are read as int32 and FCELL maps as float32. A stack that
+        mixes CELL and FCELL maps is read as float32, and float64 is only
+        used if the stack contains a DCELL map.
+        """
+        mtypes = set(self.mtypes.values())
+
+        if mtypes == {"CELL"}:
+            return np.dtype("int32")
+
+        if "DCELL" in mtypes:
+            return np.dtype("float64")
+
+        return np.dtype("float32")
+
+    def open(self):
+        """Open all of the RasterRow objects in the RasterStack for reading
+
+        While the RasterStack is open, repeated calls to `read` reuse the
+        opened maps and their row buffers instead of reopening every map for
+        each window. The RasterStack can also be used as a context manager.
+
+        Returns
+        -------
+        RasterStack
+        """
+        if self._readers is None:
+            reg = Region()
+            readers = []
+
+            try:
+                for src in self.loc.values():
+                    f = RasterRow(src.fullname())
+                    f.open("r")
+                    readers.append((f, Buffer((reg.cols,), mtype=f.mtype)))
+            except:
+                for f, _ in readers:
+                    f.close()
+                raise
+
+            self._readers = readers
+
+        return self
+
+    def close(self):
+        """Close the RasterRow objects opened by `open`"""
+        if self._readers is not None:
+            for f, _ in self._readers:
+                f.close()
+
+            self._readers = None
+
+    def __enter__(self):
+        return self.open()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
     @property
     def layers(self):
         return self.loc
@@ -177,7 +256,9 @@ class RasterStack(StatisticsMixin):
         if isinstance(mapnames, str):
             mapnames = [mapnames]
 
-        # reset existing attributes
+        # close any layers opened for reading and reset existing attributes
+        self.close()
+
         for src in list(self.loc.values()):
             try:
                 delattr(self, src.name)
@@ -337,7 +418,7 @@ class RasterStack(StatisticsMixin):
 
             return new_raster
 
-    def read(self, row=None, rows=None):
+    def read(self, row=None, rows=None, out=None):
         """Read data from RasterStack as a masked 3D numpy array
 
         Notes
@@ -350,6 +431,10 @@ class RasterStack(StatisticsMixin):
         arguments are supplied, then all of the maps within the RasterStack are
         read into a 3d numpy array (obeying the GRASS region settings)
 
+        The data is read directly into an array of the native data type of
+        the RasterStack (see `dtype`). If the RasterStack is open, the opened
+        maps are reused, otherwise they are opened and closed for this read.
+
         Parameters
         ----------
         row : int (opt)
@@ -359,6 +444,11 @@ class RasterStack(StatisticsMixin):
             Tuple of integers representing the start and end numbers of rows to
             read as a single block of rows.
 
+        out : numpy.ma.MaskedArray (opt)
+            Masked array returned by a previous call to `read`. If it has the
+            required shape then its data and mask are reused instead of
+            allocating new arrays.
+
         Returns
         -------
         data : ndarray
@@ -370,40 +460,48 @@ class RasterStack(StatisticsMixin):
         # create numpy array to receive data
         if rows:
             row_start, row_stop = rows
-            width = reg.cols
-            height = abs(row_stop - row_start)
-            shape = (self.count, height, width)
-            rowincrs = [i for i in range(row_start, row_stop)]
-        elif row:
-            row_start = row
-            row_stop = row + 1
-            height = 1
-            shape = (self.count, height, reg.cols)
-            rowincrs = [i for i in range(row_start, row_stop)]
+        elif row is not None:
+            row_start, row_stop = row, row + 1
         else:
-            shape = (self.count, reg.rows, reg.cols)
+            row_start, row_stop = 0, reg.rows
 
-        data = np.zeros(shape)
+        shape = (self.count, abs(row_stop - row_start), reg.cols)
 
-        # read from each RasterRow object
-        for band, (name, src) in enumerate(self.layers.items()):
-            with RasterRow(src.fullname()) as f:
-                if row or rows:
-                    for i, row in enumerate(rowincrs):
-                        data[band, i, :] = f[row]
-                else:
-                    data[band, :, :] = np.asarray(f)
+        if (
+            isinstance(out, np.ma.MaskedArray)
+            and out.shape == shape
+            and out.dtype == self.dtype
+        ):
+            data = out.data
+            mask = np.ma.getmaskarray(out)
+        else:
+            data = np.empty(shape, dtype=self.dtype)
+            mask = np.empty(shape, dtype="bool")
+
+        opened = self._readers is None
+
+        if opened:
+            self.open()
 
-        # mask array
-        data = np.ma.masked_equal(data, self._cell_nodata)
-        data = np.ma.masked_invalid(data)
+        # read each row directly into the data array and mask nodata
+        try:
+            for band, (f, buf) in enumerate(self._readers):
+                for i, rowincr in enumerate(range(row_start, row_stop)):
+                    f.get_row(rowincr, buf)
+                    data[band, i, :] = buf
+
+                if f.mtype == "CELL":
+                    np.equal(data[band], self._cell_nodata, out=mask[band])
+                else:
+                    np.isnan(data[band], out=mask[band])
+        finally:
+            if opened:
+                self.close()
 
-        if isinstance(data.mask, np.bool_):
-            mask_arr = np.empty(data.shape, dtype="bool")
-            mask_arr[:] = False
-            data.mask = mask_arr
+        if isinstance(out, np.ma.MaskedArray) and out.data is data:
+            return out
 
-        return data
+        return np.ma.MaskedArray(data, mask=mask, copy=False)
 
     @staticmethod
     def _pred_fun(img, estimator):
@@ -546,7 +644,86 @@ class RasterStack(StatisticsMixin):
 
         return result
 
-    def predict(self, estimator, output, height=None, overwrite=False):
+    def _predict_windows(self, estimator, func, height, n_jobs=1, n_blocks=None):
+        """Generator of prediction results for consecutive row windows
+
+        With n_jobs > 1 the estimator is applied in a pool of worker
+        processes while the calling process keeps reading the next windows
+        and consuming the finished ones, so that reading, prediction and
+        writing overlap. Results are always yielded in row order.
+
+        Parameters
+        ----------
+        estimator : estimator object implementing 'fit'
+            The object to use to fit the data.
+
+        func : function
+            Prediction function applied to each 3d block of raster data.
+
+        height : int
+            Number of raster rows in each window.
+
+        n_jobs : int (opt). Default is 1
+            Number of worker processes used for prediction.
+
+        n_blocks : int (opt)
+            Maximum number of windows that are read but not yet consumed.
+            Bounds the memory use of the pipeline. Default is 2 * n_jobs.
+
+        Yields
+        ------
+        tuple
+            Window index and the result of func for that window.
+        """
+        windows = list(self.row_windows(height=height))
+        opened = self._readers is None
+
+        if opened:
+            self.open()
+
+        try:
+            if n_jobs <= 1:
+                img = None
+
+                for wi, rows in enumerate(windows):
+                    img = self.read(rows=rows, out=img)
+                    yield wi, func(img, estimator)
+
+                return
+
+            if n_blocks is None:
+                n_blocks = 2 * n_jobs
+
+            n_blocks = max(n_blocks, 1)
+
+            with Pool(
+                processes=n_jobs,
+                initializer=_init_predict_worker,
+                initargs=(estimator,),
+            ) as pool:
+                pending = deque()
+
+                # blocks are pickled asynchronously by the pool so each block
+                # needs its own array rather than a reused buffer
+                for wi, rows in enumerate(windows):
+                    img = self.read(rows=rows)
+                    job = pool.apply_async(_predict_worker, (func, img))
+                    pending.append((wi, job))
+
+                    if len(pending) >= n_blocks:
+                        wj, job = pending.popleft()
+                        yield wj, job.get()
+
+                while pending:
+                    wj, job = pending.popleft()
+                    yield wj, job.get()
+        finally:
+            if opened:
+                self.close()
+
+    def predict(
+        self, estimator, output, height=None, overwrite=False, n_jobs=1, n_blocks=None
+    ):
         """Prediction method for RasterStack class
 
         Parameters
@@ -564,6 +741,14 @@ class RasterStack(StatisticsMixin):
         overwrite : bool (opt). Default is False
             Option to overwrite an existing raster.
 
+        n_jobs : int (opt). Default is 1
+            Number of processes used to apply the estimator to blocks of rows.
+            Only used if height is specified.
+
+        n_blocks : int (opt)
+            Maximum number of blocks of rows held in memory while predicting
+            in parallel. Default is 2 * n_jobs.
+
         Returns
         -------
         RasterStack
@@ -601,7 +786,16 @@ class RasterStack(StatisticsMixin):
 
         if len(indexes) > 1:
             result_stack = self._predict_multi(
-                estimator, reg, indexes, indexes, height, func, output, overwrite
+                estimator,
+                reg,
+                indexes,
+                indexes,
+                height,
+                func,
+                output,
+                overwrite,
+                n_jobs,
+                n_blocks,
             )
         else:
             if height is not None:
@@ -610,20 +804,16 @@ class RasterStack(StatisticsMixin):
                     output, mode="w", mtype=mtype, overwrite=overwrite
                 ) as dst:
                     n_windows = len([i for i in self.row_windows(height=height)])
+                    newrow = Buffer((reg.cols,), mtype=mtype)
 
-                    data_gen = (
-                        (wi, self.read(rows=rows))
-                        for wi, rows in enumerate(self.row_windows(height=height))
-                    )
-
-                    for wi, arr in data_gen:
+                    for wi, result in self._predict_windows(
+                        estimator, func, height, n_jobs, n_blocks
+                    ):
                         gs.percent(wi, n_windows, 1)
-                        result = func(arr, estimator)
                         result = np.ma.filled(result, nodata)
 
                         # writing data to GRASS raster row-by-row
                         for i in range(result.shape[1]):
-                            newrow = Buffer((reg.cols,), mtype=mtype)
                             newrow[:] = result[0, i, :]
                             dst.put_row(newrow)
 
@@ -640,7 +830,14 @@ class RasterStack(StatisticsMixin):
         return result_stack
 
     def predict_proba(
-        self, estimator, output, class_labels=None, height=None, overwrite=False
+        self,
+        estimator,
+        output,
+        class_labels=None,
+        height=None,
+        overwrite=False,
+        n_jobs=1,
+        n_blocks=None,
     ):
         """Prediction method for RasterStack class
 
@@ -664,6 +861,14 @@ class RasterStack(StatisticsMixin):
         overwrite : bool (opt). Default is False
             Option to overwrite an existing raster(s)
 
+        n_jobs : int (opt). Default is 1
+            Number of processes used to apply the estimator to blocks of rows.
+            Only used if height is specified.
+
+        n_blocks : int (opt)
+            Maximum number of blocks of rows held in memory while predicting
+            in parallel. Default is 2 * n_jobs.
+
         Returns
         -------
         RasterStack
@@ -686,13 +891,32 @@ class RasterStack(StatisticsMixin):
 
         # create and open rasters for writing
         result_stack = self._predict_multi(
-            estimator, reg, indexes, class_labels, height, func, output, overwrite
+            estimator,
+            reg,
+            indexes,
+            class_labels,
+            height,
+            func,
+            output,
+            overwrite,
+            n_jobs,
+            n_blocks,
         )
 
         return result_stack
 
     def _predict_multi(
-        self, estimator, region, indexes, class_labels, height, func, output, overwrite
+        self,
+        estimator,
+        region,
+        indexes,
+        class_labels,
+        height,
+        func,
+        output,
+        overwrite,
+        n_jobs=1,
+        n_blocks=None,
     ):
         # create and open rasters for writing if incremental reading
         if height is not None:
@@ -703,26 +927,21 @@ class RasterStack(StatisticsMixin):
                 dst.append(RasterRow(rastername))
                 dst[i].open("w", mtype="FCELL", overwrite=overwrite)
 
-            # create data reader generator
             n_windows = len([i for i in self.row_windows(height=height)])
-
-            data_gen = (
-                (wi, self.read(rows=rows))
-                for wi, rows in enumerate(self.row_windows(height=height))
-            )
+            newrow = Buffer((region.cols,), mtype="FCELL")
 
         # perform prediction
         try:
             if height is not None:
-                for wi, arr in data_gen:
+                for wi, result in self._predict_windows(
+                    estimator, func, height, n_jobs, n_blocks
+                ):
                     gs.percent(wi, n_windows, 1)
-                    result = func(arr, estimator)
                     result = np.ma.filled(result, np.nan)
 
                     # write multiple features to GRASS GIS rasters
                     for i, arr_index in enumerate(indexes):
                         for row in range(result.shape[1]):
-                            newrow = Buffer((region.cols,), mtype="FCELL")
                             newrow[:] = result[arr_index, row, :]
                             dst[i].put_row(newrow)
             else:
@@ -845,6 +1064,65 @@ class RasterStack(StatisticsMixin):
 
         return X, y, cat
 
+    def _sample_points(self, coords):
+        """Sample the values of all rasters in the RasterStack at point
+        locations
+
+        The coordinates are converted into row and column indexes of the
+        current region, and every row containing points is read only once
+        for each raster.
+
+        Parameters
+        ----------
+        coords : array-like
+            2d array of point coordinates with the dimensions ordered by
+            (n_samples, [x, y]).
+
+        Returns
+        -------
+        ndarray
+            2d array of raster values with the dimensions ordered by
+            (n_samples, n_features). Points outside of the region and nodata
+            cells are NaN.
+        """
+        reg = Region()
+        coords = np.asarray(coords, dtype="float64").reshape((-1, 2))
+        X = np.full((coords.shape[0], self.count), np.nan)
+
+        rows = np.floor((reg.north - coords[:, 1]) / reg.nsres).astype("int64")
+        cols = np.floor((coords[:, 0] - reg.west) / reg.ewres).astype("int64")
+
+        inside = (rows >= 0) & (rows < reg.rows) & (cols >= 0) & (cols < reg.cols)
+        idx = np.flatnonzero(inside)
+
+        # group the points by row
+        idx = idx[np.argsort(rows[idx], kind="stable")]
+        row_ids, starts = np.unique(rows[idx], return_index=True)
+        stops = np.append(starts[1:], idx.shape[0])
+
+        opened = self._readers is None
+
+        if opened:
+            self.open()
+
+        try:
+            for row, start, stop in zip(row_ids, starts, stops):
+                pts = idx[start:stop]
+
+                for band, (f, buf) in enumerate(self._readers):
+                    f.get_row(int(row), buf)
+                    X[pts, band] = np.asarray(buf)[cols[pts]]
+        finally:
+            if opened:
+                self.close()
+
+        # set any grass integer nodata values to NaN
+        for band, mtype in enumerate(self.mtypes.values()):
+            if mtype == "CELL":
+                X[X[:, band] == self._cell_nodata, band] = np.nan
+
+        return X
+
     def extract_points(self, vect_name, fields, na_rm=True, as_df=False):
         """Samples a list of GRASS rasters using a point dataset
 
@@ -911,59 +1189,31 @@ class RasterStack(StatisticsMixin):
 
             df = df.loc[:, fields + [points.table.key]]
 
-            # extract raster data
-            Xs = []
-
-            for name, layer in self.loc.items():
-                rast_data = (
-                    v.what_rast(
-                        map=vect_name,
-                        raster=layer.fullname(),
-                        flags="p",
-                        quiet=True,
-                        stdout_=PIPE,
-                    )
-                    .outputs.stdout.strip()
-                    .split(os.linesep)
-                )
+            # read point coordinates and categories once
+            coords = []
+            cats = []
 
-                with RasterRow(layer.fullname()) as src:
-                    if src.mtype == "CELL":
-                        nodata = self._cell_nodata
-                        dtype = pd.Int64Dtype()
-                    else:
-                        nodata = np.nan
-                        dtype = np.float32
-
-                    if len(list(itertools.chain(*rast_data))) == 0:
-                        gs.fatal(
-                            "There are no training point geometries in "
-                            "the supplied vector dataset"
-                        )
+            for point in points.viter("points"):
+                if point.cat is None:
+                    continue
 
-                    X = [
-                        k.split("|")[1] if k.split("|")[1] != "*" else nodata
-                        for k in rast_data
-                    ]
-                    X = np.asarray(X)
-                    cat = np.asarray([int(k.split("|")[0]) for k in rast_data])
+                coords.append((point.x, point.y))
+                cats.append(point.cat)
 
-                    if src.mtype == "CELL":
-                        X = [int(i) for i in X]
-                    else:
-                        X = [float(i) for i in X]
+        if len(cats) == 0:
+            gs.fatal(
+                "There are no training point geometries in the supplied vector dataset"
+            )
 
-                X = pd.DataFrame(
-                    data=np.column_stack((X, cat)), columns=[name, key_col]
-                )
-                X[name] = X[name].astype(dtype)
-                Xs.append(X)
+        # sample all rasters at the point locations
+        X = pd.DataFrame(self._sample_points(coords), columns=list(self.loc.keys()))
 
-        for X in Xs:
-            df = df.merge(X, on=key_col)
+        for name, mtype in self.mtypes.items():
+            if mtype == "CELL":
+                X[name] = X[name].astype(pd.Int64Dtype())
 
-        # set any grass integer nodata values to NaN
-        df = df.replace(self._cell_nodata, np.nan)
+        X[key_col] = cats
+        df = df.merge(X, on=key_col)
 
         # remove rows with missing response data
         df = df.dropna(subset=fields)
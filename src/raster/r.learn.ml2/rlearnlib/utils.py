@@ -5,6 +5,13 @@
 with passing pre-defined scikit learn classifiers
 and other utilities for loading/saving training data."""
 
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+
+import grass.script as gs
 import numpy as np
 from grass.pygrass.utils import get_mapset_raster
 
@@ -436,3 +443,245 @@ def load_training_data(file):
     X = training_data.drop(columns=["groups", "class_labels", "cat", "response"]).values
 
     return X, y, cat, class_labels, groups
+
+
+def _map_signature(name, elements):
+    """
+    Describes the files of a GRASS map by their names, sizes and
+    modification times
+
+    Parameters
+    ----------
+    name : str
+        Name of a GRASS map
+
+    elements : list
+        Names of the GRASS database elements containing files of the map,
+        e.g. ['cellhd', 'cell', 'fcell'] for rasters.
+
+    Returns
+    -------
+    signature : list
+        List of values that changes whenever the map is rewritten.
+    """
+    signature = [name]
+
+    for element in elements:
+        path = gs.find_file(name, element=element)["file"]
+
+        if not path or not os.path.exists(path):
+            continue
+
+        if os.path.isdir(path):
+            files = sorted(os.path.join(path, f) for f in os.listdir(path))
+        else:
+            files = [path]
+
+        for f in files:
+            stat = os.stat(f)
+            signature.extend(
+                [element, os.path.basename(f), stat.st_size, stat.st_mtime_ns]
+            )
+
+    return signature
+
+
+def training_cache_key(names, training_map=None, training_points=None, field=None):
+    """
+    Returns a key that identifies the training data extracted from a stack
+    of rasters using a training map, in the current computational region
+
+    The key is a hash of the names, file sizes and modification times of the
+    rasters, the training map or vector and its attribute database, the
+    response field and the computational region. It changes whenever any of
+    these inputs is modified.
+
+    Parameters
+    ----------
+    names : list
+        Full names of the rasters in the RasterStack, including any
+        group_raster.
+
+    training_map : str (opt)
+        Name of the raster containing labelled pixels.
+
+    training_points : str (opt)
+        Name of the vector containing training points.
+
+    field : str (opt)
+        Name of the attribute column with the response values.
+
+    Returns
+    -------
+    key : str
+        Hexadecimal sha1 digest.
+    """
+    signature = []
+
+    for name in names:
+        signature.append(_map_signature(name, ["cellhd", "cell", "fcell"]))
+
+    if training_map:
+        signature.append(_map_signature(training_map, ["cellhd", "cell", "fcell"]))
+
+    if training_points:
+        signature.append(_map_signature(training_points, ["vector"]))
+        signature.append(field)
+
+        try:
+            database = gs.vector_db(training_points)[1]["database"]
+        except (KeyError, gs.CalledModuleError):
+            database = None
+
+        if database and os.path.isfile(database):
+            stat = os.stat(database)
+            signature.append([database, stat.st_size, stat.st_mtime_ns])
+
+    region = gs.region()
+    signature.append(sorted(region.items()))
+
+    return hashlib.sha1(json.dumps(signature).encode("utf-8")).hexdigest()
+
+
+def save_training_cache(
+    directory,
+    X,
+    y,
+    cat,
+    class_labels=None,
+    groups=None,
+    names=None,
+    categorical=None,
+    random_state=None,
+):
+    """
+    Saves extracted training data as a directory of binary numpy arrays
+
+    The directory contains X.npy, y.npy, cat.npy and optionally groups.npy,
+    together with a metadata.json file that holds the feature names, the
+    indexes of categorical features, the class labels and the random state
+    with which the samples were shuffled before saving them. The directory is
+    written to a temporary location first and then moved into place, so that
+    an interrupted run never leaves a partial cache.
+
+    Parameters
+    ----------
+    directory : str
+        Path of the cache directory to create.
+
+    X : ndarray
+        2d numpy array containing predictor values
+
+    y : ndarray
+        1d numpy array containing labels
+
+    cat : ndarray
+        1d numpy array of GRASS key column
+
+    class_labels : dict (opt)
+        Dict of class index values as keys, and class labels as values
+
+    groups : ndarray (opt)
+        1d numpy array containing group labels
+
+    names : list (opt)
+        Names of the features
+
+    categorical : list (opt)
+        Indexes of categorical features
+
+    random_state : int (opt)
+        Seed with which the samples were shuffled, if they were
+    """
+    parent = os.path.dirname(os.path.abspath(directory))
+    tmpdir = tempfile.mkdtemp(dir=parent, prefix=".tmp_")
+
+    try:
+        np.save(os.path.join(tmpdir, "X.npy"), np.asarray(X, dtype="float64"))
+        np.save(os.path.join(tmpdir, "y.npy"), np.asarray(y))
+        np.save(os.path.join(tmpdir, "cat.npy"), np.asarray(cat, dtype="int64"))
+
+        if groups is not None:
+            np.save(os.path.join(tmpdir, "groups.npy"), np.asarray(groups))
+
+        if class_labels:
+            class_labels = [
+                [np.asarray(k).item(), np.asarray(v).item()]
+                for k, v in class_labels.items()
+            ]
+
+        metadata = {
+            "names": list(names) if names is not None else None,
+            "categorical": [int(i) for i in categorical] if categorical else [],
+            "class_labels": class_labels or None,
+            "random_state": random_state,
+        }
+
+        with open(os.path.join(tmpdir, "metadata.json"), "w") as f:
+            json.dump(metadata, f)
+
+        try:
+            os.replace(tmpdir, directory)
+        except OSError:
+            # another run has already written the same cache
+            if not os.path.isdir(directory):
+                raise
+
+            shutil.rmtree(tmpdir, ignore_errors=True)
+
+    except BaseException:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+        raise
+
+
+def load_training_cache(directory):
+    """
+    Loads training data saved by `save_training_cache`
+
+    The arrays are memory-mapped rather than read into memory.
+
+    Parameters
+    ----------
+    directory : str
+        Path of the cache directory.
+
+    Returns
+    -------
+    X (2d numpy array): Numpy array containing predictor values
+    y (1d numpy array): Numpy array containing labels
+    cat (1d numpy array): Numpy array of GRASS key column
+    class_labels (dict): Dict of class index values and labels, or None
+    groups (1d numpy array): Numpy array of group labels, or None
+    names (list): Names of the features, or None
+    categorical (list): Indexes of categorical features
+    random_state (int): Seed with which the samples were shuffled, or None
+    """
+    X = np.load(os.path.join(directory, "X.npy"), mmap_mode="r")
+    y = np.load(os.path.join(directory, "y.npy"), mmap_mode="r")
+    cat = np.load(os.path.join(directory, "cat.npy"), mmap_mode="r")
+
+    groups_file = os.path.join(directory, "groups.npy")
+
+    if os.path.exists(groups_file):
+        groups = np.load(groups_file, mmap_mode="r")
+    else:
+        groups = None
+
+    with open(os.path.join(directory, "metadata.json")) as f:
+        metadata = json.load(f)
+
+    class_labels = metadata["class_labels"]
+
+    if class_labels:
+        class_labels = {k: v for (k, v) in class_labels}
+
+    return (
+        X,
+        y,
+        cat,
+        class_labels,
+        groups,
+        metadata["names"],
+        metadata["categorical"],
+        metadata.get("random_state"),
+    )
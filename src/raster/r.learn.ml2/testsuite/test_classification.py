@@ -15,6 +15,7 @@ for details.
 """
 import tempfile
 import os
+import shutil
 
 import grass.script as gs
 
@@ -190,6 +191,64 @@ class TestClassification(TestCase):
         )
         self.assertRasterExists(self.output, msg="Output was not created")
 
+    def test_training_cache(self):
+        """Test that extracted training data is cached and reused"""
+        cache_dir = tempfile.mkdtemp()
+
+        # the last run reorders the cached samples for another random state
+        for random_state in (1, 1, 2):
+            self.assertModule(
+                "r.learn.train",
+                group=self.group,
+                training_points=self.labelled_points,
+                field="value",
+                model_name="RandomForestClassifier",
+                training_cache=cache_dir,
+                random_state=random_state,
+                n_estimators=100,
+                save_model=self.model_file,
+                overwrite=True,
+            )
+            self.assertFileExists(filename=self.model_file)
+            self.assertEqual(len(os.listdir(cache_dir)), 1)
+
+        shutil.rmtree(cache_dir)
+
+    def test_parallel_prediction(self):
+        """Checks that prediction using several processes matches the serial
+        prediction"""
+        parallel_output = self.output + "_parallel"
+
+        self.assertModule(
+            "r.learn.train",
+            group=self.group,
+            training_map=self.labelled_pixels,
+            model_name="RandomForestClassifier",
+            n_estimators=100,
+            random_state=1,
+            save_model=self.model_file,
+        )
+
+        self.assertModule(
+            "r.learn.predict",
+            group=self.group,
+            load_model=self.model_file,
+            output=self.output,
+            chunksize=10000,
+        )
+        self.assertModule(
+            "r.learn.predict",
+            group=self.group,
+            load_model=self.model_file,
+            output=parallel_output,
+            chunksize=10000,
+            nprocs=2,
+        )
+        self.assertRastersNoDifference(
+            actual=parallel_output, reference=self.output, precision=0
+        )
+        self.runModule("g.remove", flags="f", type="raster", name=parallel_output)
+
 
 if __name__ == "__main__":
     test()
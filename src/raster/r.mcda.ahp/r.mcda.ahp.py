@@ -50,6 +50,13 @@ import sys
 import grass.script as grass
 import numpy as np
 import warnings
+from grass.pygrass.gis.region import Region
+from grass.pygrass.raster import RasterRow
+from grass.pygrass.raster.buffer import Buffer
+
+# number of cells of a block of rows of all the criteria read at once
+BLOCK_SIZE = 2 ** 20
+CNULL = -2147483648  # null value for CELL maps
 
 
 def calculateWeight(pairwise):
@@ -68,13 +75,42 @@ def calculateWeight(pairwise):
     return weight, eigenvalues, eigenvector
 
 
+def getRowOrNan(raster, row):
+    "Read a row of a raster map as floats with null cells as NaN"
+    values = raster.get_row(row)
+    if raster.mtype != "CELL":
+        return values.astype(np.float64)
+    nulls = values == CNULL
+    values = values.astype(np.float64)
+    values[nulls] = np.nan
+    return values
+
+
+def criteriaBlocks(criteria):
+    "Iterate over blocks of rows of all the criteria (criteria, rows, cols)"
+    region = Region()
+    blockRows = max(1, BLOCK_SIZE // (len(criteria) * region.cols))
+    maps = [RasterRow(criterion) for criterion in criteria]
+    for m in maps:
+        m.open("r")
+    try:
+        for start in range(0, region.rows, blockRows):
+            rows = range(start, min(start + blockRows, region.rows))
+            yield np.array([[getRowOrNan(m, row) for row in rows] for m in maps])
+    finally:
+        for m in maps:
+            m.close()
+
+
 def calculateMap(criteria, weight, outputMap):
-    "Parser a formula for mapcalc and run grass.mapcalc"
-    formula = ""
-    for i in range(len(criteria) - 1):
-        formula += "%s*%s + " % (criteria[i], weight[i])
-    formula += "%s*%s " % (criteria[len(criteria) - 1], weight[len(criteria) - 1])
-    grass.mapcalc(outputMap + "=" + formula)
+    "Weighted sum of the criteria, computed by blocks of rows"
+    weight = np.array(weight, dtype=np.float64)
+    with RasterRow(
+        outputMap, mode="w", mtype="DCELL", overwrite=grass.overwrite()
+    ) as output:
+        for block in criteriaBlocks(criteria):
+            for row in np.tensordot(weight, block, axes=1):
+                output.put_row(Buffer(row.shape, "DCELL", row))
     return 0
 
 
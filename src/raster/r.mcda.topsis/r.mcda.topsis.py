@@ -53,104 +53,106 @@
 
 import sys
 import grass.script as gscript
+import numpy as np
+from grass.pygrass.gis.region import Region
+from grass.pygrass.raster import RasterRow
+from grass.pygrass.raster.buffer import Buffer
 from time import time
 
-
-def standardizedNormalizedMatrix(attributes, weights):  # step1 and step2
-    criteria = []
-    for criterion, weight in zip(attributes, weights):
-        gscript.mapcalc(
-            "critPow=pow(${criterion},2)", criterion=criterion, overwrite="True"
-        )
-        stats = gscript.parse_command("r.univar", map="critPow", flags="g")
-        nameMap = "_%s" % criterion
-        gscript.mapcalc(
-            "${nameMap}=(${criterion}/sqrt(${sum}))*${weight}",
-            nameMap=nameMap,
-            criterion=criterion,
-            sum=stats["sum"],
-            weight=weight,
-            overwrite="True",
-        )
-        criteria.append(nameMap)
-    return criteria
-
-
-def idealPoints(criteria, preference):  # step3
+# number of cells of a block of rows of all the criteria read at once
+BLOCK_SIZE = 2 ** 20
+CNULL = -2147483648  # null value for CELL maps
+
+
+def getRowOrNan(raster, row):
+    "Read a row of a raster map as floats with null cells as NaN"
+    values = raster.get_row(row)
+    if raster.mtype != "CELL":
+        return values.astype(np.float64)
+    nulls = values == CNULL
+    values = values.astype(np.float64)
+    values[nulls] = np.nan
+    return values
+
+
+def criteriaBlocks(attributes):
+    "Iterate over blocks of rows of all the criteria (criteria, rows, cols)"
+    region = Region()
+    blockRows = max(1, BLOCK_SIZE // (len(attributes) * region.cols))
+    maps = [RasterRow(attribute) for attribute in attributes]
+    for m in maps:
+        m.open("r")
+    try:
+        for start in range(0, region.rows, blockRows):
+            rows = range(start, min(start + blockRows, region.rows))
+            yield np.array([[getRowOrNan(m, row) for row in rows] for m in maps])
+    finally:
+        for m in maps:
+            m.close()
+
+
+def criteriaStats(attributes):  # pre-pass
+    "Sum of squares, minimum and maximum of each criterion in one pass"
+    n = len(attributes)
+    sumSquares = np.zeros(n)
+    minimum = np.full(n, np.inf)
+    maximum = np.full(n, -np.inf)
+    for block in criteriaBlocks(attributes):
+        block = block.reshape(n, -1)
+        nulls = np.isnan(block)
+        sumSquares += np.sum(np.where(nulls, 0, block) ** 2, axis=1)
+        minimum = np.minimum(minimum, np.where(nulls, np.inf, block).min(axis=1))
+        maximum = np.maximum(maximum, np.where(nulls, -np.inf, block).max(axis=1))
+    return sumSquares, minimum, maximum
+
+
+def standardizedNormalizedMatrix(sumSquares, weights):  # step1 and step2
+    "Factors to normalize each criterion and multiply it by its weight"
+    return np.array(weights, dtype=np.float64) / np.sqrt(sumSquares)
+
+
+def idealPoints(factors, minimum, maximum, preference):  # step3
     idelaPointsList = []
-    for c, p in zip(criteria, preference):
-        stats = gscript.parse_command("r.univar", map=c, flags="g")
+    for f, mn, mx, p in zip(factors, minimum, maximum, preference):
         if p == "gain":
-            ip = float(stats["max"])
+            ip = max(f * mn, f * mx)
         elif p == "cost":
-            ip = float(stats["min"])
+            ip = min(f * mn, f * mx)
         else:
             ip = -9999
             print("warning! %s doesn't compliant" % p)
         idelaPointsList.append(ip)
-    return idelaPointsList
+    return np.array(idelaPointsList)
 
 
-def worstPoints(criteria, preference):
+def worstPoints(factors, minimum, maximum, preference):
     worstPointsList = []
-    for c, p in zip(criteria, preference):
-        stats = gscript.parse_command("r.univar", map=c, flags="g")
+    for f, mn, mx, p in zip(factors, minimum, maximum, preference):
         if p == "gain":
-            wp = float(stats["min"])
+            wp = min(f * mn, f * mx)
         elif p == "cost":
-            wp = float(stats["max"])
+            wp = max(f * mn, f * mx)
         else:
             wp = -9999
             print("warning! %s doesn't compliant" % p)
         worstPointsList.append(wp)
-    return worstPointsList
-
-
-def idealPointDistance(idelaPointsList, criteria):  # step4a
-    distance = []
-    i = 0
-    for c, ip in zip(criteria, idelaPointsList):
-        mapname = "tmap_%s" % i
-        gscript.mapcalc(
-            "${mapname}=pow((${c}-${ip}),2)",
-            mapname=mapname,
-            c=c,
-            ip=ip,
-            overwrite="True",
-        )
-        distance.append(mapname)
-        i = i + 1
-    mapalgebra2 = "IdealPointDistance=sqrt(%s)" % ("+".join(distance))
-    gscript.mapcalc(mapalgebra2, overwrite="True")
-    gscript.run_command("g.remove", flags="f", type="raster", name=",".join(distance))
-    return 0
-
-
-def worstPointDistance(worstPointsList, criteria):  # step4b
-    distance = []
-    i = 0
-    for c, wp in zip(criteria, worstPointsList):
-        mapname = "tmap_%s" % i
-        gscript.mapcalc(
-            "${mapname}=pow((${c}-${wp}),2)",
-            mapname=mapname,
-            c=c,
-            wp=wp,
-            overwrite="True",
-        )
-        distance.append(mapname)
-        i = i + 1
-    mapalgebra2 = "WorstPointDistance=sqrt(%s)" % ("+".join(distance))
-    gscript.mapcalc(mapalgebra2, overwrite="True")
-    gscript.run_command("g.remove", flags="f", type="raster", name=",".join(distance))
-
-
-def relativeCloseness(topsismap):  # step5
-    gscript.mapcalc(
-        "${topsismap}=WorstPointDistance/(WorstPointDistance+IdealPointDistance)",
-        topsismap=topsismap,
-        overwrite="True",
-    )
+    return np.array(worstPointsList)
+
+
+def pointDistance(criteria, pointsList):  # step4
+    "Euclidean distance of each cell to the ideal or worst point"
+    return np.sqrt(np.sum((criteria - pointsList[:, None, None]) ** 2, axis=0))
+
+
+def relativeCloseness(worstPointDistance, idealPointDistance):  # step5
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return worstPointDistance / (worstPointDistance + idealPointDistance)
+
+
+def writeRows(raster, rows):
+    "Write the rows of a 2D array to a DCELL raster map"
+    for row in rows.astype(np.float64):
+        raster.put_row(Buffer(row.shape, raster.mtype, row))
 
 
 def main():
@@ -162,20 +164,21 @@ def main():
     weights = options["weights"].split(",")
     topsismap = options["topsismap"]
 
-    criteria = standardizedNormalizedMatrix(attributes, weights)
-    idelaPointsList = idealPoints(criteria, preferences)
-    worstPointsList = worstPoints(criteria, preferences)
-
-    idealPointDistance(idelaPointsList, criteria)
-    worstPointDistance(worstPointsList, criteria)
-    relativeCloseness(topsismap)
-    gscript.run_command("g.remove", flags="f", type="raster", name=",".join(criteria))
-    gscript.run_command(
-        "g.remove",
-        flags="f",
-        type="raster",
-        name="IdealPointDistance,WorstPointDistance,critPow",
-    )
+    # the criteria are read twice, once for the normalization and the
+    # ideal and worst points and once to compute the closeness
+    sumSquares, minimum, maximum = criteriaStats(attributes)
+    factors = standardizedNormalizedMatrix(sumSquares, weights)
+    idelaPointsList = idealPoints(factors, minimum, maximum, preferences)
+    worstPointsList = worstPoints(factors, minimum, maximum, preferences)
+
+    with RasterRow(
+        topsismap, mode="w", mtype="DCELL", overwrite=gscript.overwrite()
+    ) as output:
+        for block in criteriaBlocks(attributes):
+            criteria = block * factors[:, None, None]
+            idealPointDistance = pointDistance(criteria, idelaPointsList)
+            worstPointDistance = pointDistance(criteria, worstPointsList)
+            writeRows(output, relativeCloseness(worstPointDistance, idealPointDistance))
     end = time()
     print("Time computing-> %.4f s" % (end - start))
 
@@ -107,6 +107,14 @@
 #% guisection: Output
 #%end
 
+#%option
+#% key: nprocs
+#% type: integer
+#% description: Number of processes used for the computations
+#% options: 1-
+#% answer: 1
+#%end
+
 # import libraries
 import os
 import sys
@@ -114,10 +122,13 @@ import numpy as np
 import uuid
 import atexit
 import tempfile
-import operator
-import string
+from collections import deque
+from multiprocessing import Pool
 import grass.script as gs
 from grass.script import db as db
+from grass.pygrass.gis.region import Region
+from grass.pygrass.raster import RasterRow
+from grass.pygrass.raster.buffer import Buffer
 
 # for Python 3 compatibility
 try:
@@ -140,6 +151,10 @@ RECL_MESNEG = """\
 # Functions
 # ----------------------------------------------------------------------------
 
+# Number of cells of a block of rows of all the layers processed at once
+BLOCK_SIZE = 2 ** 20
+CNULL = -2147483648  # null value for CELL maps
+
 # create set to store names of temporary maps to be deleted upon exit
 CLEAN_RAST = []
 
@@ -166,28 +181,190 @@ def tmpname(prefix):
     Use only for raster maps.
     """
     tmpf = prefix + str(uuid.uuid4())
-    tmpf = string.replace(tmpf, "-", "_")
+    tmpf = tmpf.replace("-", "_")
     CLEAN_RAST.append(tmpf)
     return tmpf
 
 
-def compute_ies(INtmprule, INipi, INtmpf2, INenvmin, INenvmax):
+def raster_window():
+    """Set the raster window of this process to the current region
+
+    The region is changed by g.region while the module runs, so it is
+    read again from g.region.
+    """
+    current = gs.region()
+    region = Region()
+    region.north = current["n"]
+    region.south = current["s"]
+    region.east = current["e"]
+    region.west = current["w"]
+    region.nsres = current["nsres"]
+    region.ewres = current["ewres"]
+    region.adjust()
+    region.set_raster_region()
+    return region
+
+
+def get_row_or_nan(raster, row_num):
+    """Get a row of a raster map as floats, with null cells as NaN"""
+    row = raster.get_row(row_num)
+    if raster.mtype != "CELL":
+        return row.astype(np.float64)
+    nans = row == CNULL
+    row = row.astype(np.float64)
+    row[nans] = np.nan
+    return row
+
+
+def stack_blocks(maps, region):
+    """Iterate over a stack of raster maps in blocks of rows
+
+    Yield the index of the first row of each block and the block as an
+    array of shape (layers, rows, cols), with null cells as NaN.
+    """
+    block_rows = max(1, BLOCK_SIZE // (len(maps) * region.cols))
+    rasters = [RasterRow(name) for name in maps]
+    for raster in rasters:
+        raster.open("r")
+    try:
+        for start in range(0, region.rows, block_rows):
+            rows = range(start, min(start + block_rows, region.rows))
+            yield start, np.array(
+                [[get_row_or_nan(r, i) for i in rows] for r in rasters]
+            )
+    finally:
+        for raster in rasters:
+            raster.close()
+
+
+def map_blocks(function, blocks, args=(), nprocs=1):
+    """Apply function(block, *args) to the blocks and yield the results
+
+    With nprocs > 1, the blocks are processed by worker processes, but
+    the results are still yielded in the order of the blocks, keeping at
+    most two blocks per process in memory.
+    """
+    if nprocs <= 1:
+        for start, block in blocks:
+            yield function(block, *args)
+        return
+    pool = Pool(nprocs)
+    try:
+        pending = deque()
+        for start, block in blocks:
+            pending.append(pool.apply_async(function, (block,) + tuple(args)))
+            if len(pending) >= 2 * nprocs:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+    finally:
+        pool.terminate()
+
+
+def put_rows(raster, rows):
+    """Write the rows of a 2D array to a raster map, NaN as null"""
+    if raster.mtype == "CELL":
+        nulls = np.isnan(rows)
+        rows = np.where(nulls, 0, rows).astype(np.int32)
+        rows[nulls] = CNULL
+    else:
+        rows = rows.astype(np.float32 if raster.mtype == "FCELL" else np.float64)
+    for row in rows:
+        raster.put_row(Buffer(row.shape, raster.mtype, row))
+
+
+def merge_counts(counts1, counts2):
+    """Merge two frequency tables (sorted values, counts)"""
+    values = np.concatenate([counts1[0], counts2[0]])
+    counts = np.concatenate([counts1[1], counts2[1]])
+    values, index = np.unique(values, return_inverse=True)
+    return values, np.bincount(index.ravel(), weights=counts)
+
+
+def reference_counts(block, dignum, area):
+    """Compute the frequency tables of a block of reference layers
+
+    The values are multiplied with dignum and truncated to integers. With
+    area, the last layer of the block is the reference area and only the
+    cells where it is 1 are counted, otherwise the cells where the first
+    layer has a value.
+    """
+    if area:
+        inside = block[-1] == 1
+        block = block[:-1]
+    else:
+        inside = ~np.isnan(block[0])
+    tables = []
+    for layer in block:
+        values = layer[inside & ~np.isnan(layer)]
+        tables.append(np.unique(np.trunc(values * dignum), return_counts=True))
+    return tables
+
+
+def frequency_table(values, counts):
+    """Turn a frequency table into the cumulative table of the IES
+
+    Return the sorted values, the percentage of values lower or equal to
+    each of them, and the minimum and maximum value.
+    """
+    order = np.argsort(values, kind="stable")
+    values = np.asarray(values, dtype=np.float64)[order]
+    counts = np.asarray(counts, dtype=np.float64)[order]
+    percent = np.cumsum(counts) / np.sum(counts) * 100
+    return values, percent, values[0], values[-1]
+
+
+def compute_ies(values, table):
     """
-    Compute the environmental similarity layer for the individual variables
+    Compute the environmental similarity of the individual variable
+
+    The values are the projected conditions, multiplied with dignum and
+    truncated, the table the cumulative table of the reference values.
     """
-    tmpf3 = tmpname("tmp6")
-    gs.run_command("r.recode", input=INtmpf2, output=tmpf3, rules=INtmprule)
-
-    calcc = (
-        "{0} = if({1} == 0, (float({2}) - {3}) / ({4} - {3}) "
-        "* 100.0, if({1} <= 50, 2 * float({1}), "
-        "if({1} < 100, 2*(100-float({1})), "
-        "({4} - float({2})) / ({4} - {3}) * 100.0)))".format(
-            INipi, tmpf3, INtmpf2, float(INenvmin), float(INenvmax)
+    ref_values, percent, envmin, envmax = table
+    index = np.searchsorted(ref_values, values, side="right")
+    f = np.concatenate([[0], percent])[index]
+    with np.errstate(invalid="ignore", divide="ignore"):
+        ies = np.where(
+            f == 0,
+            (values - envmin) / (envmax - envmin) * 100.0,
+            np.where(
+                f <= 50,
+                2 * f,
+                np.where(
+                    f < 100,
+                    2 * (100 - f),
+                    (envmax - values) / (envmax - envmin) * 100.0,
+                ),
+            ),
         )
-    )
-    gs.mapcalc(calcc, quiet=True)
-    gs.write_command("r.colors", map=INipi, rules="-", stdin=COLORS_MES, quiet=True)
+    ies[~np.isfinite(ies) | np.isnan(values)] = np.nan
+    return ies
+
+
+def mess_block(block, tables, dignum):
+    """Compute the IES and the MESS statistics of a block of layers
+
+    Returns the IES of each layer, the MES (minimum IES), the MoD (index
+    of the layer with the minimum IES), the sum of the IES values below
+    -0.01 / dignum and the number of IES values below -0.0001 / dignum.
+    """
+    values = np.trunc(block * dignum)
+    ies = np.array([compute_ies(values[i], tables[i]) for i in range(len(tables))])
+    nulls = np.isnan(ies).all(axis=0)
+    filled = np.where(np.isnan(ies), np.inf, ies)
+    with np.errstate(invalid="ignore"):
+        negative = ies <= -0.01 / dignum
+        sumneg = np.where(negative, ies, 0).sum(axis=0)
+        sumneg[~negative.any(axis=0)] = np.nan
+        countneg = np.sum(ies <= -0.0001 / dignum, axis=0)
+    return {
+        "ies": ies,
+        "mes": np.where(nulls, np.nan, filled.min(axis=0)),
+        "mod": np.where(nulls, np.nan, np.argmin(filled, axis=0)),
+        "sumneg": sumneg,
+        "countneg": countneg,
+    }
 
 
 def main(options, flags):
@@ -251,6 +428,7 @@ def main(options, flags):
     fln = flags["n"]
     fli = flags["i"]
     flc = flags["c"]
+    nprocs = int(options["nprocs"])
 
     # digits / precision
     digits = int(options["digits"])
@@ -260,126 +438,38 @@ def main(options, flags):
     region_1 = gs.parse_command("g.region", flags="g")
 
     # Text for history in metadata
-    opt2 = dict((k, v) for k, v in options.iteritems() if v)
-    hist = " ".join("{!s}={!r}".format(k, v) for (k, v) in opt2.iteritems())
+    opt2 = dict((k, v) for k, v in options.items() if v)
+    hist = " ".join("{!s}={!r}".format(k, v) for (k, v) in opt2.items())
     hist = "r.mess {}".format(hist)
     unused, tmphist = tempfile.mkstemp()
     with open(tmphist, "w") as text_file:
         text_file.write(hist)
 
-    # Create reference layer if not defined
-    if not ref_rast and not ref_vect:
-        ref_rast = tmpname("tmp0")
-        gs.mapcalc("$i = if(isnull($r),null(),1)", i=ref_rast, r=REF[0], quiet=True)
-
-    # Create the recode table - Reference distribution is raster
+    # Create the frequency tables - Reference distribution is raster
     citiam = gs.find_file(name="MASK", element="cell", mapset=gs.gisenv()["MAPSET"])
     if citiam["fullname"]:
         rname = tmpname("tmp3")
         gs.mapcalc("$rname = MASK", rname=rname, quiet=True)
 
-    if ref_rast:
-        vtl = ref_rast
-
-        # Create temporary layer based on reference layer
-        tmpf0 = tmpname("tmp2")
-        gs.mapcalc("$tmpf0 = int($vtl * 1)", vtl=vtl, tmpf0=tmpf0, quiet=True)
-        gs.run_command("r.null", map=tmpf0, setnull=0, quiet=True)
+    tables = [None] * len(REF)
+    if not ref_vect:
+        # The reference layers are read once, within the MASK (if set),
+        # counting the values in the reference area
+        maps = REF + [ref_rast] if ref_rast else REF
+        blocks = stack_blocks(maps, raster_window())
+        counts = [(np.zeros(0), np.zeros(0))] * len(REF)
+        for block_counts in map_blocks(
+            reference_counts, blocks, (digits2, bool(ref_rast)), nprocs
+        ):
+            counts = [merge_counts(*c) for c in zip(counts, block_counts)]
+        for i in xrange(len(REF)):
+            if not counts[i][0].size:
+                gs.fatal(_("There are no reference values for {}").format(REF[i]))
+            tables[i] = frequency_table(*counts[i])
         if citiam["fullname"]:
             gs.run_command("r.mask", flags="r", quiet=True)
-        for i in xrange(len(REF)):
-
-            # Create mask based on combined MASK/reference layer
-            gs.run_command("r.mask", raster=tmpf0, quiet=True)
-
-            # Calculate the frequency distribution
-            tmpf1 = tmpname("tmp4")
-            gs.mapcalc(
-                "$tmpf1 = int($dignum * $inplay)",
-                tmpf1=tmpf1,
-                inplay=REF[i],
-                dignum=digits2,
-                quiet=True,
-            )
-            p = gs.pipe_command(
-                "r.stats", quiet=True, flags="cn", input=tmpf1, sort="asc", sep=";"
-            )
-            stval = {}
-            for line in p.stdout:
-                [val, count] = line.strip(os.linesep).split(";")
-                stval[float(val)] = float(count)
-            p.wait()
-            sstval = sorted(stval.items(), key=operator.itemgetter(0))
-            sstval = np.matrix(sstval)
-            a = np.cumsum(np.array(sstval), axis=0)
-            b = np.sum(np.array(sstval), axis=0)
-            c = a[:, 1] / b[1] * 100
-
-            # Remove tmp mask and set region to env_proj if needed
-            gs.run_command("r.mask", quiet=True, flags="r")
-            if RP:
-                gs.use_temp_region()
-                gs.run_command("g.region", quiet=True, raster=PROJ[0])
-
-            # get new region settings, to compare to original ones later
-            region_2 = gs.parse_command("g.region", flags="g")
-
-            # Get min and max values for recode table (based on full map)
-            tmpf2 = tmpname("tmp5")
-            gs.mapcalc(
-                "$tmpf2 = int($dignum * $inplay)",
-                tmpf2=tmpf2,
-                inplay=PROJ[i],
-                dignum=digits2,
-                quiet=True,
-            )
-            d = gs.parse_command("r.univar", flags="g", map=tmpf2, quiet=True)
-
-            # Create recode rules
-            Dmin = int(d["min"])
-            Dmax = int(d["max"])
-            envmin = np.min(np.array(sstval), axis=0)[0]
-            envmax = np.max(np.array(sstval), axis=0)[0]
-
-            if Dmin < envmin:
-                e1 = Dmin - 1
-            else:
-                e1 = envmin - 1
-            if Dmax > envmax:
-                e2 = Dmax + 1
-            else:
-                e2 = envmax + 1
 
-            a1 = np.hstack([(e1), np.array(sstval.T[0])[0, :]])
-            a2 = np.hstack([np.array(sstval.T[0])[0, :] - 1, (e2)])
-            b1 = np.hstack([(0), c])
-
-            fd2, tmprule = tempfile.mkstemp(suffix=ipn[i])
-            with open(tmprule, "w") as text_file:
-                for k in np.arange(0, len(b1.T)):
-                    text_file.write(
-                        "%s:%s:%s\n" % (str(int(a1[k])), str(int(a2[k])), str(b1[k]))
-                    )
-
-            # Create the recode layer and calculate the IES
-            compute_ies(tmprule, ipi[i], tmpf2, envmin, envmax)
-            gs.run_command(
-                "r.support",
-                map=ipi[i],
-                title="IES {}".format(REF[i]),
-                units="0-100 (relative score",
-                description="Environmental similarity {}".format(REF[i]),
-                loadhistory=tmphist,
-            )
-
-            # Clean up
-            os.close(fd2)
-            os.remove(tmprule)
-
-            # Change region back to original
-            gs.del_temp_region()
-
-    # Create the recode table - Reference distribution is vector
+    # Create the frequency tables - Reference distribution is vector
     else:
         vtl = ref_vect
 
@@ -429,10 +519,8 @@ def main(options, flags):
                 "GROUP BY {0} ORDER BY {0}"
             ).format(coln, tmpf0)
             volval = np.vstack(db.db_select(sql=sql3))
-            volval = volval.astype(np.float, copy=False)
-            a = np.cumsum(volval[:, 1], axis=0)
+            volval = volval.astype(np.float64, copy=False)
             b = np.sum(volval[:, 1], axis=0)
-            c = a / b * 100
 
             # Check for point without values
             if b < cn:
@@ -444,74 +532,11 @@ def main(options, flags):
                     )
                 )
 
-            # Set region to env_proj layers (if different from env) and remove
-            # mask (if set above)
+            # Remove mask (if set above)
             if citiam["fullname"]:
                 gs.run_command("r.mask", quiet=True, flags="r")
-            if RP:
-                gs.use_temp_region()
-                gs.run_command("g.region", quiet=True, raster=PROJ[0])
-            region_2 = gs.parse_command("g.region", flags="g")
-
-            # Multiply env_proj layer with dignum
-            tmpf2 = tmpname("tmp8")
-            gs.mapcalc(
-                "$tmpf2 = int($dignum * $inplay)",
-                tmpf2=tmpf2,
-                inplay=PROJ[m],
-                dignum=digits2,
-                quiet=True,
-            )
-
-            # Calculate min and max values of sample points and raster layer
-            envmin = int(min(volval[:, 0]) * digits2)
-            envmax = int(max(volval[:, 0]) * digits2)
-            Drange = gs.read_command("r.info", flags="r", map=tmpf2)
-            Drange = str.splitlines(Drange)
-            Drange = np.hstack([i.split("=") for i in Drange])
-            Dmin = int(Drange[1])
-            Dmax = int(Drange[3])
-
-            if Dmin < envmin:
-                e1 = Dmin - 1
-            else:
-                e1 = envmin - 1
-            if Dmax > envmax:
-                e2 = Dmax + 1
-            else:
-                e2 = envmax + 1
-
-            a0 = volval[:, 0] * digits2
-            a0 = a0.astype(np.int, copy=False)
-            a1 = np.hstack([(e1), a0])
-            a2 = np.hstack([a0 - 1, (e2)])
-            b1 = np.hstack([(0), c])
-
-            fd3, tmprule = tempfile.mkstemp(suffix=ipn[m])
-            with open(tmprule, "w") as text_file:
-                for k in np.arange(0, len(b1)):
-                    rtmp = "{}:{}:{}\n".format(
-                        str(int(a1[k])), str(int(a2[k])), str(b1[k])
-                    )
-                    text_file.write(rtmp)
-
-            # Create the recode layer and calculate the IES
-            compute_ies(tmprule, ipi[m], tmpf2, envmin, envmax)
-            gs.run_command(
-                "r.support",
-                map=ipi[m],
-                title="IES {}".format(REF[m]),
-                units="0-100 (relative score",
-                description="Environmental similarity {}".format(REF[m]),
-                loadhistory=tmphist,
-            )
-
-            # Clean up
-            os.close(fd3)
-            os.remove(tmprule)
 
-            # Change region back to original
-            gs.del_temp_region()
+            tables[m] = frequency_table(np.trunc(volval[:, 0] * digits2), volval[:, 1])
 
     # Calculate MESS statistics
     # Set region to env_proj layers (if different from env)
@@ -520,9 +545,67 @@ def main(options, flags):
     # There will be a warning.
     if RP:
         gs.run_command("g.region", quiet=True, raster=PROJ[0])
+    region_2 = gs.parse_command("g.region", flags="g")
+
+    # The IES and all statistics are computed in one pass over the
+    # projected layers
+    mod1 = "{}_novel".format(opl)
+    mod2 = "{}_MoD".format(opl)
+    mod3 = "{}_SumNeg".format(opl)
+    mod4 = "{}_CountNeg".format(opl)
+    outputs = [(opc, "DCELL")]
+    if not fli:
+        outputs.extend((name, "DCELL") for name in ipi)
+    if fln:
+        outputs.append((mod1, "CELL"))
+    if flm:
+        outputs.append((mod2, "CELL"))
+    if flk:
+        outputs.append((mod3, "DCELL"))
+    if flc:
+        outputs.append((mod4, "CELL"))
+    rasters = {}
+    try:
+        for name, mtype in outputs:
+            rasters[name] = RasterRow(name)
+            rasters[name].open("w", mtype, overwrite=gs.overwrite())
+        blocks = stack_blocks(PROJ, raster_window())
+        for result in map_blocks(mess_block, blocks, (tables, digits2), nprocs):
+            put_rows(rasters[opc], result["mes"])
+            if not fli:
+                for i, name in enumerate(ipi):
+                    put_rows(rasters[name], result["ies"][i])
+            if fln:
+                with np.errstate(invalid="ignore"):
+                    novel = np.where(result["mes"] < 0, 1, 0).astype(np.float64)
+                novel[np.isnan(result["mes"])] = np.nan
+                put_rows(rasters[mod1], novel)
+            if flm:
+                put_rows(rasters[mod2], result["mod"])
+            if flk:
+                put_rows(rasters[mod3], result["sumneg"])
+            if flc:
+                put_rows(rasters[mod4], result["countneg"].astype(np.float64))
+    finally:
+        for raster in rasters.values():
+            raster.close()
+
+    # Write IES layers metadata
+    if not fli:
+        for i in xrange(len(REF)):
+            gs.write_command(
+                "r.colors", map=ipi[i], rules="-", stdin=COLORS_MES, quiet=True
+            )
+            gs.run_command(
+                "r.support",
+                map=ipi[i],
+                title="IES {}".format(REF[i]),
+                units="0-100 (relative score",
+                description="Environmental similarity {}".format(REF[i]),
+                loadhistory=tmphist,
+            )
 
     # MES
-    gs.run_command("r.series", quiet=True, output=opc, input=ipi, method="minimum")
     gs.write_command("r.colors", map=opc, rules="-", stdin=COLORS_MES, quiet=True)
 
     # Write layer metadata
@@ -537,9 +620,6 @@ def main(options, flags):
 
     # Area with negative MES
     if fln:
-        mod1 = "{}_novel".format(opl)
-        gs.mapcalc("$mod1 = int(if( $opc < 0, 1, 0))", mod1=mod1, opc=opc, quiet=True)
-
         # Write category labels
         gs.write_command(
             "r.category", map=mod1, rules="-", stdin=RECL_MESNEG, quiet=True
@@ -558,13 +638,6 @@ def main(options, flags):
 
     # Most dissimilar variable (MoD)
     if flm:
-        tmpf4 = tmpname("tmp9")
-        mod2 = "{}_MoD".format(opl)
-        gs.run_command(
-            "r.series", quiet=True, output=tmpf4, input=ipi, method="min_raster"
-        )
-        gs.mapcalc("$mod2 = int($tmpf4)", mod2=mod2, tmpf4=tmpf4, quiet=True)
-
         fd4, tmpcat = tempfile.mkstemp()
         with open(tmpcat, "w") as text_file:
             for cats in xrange(len(ipi)):
@@ -586,16 +659,6 @@ def main(options, flags):
 
     # sum(IES), where IES < 0
     if flk:
-        mod3 = "{}_SumNeg".format(opl)
-        c0 = -0.01 / digits2
-        gs.run_command(
-            "r.series",
-            quiet=True,
-            input=ipi,
-            method="sum",
-            range=("-inf", c0),
-            output=mod3,
-        )
         gs.write_command("r.colors", map=mod3, rules="-", stdin=COLORS_MES, quiet=True)
 
         # Write layer metadata
@@ -611,22 +674,6 @@ def main(options, flags):
 
     # Number of layers with negative values
     if flc:
-        tmpf5 = tmpname("tmp10")
-        mod4 = "{}_CountNeg".format(opl)
-        MinMes = gs.read_command("r.info", quiet=True, flags="r", map=opc)
-        MinMes = str.splitlines(MinMes)
-        MinMes = float(np.hstack([i.split("=") for i in MinMes])[1])
-        c0 = -0.0001 / digits2
-        gs.run_command(
-            "r.series",
-            quiet=True,
-            input=ipi,
-            output=tmpf5,
-            method="count",
-            range=(MinMes, c0),
-        )
-        gs.mapcalc("$mod4 = int($tmpf5)", mod4=mod4, tmpf5=tmpf5, quiet=True)
-
         # Write layer metadata
         gs.run_command(
             "r.support",
@@ -638,9 +685,6 @@ def main(options, flags):
             loadhistory=tmphist,
         )
 
-    # Remove IES layers
-    if fli:
-        gs.run_command("g.remove", quiet=True, flags="f", type="raster", name=ipi)
     # Clean up tmp file
     os.remove(tmphist)
 
@@ -67,19 +67,35 @@ if "GISBASE" not in os.environ:
 import grass.script as grass
 from grass.pygrass import raster
 from grass.pygrass.gis.region import Region
+from grass.pygrass.raster.buffer import Buffer
 
 CNULL = -2147483648  # null value for CELL maps
 FNULL = np.nan  # null value for FCELL and DCELL maps
 
 
-def get_val_or_null(map, row, col):
+def get_row_or_null(map, row):
     """
-    Return map value of the cell or FNULL (if the cell is null)
+    Return map values of the row as a float array, with FNULL in the
+    null cells
     """
-    value = map.get(row, col)
-    if map.mtype == "CELL" and value == CNULL:
-        value = FNULL
-    return value
+    values = np.array(map[row], dtype=np.float64)
+    if map.mtype == "CELL":
+        values[values == CNULL] = FNULL
+    return values
+
+
+def fit_ols(y, x):
+    """Ordinary least squares of a batch of samples without null values.
+
+    :param x:   KxMxN array: MxN matrices of data points of K pixels
+    :param x:   numpy.array
+    :param y:   KxM array: vectors of M output values of K pixels
+    :param y:   numpy.array
+    :return:    KxN array of the coefficients b of each pixel (x * b = y)
+    """
+    # the pseudoinverse (as statsmodels' OLS does) gives a solution for
+    # rank deficient systems too
+    return np.einsum("kij,kj->ki", np.linalg.pinv(x), y)
 
 
 def fit(y, x, model="ols"):
@@ -124,7 +140,7 @@ def get_sample_names(filename, delimiter=","):
     """
     with open(filename) as settings:
         reader = csv.reader(settings, delimiter=delimiter)
-        headers = reader.next()
+        headers = next(reader)
         inputs = []
         outputs = []
         for row in reader:
@@ -179,7 +195,7 @@ class DataModel(object):
 
     def _init_rasters(self):
         for name in self.y_names:
-            map = raster.RasterSegment(name)
+            map = raster.RasterRow(name)
             if not map.exist():
                 raise ValueError("Raster map %s doesn't exist" % (name,))
             self._y_rasters.append(map)
@@ -187,7 +203,7 @@ class DataModel(object):
         for names in self.x_names:
             maps = []
             for name in names:
-                map = raster.RasterSegment(name)
+                map = raster.RasterRow(name)
                 if not map.exist():
                     raise ValueError("Raster map %s doesn't exist" % (name,))
                 maps.append(map)
@@ -199,7 +215,7 @@ class DataModel(object):
         # Rasters of the regression coefitients
         for i in range(self.factor_count):
             name = self.b_names[i]
-            map = raster.RasterSegment(name)
+            map = raster.RasterRow(name)
             self._b_rasters.append(map)
 
     def open_rasters(self, overwrite):
@@ -226,31 +242,70 @@ class DataModel(object):
                 map = self.x(i, j)
                 map.close()
 
-    def get_sample(self, row, col):
-        """Return X and Y matrices for one pixel sample"""
-        X = np.empty((self.sample_count, self.factor_count))
-        Y = np.empty(self.sample_count)
-        for snum in range(self.sample_count):
-            y = self.y(snum)
-            Y[snum] = get_val_or_null(y, row, col)
-            for fnum in range(self.factor_count):
-                x = self.x(snum, fnum)
-                X[snum, fnum] = get_val_or_null(x, row, col)
+    def get_samples(self, row):
+        """Return X and Y arrays for all the pixels of one row:
+        X is (cols x samples x factors), Y is (cols x samples)
+        """
+        Y = np.column_stack(
+            [get_row_or_null(self.y(snum), row) for snum in range(self.sample_count)]
+        )
+        X = np.stack(
+            [
+                np.column_stack(
+                    [
+                        get_row_or_null(self.x(snum, fnum), row)
+                        for fnum in range(self.factor_count)
+                    ]
+                )
+                for snum in range(self.sample_count)
+            ],
+            axis=1,
+        )
 
         return Y, X
 
+    def fit_row(self, Y, X, model="ols"):
+        """Return the coefficients (cols x factors) of all the pixels of a row.
+
+        OLS problems of the pixels without nulls are solved at once,
+        the others (and all the RLM problems) pixel by pixel.
+        """
+        coefs = np.full((Y.shape[0], self.factor_count), FNULL)
+        if model == "ols":
+            complete = ~np.logical_or(
+                np.isnan(Y).any(axis=1), np.isnan(X).any(axis=(1, 2))
+            )
+            if self.sample_count < self.factor_count:
+                complete[:] = False
+            if complete.any():
+                try:
+                    coefs[complete] = fit_ols(Y[complete], X[complete])
+                except LinAlgError:
+                    complete[:] = False
+            pixels = np.flatnonzero(~complete)
+        else:
+            pixels = range(Y.shape[0])
+        for c in pixels:
+            coefs[c] = fit(Y[c], X[c], model)
+
+        return coefs
+
     def fit(self, model="ols", overwrite=None):
+        if model not in ("ols", "rlm"):
+            raise NotImplementedError("Model %s doesn't implemented" % (model,))
         try:
             reg = Region()
             self.open_rasters(overwrite=overwrite)
             rows, cols = reg.rows, reg.cols
+            buffers = [
+                Buffer((cols,), mtype=self.mtype) for i in range(self.factor_count)
+            ]
             for r in range(rows):
-                for c in range(cols):
-                    Y, X = self.get_sample(r, c)
-                    coefs = fit(Y, X, model)
-                    for i in range(self.factor_count):
-                        b = self.b(i)
-                        b.put(r, c, coefs[i])
+                Y, X = self.get_samples(r)
+                coefs = self.fit_row(Y, X, model)
+                for i in range(self.factor_count):
+                    buffers[i][:] = coefs[:, i]
+                    self.b(i).put_row(buffers[i])
         finally:
             self.close_rasters()
 
@@ -107,10 +107,21 @@
 #% description: Number of iterations
 #% answer: 1
 #%end
+#%option
+#% key: nprocs
+#% type: integer
+#% required: no
+#% multiple: no
+#% description: Number of processes used for filtering
+#% options: 1-
+#% answer: 1
+#%end
 
 
 import os
 import sys
+from collections import deque
+from multiprocessing import Pool
 
 if "GISBASE" not in os.environ:
     sys.stderr.write("You must be in GRASS GIS to run this program.\n")
@@ -129,14 +140,16 @@ import numpy as np
 CNULL = -2147483648  # null value for CELL maps
 FNULL = np.nan  # null value for FCELL and DCELL maps
 
+BLOCK_SIZE = 2 ** 22  # count of values (maps x cells) in a block of rows
 
-def init_rasters(names, mapset=""):
+
+def init_rasters(names, mapset="", rtype=raster.RasterSegment):
     """Get list of raster names,
     return array of the rasters
     """
     rasters = []
     for name in names:
-        r = raster.RasterSegment(name, mapset=mapset)
+        r = rtype(name, mapset=mapset)
         rasters.append(r)
     return rasters
 
@@ -161,88 +174,117 @@ def close_rasters(raster_list):
             r.close()
 
 
-def _filter_up(method, arr, winsize, order):
-    """Filter array using algorithm from the next article:
+def _smooth(method, data, winsize, order):
+    """Filter all the time series (columns) of data at once"""
+    if method == "savgol":
+        return savgol_filter(data, winsize, order, axis=0, mode="nearest")
+    elif method == "median":
+        return medfilt(data, kernel_size=(winsize, 1))
+    else:
+        grass.fatal("The method is not implemented")
+
+
+def _filter_up(method, data, winsize, order):
+    """Filter the time series (columns) of data using algorithm from the
+    next article:
     Chen, Jin, et al. "A simple method for reconstructing a high-quality
     NDVI time-series data set based on the Savitzky–Golay filter."
     Remote sensing of Environment 91.3 (2004): 332-344.
     """
+    _, cols = data.shape
 
-    size = len(arr)
-
-    old_f = np.inf  # Filter fitting index for previose iteration
-    cur_f = np.inf  # Filter fitting index for current iteration
-    wk = np.empty(size)  # Weights array
-    init_arr = np.copy(arr)
+    old_f = np.full(cols, np.inf)  # Filter fitting index for previose iteration
+    cur_f = np.full(cols, np.inf)  # Filter fitting index for current iteration
+    init_data = np.copy(data)
+    result = np.copy(data)
+    active = np.ones(cols, dtype=bool)  # The optimum is not found yet
 
     while winsize > order + 2:  # We don't want fit for too small window size
-        if method == "savgol":
-            trend = savgol_filter(arr, winsize, order, mode="nearest")
-        elif method == "median":
-            trend = medfilt(arr, kernel_size=winsize)
-        else:
-            grass.fatal("The method is not implemented")
+        idx = np.flatnonzero(active)
+        arr = data[:, idx]
+        trend = _smooth(method, arr, winsize, order)
 
         # Weights
-        # import ipdb; ipdb.set_trace()
-        difference = trend - init_arr
-        max_diff = np.max(difference)
-        for i in range(size):
-            wk[i] = 1.0 if difference[i] <= 0 else 1.0 - difference[i] / max_diff
+        difference = trend - init_data[:, idx]
+        max_diff = np.max(difference, axis=0)
+        rising = difference > 0
+        with np.errstate(divide="ignore", invalid="ignore"):
+            wk = np.where(rising, 1.0 - difference / max_diff, 1.0)
 
-        old_arr = np.copy(arr)
-        for i in range(size):
-            arr[i] = arr[i] if difference[i] <= 0 else trend[i]
+        result[:, idx] = arr
+        data[:, idx] = np.where(rising, trend, arr)
 
         # Fitting index and exit criteria
-        f = np.sum(np.abs(difference) * wk)
-        if old_f > cur_f < f:
-            # The optimm was found on previous iteration
-            # old_arr contains the optimal results
-            return old_arr
-
-        old_f = cur_f
-        cur_f = f
+        f = np.sum(np.abs(difference) * wk, axis=0)
+        # The optimum was found on previous iteration
+        # result contains the optimal results
+        found = (old_f[idx] > cur_f[idx]) & (cur_f[idx] < f)
+        active[idx[found]] = False
+        if not active.any():
+            break
+
+        old_f[idx] = cur_f[idx]
+        cur_f[idx] = f
         winsize -= 2
-    return old_arr
+    return result
 
 
 def _filter(method, row_data, winsize, order, itercount, fit_up):
-    result = np.empty(row_data.shape)
-    _, cols = row_data.shape
-    for i in range(cols):
-        arr = row_data[:, i]
-        if not all(np.isnan(arr)):
-            arr = _fill_nulls(arr)
-            if fit_up:
-                arr = _filter_up(method, arr, winsize, order)
-            else:
-                if method == "savgol":
-                    for j in range(itercount):
-                        arr = savgol_filter(arr, winsize, order, mode="nearest")
-                elif method == "median":
-                    for j in range(itercount):
-                        arr = medfilt(arr, kernel_size=winsize)
-                else:
-                    grass.fatal("The method is not implemented")
-        result[:, i] = arr
+    """Filter the time series (columns) of row_data, shaped (time, cols)"""
+    result = np.full(row_data.shape, FNULL)
+    valid = ~np.isnan(row_data).all(axis=0)
+    if not valid.any():
+        return result
+
+    data = _fill_nulls(row_data[:, valid])
+    if fit_up:
+        data = _filter_up(method, data, winsize, order)
+    else:
+        for j in range(itercount):
+            data = _smooth(method, data, winsize, order)
+    result[:, valid] = data
 
     return result
 
 
-def _non_zero(x):
-    return x.nonzero()[0]
+def _filter_block(args):
+    """Filter a block of rows, shaped (time, rows, cols)"""
+    block, method, winsize, order, itercount, fit_up = args
+    time, rows, cols = block.shape
+    block = block.reshape((time, rows * cols))
+    block = _filter(method, block, winsize, order, itercount, fit_up)
+    return block.reshape((time, rows, cols))
 
 
-def _fill_nulls(arr):
-    """Fill no-data values in arr
+def _fill_nulls(data):
+    """Fill no-data values in the time series (columns) of data by linear
+    interpolation, columns without data are kept as they are
     Return np.array with filled data
     """
-    nans = np.isnan(arr)
-    if not all(nans):
-        arr[nans] = np.interp(_non_zero(nans), _non_zero(~nans), arr[~nans])
-
-    return arr
+    nans = np.isnan(data)
+    if not nans.any():
+        return data
+
+    size, cols = data.shape
+    steps = np.arange(size)[:, None]
+    # Previous and next step with data, the first and the last data
+    # are repeated at the ends of the series
+    prev = np.maximum.accumulate(np.where(nans, -1, steps), axis=0)
+    following = np.minimum.accumulate(np.where(nans, size, steps)[::-1], axis=0)[::-1]
+    prev, following = (
+        np.where(prev < 0, following, prev),
+        np.where(following == size, prev, following),
+    )
+    prev[:, np.all(nans, axis=0)] = 0
+    following[:, np.all(nans, axis=0)] = 0
+
+    columns = np.arange(cols)
+    start = data[prev, columns]
+    end = data[following, columns]
+    span = following - prev
+    weight = np.where(span > 0, (steps - prev) / np.maximum(span, 1), 0)
+
+    return np.where(nans, start + (end - start) * weight, data)
 
 
 def fitting_quality(input_data, fitted_data, diff_penalty=1.0, deriv_penalty=1.0):
@@ -316,7 +358,7 @@ def _optimize_savgol(input_data, diff_penalty, deriv_penalty, itercount):
     map_count, npoints = input_data.shape
     best = np.inf
     best_winsize = best_order = None
-    for winsize in range(5, map_count / 2, 2):
+    for winsize in range(5, map_count // 2, 2):
         for order in range(
             2, min(winsize - 2, 10)
         ):  # 10 is a 'magic' number: we don't want very hight polynomyal fitting usually
@@ -340,7 +382,7 @@ def _optimize_median(input_data, diff_penalty, deriv_penalty, itercount):
     map_count, npoints = input_data.shape
     best = np.inf
     best_winsize = order = None
-    for winsize in range(3, map_count / 2, 2):
+    for winsize in range(3, map_count // 2, 2):
         test_data = np.copy(input_data)
         test_data = _filter("median", test_data, winsize, order, itercount, False)
         penalty = fitting_quality(input_data, test_data, diff_penalty, deriv_penalty)
@@ -351,29 +393,49 @@ def _optimize_median(input_data, diff_penalty, deriv_penalty, itercount):
     return best_winsize
 
 
-def filter(method, names, winsize, order, prefix, itercount, fit_up):
+def filter(method, names, winsize, order, prefix, itercount, fit_up, nprocs=1):
 
     current_mapset = grass.read_command("g.mapset", flags="p")
     current_mapset = current_mapset.strip()
 
-    inputs = init_rasters(names)
+    inputs = init_rasters(names, rtype=raster.RasterRow)
     output_names = [prefix + name for name in names]
-    outputs = init_rasters(output_names, mapset=current_mapset)
+    outputs = init_rasters(output_names, mapset=current_mapset, rtype=raster.RasterRow)
+    pool = Pool(nprocs) if nprocs > 1 else None
     try:
         open_rasters(outputs, write=True)
         open_rasters(inputs)
 
         reg = Region()
-        for i in range(reg.rows):
-            # import ipdb; ipdb.set_trace()
-            row_data = np.array([_get_row_or_nan(r, i) for r in inputs])
-            filtered_rows = _filter(method, row_data, winsize, order, itercount, fit_up)
+        block_rows = max(1, BLOCK_SIZE // (len(inputs) * reg.cols))
+
+        def write_block(filtered_block):
             for map_num in range(len(outputs)):
                 map = outputs[map_num]
-                row = filtered_rows[map_num, :]
-                buf = Buffer(row.shape, map.mtype, row)
-                map.put_row(i, buf)
+                for row in filtered_block[map_num]:
+                    buf = Buffer(row.shape, map.mtype, row)
+                    map.put_row(buf)
+
+        pending = deque()
+        for start in range(0, reg.rows, block_rows):
+            rows = range(start, min(start + block_rows, reg.rows))
+            block = np.array(
+                [[_get_row_or_nan(r, i) for i in rows] for r in inputs],
+                dtype=np.float64,
+            )
+            args = (block, method, winsize, order, itercount, fit_up)
+            if pool is None:
+                write_block(_filter_block(args))
+                continue
+            # Keep at most two blocks per process in memory
+            pending.append(pool.apply_async(_filter_block, (args,)))
+            if len(pending) >= 2 * nprocs:
+                write_block(pending.popleft().get())
+        while pending:
+            write_block(pending.popleft().get())
     finally:
+        if pool is not None:
+            pool.terminate()
         close_rasters(outputs)
         close_rasters(inputs)
 
@@ -394,7 +456,7 @@ def _get_row_or_nan(raster, row_num):
         return row
     nans = row == CNULL
     row = row.astype(np.float64)
-    row[nans.astype(np.bool)] = np.nan
+    row[nans] = np.nan
     return row
 
 
@@ -430,6 +492,8 @@ def main(options, flags):
 
     res_prefix = options["result_prefix"]
 
+    nprocs = int(options["nprocs"])
+
     N = len(xnames)
     if N < winsize:
         grass.fatal(
@@ -450,7 +514,7 @@ def main(options, flags):
         if winsize is None:
             grass.fatal("Optimization procedure doesn't convergence.")
 
-    filter(method, xnames, winsize, order, res_prefix, itercount, fit_up)
+    filter(method, xnames, winsize, order, res_prefix, itercount, fit_up, nprocs)
 
 
 if __name__ == "__main__":
@@ -86,6 +86,11 @@
 #% description: Openness considers zenith angles > 90 degrees
 #%end
 #%flag
+#% key: c
+#% label: Reuse horizon maps cached in the current mapset
+#% description: Horizon maps are computed once for the same input, region, number of directions and maximum distance
+#%end
+#%flag
 #% key: n
 #% label: Invert color table for colorization raster
 #% description: Ignored for input and color_input
@@ -95,7 +100,9 @@
 
 import sys
 import os
+import math
 import atexit
+import hashlib
 
 from grass.exceptions import CalledModuleError
 import grass.script.core as gcore
@@ -180,19 +187,29 @@ def main():
     if not gcore.overwrite() and color_raster_tmp:
         check_map_name(color_raster_tmp)
     try:
-        params = {}
-        if options["maxdistance"]:
-            params["maxdistance"] = options["maxdistance"]
-        gcore.run_command(
-            "r.horizon",
-            elevation=elev,
-            step=horizon_step,
-            output=TMP_NAME,
-            flags="d",
-            **params
-        )
+        if flags["c"]:
+            # cached horizon maps are in radians
+            new_maps = _get_horizon_maps(
+                horizon_cache(elev, horizon_step, options["maxdistance"])
+            )
+            new_maps = [
+                "({name} * {deg})".format(name=name, deg=math.degrees(1))
+                for name in new_maps
+            ]
+        else:
+            params = {}
+            if options["maxdistance"]:
+                params["maxdistance"] = options["maxdistance"]
+            gcore.run_command(
+                "r.horizon",
+                elevation=elev,
+                step=horizon_step,
+                output=TMP_NAME,
+                flags="d",
+                **params
+            )
+            new_maps = _get_horizon_maps()
 
-        new_maps = _get_horizon_maps()
         if flags["o"]:
             msgr.message(_("Computing openness ..."))
             expr = "{out} = 1 - (sin({first}) ".format(first=new_maps[0], out=output)
@@ -248,8 +265,65 @@ def main():
     return 0
 
 
-def _get_horizon_maps():
-    return gcore.list_grouped("rast", pattern=TMP_NAME + "*")[gcore.gisenv()["MAPSET"]]
+def horizon_cache(elevation, step, maxdistance=None):
+    """
+    Return the base name of the horizon maps (in radians) of the elevation
+    map for the current region, step and maximum distance, computing them
+    with r.horizon only if they are not cached in the current mapset yet.
+
+    The base name is a hash of the elevation map (name and modification
+    of its data files), the region, the step and the maximum distance.
+    """
+    found = gcore.find_file(elevation, element="cell")
+    if not found["file"]:
+        gcore.fatal(_("Raster map <{}> not found").format(elevation))
+    key = [found["fullname"]]
+    for data in (
+        found["file"],
+        found["file"].replace(os.sep + "cell" + os.sep, os.sep + "fcell" + os.sep),
+    ):
+        if os.path.exists(data):
+            stat = os.stat(data)
+            key.append((stat.st_size, stat.st_mtime))
+    key.append(sorted(gcore.region().items()))
+    key.append(float(step))
+    key.append(float(maxdistance) if maxdistance else None)
+    basename = (
+        "horizon_cache_" + hashlib.sha1(repr(key).encode("utf-8")).hexdigest()[:16]
+    )
+
+    # r.horizon computes one map for each angle in [0, 360)
+    directions = 0
+    angle = 0.0
+    while angle < 360.0:
+        directions += 1
+        angle += float(step)
+    mapset = gcore.gisenv()["MAPSET"]
+    cached = gcore.list_grouped("raster", pattern=basename + "_*")[mapset]
+    if len(cached) == directions:
+        gcore.verbose(_("Using cached horizon maps <{}>").format(basename))
+        return basename
+
+    gcore.info(_("Computing horizon maps <{}>...").format(basename))
+    params = {}
+    if maxdistance:
+        params["maxdistance"] = maxdistance
+    gcore.run_command(
+        "r.horizon",
+        elevation=elevation,
+        step=step,
+        output=basename,
+        overwrite=True,
+        quiet=True,
+        **params
+    )
+    return basename
+
+
+def _get_horizon_maps(basename=None):
+    if basename is None:
+        basename = TMP_NAME
+    return gcore.list_grouped("rast", pattern=basename + "*")[gcore.gisenv()["MAPSET"]]
 
 
 def check_map_name(name):
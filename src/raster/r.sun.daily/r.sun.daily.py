@@ -118,7 +118,8 @@
 #% key_desc: stepsize
 #% type: string
 #% gisprompt: old,cell,raster
-#% description: Angle step size for multidirectional horizon [degrees]
+#% label: Angle step size for multidirectional horizon [degrees]
+#% description: Without horizon_basename, horizon maps are computed once and cached in the current mapset
 #% required : no
 #%end
 
@@ -273,10 +274,12 @@
 
 import os
 import atexit
-from multiprocessing import Process
+import hashlib
+from multiprocessing import Pool
 
 import grass.script as grass
 import grass.script.core as core
+from grass.exceptions import CalledModuleError
 
 
 REMOVE = []
@@ -391,6 +394,61 @@ def run_r_sun(
     )
 
 
+def horizon_cache(elevation, step, maxdistance=None):
+    """
+    Return the base name of the horizon maps (in radians) of the elevation
+    map for the current region, step and maximum distance, computing them
+    with r.horizon only if they are not cached in the current mapset yet.
+
+    The base name is a hash of the elevation map (name and modification
+    of its data files), the region, the step and the maximum distance.
+    """
+    found = grass.find_file(elevation, element="cell")
+    if not found["file"]:
+        grass.fatal(_("Raster map <{}> not found").format(elevation))
+    key = [found["fullname"]]
+    for data in (
+        found["file"],
+        found["file"].replace(os.sep + "cell" + os.sep, os.sep + "fcell" + os.sep),
+    ):
+        if os.path.exists(data):
+            stat = os.stat(data)
+            key.append((stat.st_size, stat.st_mtime))
+    key.append(sorted(grass.region().items()))
+    key.append(float(step))
+    key.append(float(maxdistance) if maxdistance else None)
+    basename = (
+        "horizon_cache_" + hashlib.sha1(repr(key).encode("utf-8")).hexdigest()[:16]
+    )
+
+    # r.horizon computes one map for each angle in [0, 360)
+    directions = 0
+    angle = 0.0
+    while angle < 360.0:
+        directions += 1
+        angle += float(step)
+    mapset = grass.gisenv()["MAPSET"]
+    cached = grass.list_grouped("raster", pattern=basename + "_*")[mapset]
+    if len(cached) == directions:
+        grass.verbose(_("Using cached horizon maps <{}>").format(basename))
+        return basename
+
+    grass.info(_("Computing horizon maps <{}>...").format(basename))
+    params = {}
+    if maxdistance:
+        params["maxdistance"] = maxdistance
+    grass.run_command(
+        "r.horizon",
+        elevation=elevation,
+        step=step,
+        output=basename,
+        overwrite=True,
+        quiet=True,
+        **params
+    )
+    return basename
+
+
 def set_color_table(rasters):
     """
     Set 'gyr' color tables for raster maps
@@ -430,14 +488,65 @@ def check_daily_map_names(basename, mapset, start_day, end_day, day_step):
             )
 
 
-def sum_maps(sum_, basename, suffixes):
+def fold_maps(sum_, basename, suffixes, remove=False):
     """
-    Sum up multiple raster maps
+    Add raster maps to the running sum, optionally removing them afterwards
     """
-    maps = "+".join([basename + suf for suf in suffixes])
-    grass.mapcalc(
-        "{sum_} = {new}".format(sum_=sum_, new=maps), overwrite=True, quiet=True
-    )
+    maps = "+".join([sum_] + [basename + suf for suf in suffixes])
+    tmp = create_tmp_map_name("sum")
+    grass.mapcalc("{tmp} = {new}".format(tmp=tmp, new=maps), overwrite=True, quiet=True)
+    grass.run_command("g.rename", raster=[tmp, sum_], overwrite=True, quiet=True)
+    if remove:
+        grass.run_command(
+            "g.remove",
+            type="raster",
+            name=[basename + suf for suf in suffixes],
+            flags="f",
+            quiet=True,
+        )
+
+
+def run_r_sun_task(task):
+    """
+    Run r.sun in a worker process, return the suffix of the outputs and
+    whether r.sun succeeded
+    """
+    suffix, args = task
+    try:
+        run_r_sun(*args)
+    except CalledModuleError:
+        return suffix, False
+    return suffix, True
+
+
+def run_r_sun_pool(tasks, nprocs, sums):
+    """
+    Run r.sun for all tasks keeping nprocs processes busy, adding the
+    outputs to the running sums as soon as they are available.
+
+    sums is a list of (sum map, base name of the added maps, whether
+    to remove the added maps)
+    """
+    num_tasks = len(tasks)
+    pending = []
+    core.percent(0, num_tasks, 1)
+    pool = Pool(nprocs)
+    try:
+        results = pool.imap_unordered(run_r_sun_task, tasks)
+        for count, (suffix, success) in enumerate(results, 1):
+            if not success:
+                core.fatal(_("Error while r.sun computation"))
+            core.percent(count, num_tasks, 10)
+            pending.append(suffix)
+            # fold a batch of outputs while the next ones are computed
+            if len(pending) >= nprocs or count == num_tasks:
+                for sum_, basename, remove in sums:
+                    fold_maps(sum_, basename, pending, remove)
+                pending = []
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
 
 
 def main():
@@ -571,6 +680,10 @@ def main():
             "r.slope.aspect", elevation=elevation_input, quiet=True, **params
         )
 
+    # compute (or reuse) horizon maps instead of terrain shading in each run
+    if horizon_step and not horizon_basename and not flags["p"]:
+        horizon_basename = horizon_cache(elevation_input, horizon_step)
+
     if beam_rad:
         grass.mapcalc("{beam} = 0".format(beam=beam_rad), quiet=True)
     if diff_rad:
@@ -589,23 +702,15 @@ def main():
         rsun_flags += "p"
 
     grass.info(_("Running r.sun in a loop..."))
-    count = 0
-    # Parallel processing
-    proc_list = []
-    proc_count = 0
+    tasks = []
     suffixes_all = []
     days = range(start_day, end_day + 1, day_step)
-    num_days = len(days)
-    core.percent(0, num_days, 1)
     for day in days:
-        count += 1
-        core.percent(count, num_days, 10)
-
         suffix = "_" + format_order(day)
-        proc_list.append(
-            Process(
-                target=run_r_sun,
-                args=(
+        tasks.append(
+            (
+                suffix,
+                (
                     elevation_input,
                     aspect_input,
                     slope_input,
@@ -630,34 +735,22 @@ def main():
                 ),
             )
         )
-
-        proc_list[proc_count].start()
-        proc_count += 1
         suffixes_all.append(suffix)
 
-        if proc_count == nprocs or proc_count == num_days or count == num_days:
-            proc_count = 0
-            exitcodes = 0
-            for proc in proc_list:
-                proc.join()
-                exitcodes += proc.exitcode
-
-            if exitcodes != 0:
-                core.fatal(_("Error while r.sun computation"))
-
-            # Empty process list
-            proc_list = []
-
-    if beam_rad:
-        sum_maps(beam_rad, beam_rad_basename, suffixes_all)
-    if diff_rad:
-        sum_maps(diff_rad, diff_rad_basename, suffixes_all)
-    if refl_rad:
-        sum_maps(refl_rad, refl_rad_basename, suffixes_all)
-    if glob_rad:
-        sum_maps(glob_rad, glob_rad_basename, suffixes_all)
-    if insol_time:
-        sum_maps(insol_time, insol_time_basename, suffixes_all)
+    # daily maps are added to the sums as they are computed,
+    # and removed unless the user asked for them
+    sums = [
+        (sum_, basename, not basename_user)
+        for sum_, basename, basename_user in (
+            (beam_rad, beam_rad_basename, beam_rad_basename_user),
+            (diff_rad, diff_rad_basename, diff_rad_basename_user),
+            (refl_rad, refl_rad_basename, refl_rad_basename_user),
+            (glob_rad, glob_rad_basename, glob_rad_basename_user),
+            (insol_time, insol_time_basename, insol_time_basename_user),
+        )
+        if sum_
+    ]
+    run_r_sun_pool(tasks, nprocs, sums)
 
     # FIXME: how percent really works?
     # core.percent(1, 1, 1)
@@ -168,6 +168,13 @@
 #% answer: 1.0
 #%end
 #%option
+#% key: horizon_step
+#% type: double
+#% required: no
+#% label: Angle step size for multidirectional horizon [degrees]
+#% description: Horizon maps are computed once and cached in the current mapset
+#%end
+#%option
 #% key: beam_rad_basename
 #% type: string
 #% label: Base name for output beam irradiance [W.m-2] (mode 1) or irradiation raster map [Wh.m-2] (mode 2)
@@ -257,7 +264,8 @@
 import os
 import datetime
 import atexit
-from multiprocessing import Process
+import hashlib
+from multiprocessing import Pool
 
 import grass.script as grass
 import grass.script.core as core
@@ -313,6 +321,8 @@ def run_r_sun(
     time_step,
     distance_step,
     solar_constant,
+    horizon_basename,
+    horizon_step,
     flags,
 ):
     params = {}
@@ -350,6 +360,9 @@ def run_r_sun(
         params.update({"distance_step": distance_step})
     if solar_constant is not None:
         params.update({"solar_constant": solar_constant})
+    if horizon_basename and horizon_step:
+        params.update({"horizon_basename": horizon_basename})
+        params.update({"horizon_step": horizon_step})
 
     grass.run_command(
         "r.sun",
@@ -392,6 +405,61 @@ def run_r_sun(
             )
 
 
+def horizon_cache(elevation, step, maxdistance=None):
+    """
+    Return the base name of the horizon maps (in radians) of the elevation
+    map for the current region, step and maximum distance, computing them
+    with r.horizon only if they are not cached in the current mapset yet.
+
+    The base name is a hash of the elevation map (name and modification
+    of its data files), the region, the step and the maximum distance.
+    """
+    found = grass.find_file(elevation, element="cell")
+    if not found["file"]:
+        grass.fatal(_("Raster map <{}> not found").format(elevation))
+    key = [found["fullname"]]
+    for data in (
+        found["file"],
+        found["file"].replace(os.sep + "cell" + os.sep, os.sep + "fcell" + os.sep),
+    ):
+        if os.path.exists(data):
+            stat = os.stat(data)
+            key.append((stat.st_size, stat.st_mtime))
+    key.append(sorted(grass.region().items()))
+    key.append(float(step))
+    key.append(float(maxdistance) if maxdistance else None)
+    basename = (
+        "horizon_cache_" + hashlib.sha1(repr(key).encode("utf-8")).hexdigest()[:16]
+    )
+
+    # r.horizon computes one map for each angle in [0, 360)
+    directions = 0
+    angle = 0.0
+    while angle < 360.0:
+        directions += 1
+        angle += float(step)
+    mapset = grass.gisenv()["MAPSET"]
+    cached = grass.list_grouped("raster", pattern=basename + "_*")[mapset]
+    if len(cached) == directions:
+        grass.verbose(_("Using cached horizon maps <{}>").format(basename))
+        return basename
+
+    grass.info(_("Computing horizon maps <{}>...").format(basename))
+    params = {}
+    if maxdistance:
+        params["maxdistance"] = maxdistance
+    grass.run_command(
+        "r.horizon",
+        elevation=elevation,
+        step=step,
+        output=basename,
+        overwrite=True,
+        quiet=True,
+        **params
+    )
+    return basename
+
+
 def set_color_table(rasters, binary=False):
     table = "gyr"
     if binary:
@@ -485,14 +553,65 @@ def format_grass_time(dt):
     )
 
 
-def sum_maps(sum_, basename, suffixes):
+def fold_maps(sum_, basename, suffixes, remove=False):
     """
-    Sum up multiple raster maps
+    Add raster maps to the running sum, optionally removing them afterwards
     """
-    maps = "+".join([basename + suf for suf in suffixes])
-    grass.mapcalc(
-        "{sum_} = {new}".format(sum_=sum_, new=maps), overwrite=True, quiet=True
-    )
+    maps = "+".join([sum_] + [basename + suf for suf in suffixes])
+    tmp = create_tmp_map_name("sum")
+    grass.mapcalc("{tmp} = {new}".format(tmp=tmp, new=maps), overwrite=True, quiet=True)
+    grass.run_command("g.rename", raster=[tmp, sum_], overwrite=True, quiet=True)
+    if remove:
+        grass.run_command(
+            "g.remove",
+            type="raster",
+            name=[basename + suf for suf in suffixes],
+            flags="f",
+            quiet=True,
+        )
+
+
+def run_r_sun_task(task):
+    """
+    Run r.sun in a worker process, return the suffix of the outputs and
+    whether r.sun succeeded
+    """
+    suffix, args = task
+    try:
+        run_r_sun(*args)
+    except CalledModuleError:
+        return suffix, False
+    return suffix, True
+
+
+def run_r_sun_pool(tasks, nprocs, sums):
+    """
+    Run r.sun for all tasks keeping nprocs processes busy, adding the
+    outputs to the running sums as soon as they are available.
+
+    sums is a list of (sum map, base name of the added maps, whether
+    to remove the added maps)
+    """
+    num_tasks = len(tasks)
+    pending = []
+    core.percent(0, num_tasks, 1)
+    pool = Pool(nprocs)
+    try:
+        results = pool.imap_unordered(run_r_sun_task, tasks)
+        for count, (suffix, success) in enumerate(results, 1):
+            if not success:
+                core.fatal(_("Error while r.sun computation"))
+            core.percent(count, num_tasks, 10)
+            pending.append(suffix)
+            # fold a batch of outputs while the next ones are computed
+            if len(pending) >= nprocs or count == num_tasks:
+                for sum_, basename, remove in sums:
+                    fold_maps(sum_, basename, pending, remove)
+                pending = []
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
 
 
 def get_raster_from_strds(year, day, time, strds):
@@ -579,6 +698,7 @@ def main():
     solar_constant = (
         float(options["solar_constant"]) if options["solar_constant"] else None
     )
+    horizon_step = options["horizon_step"]
     temporal = flags["t"]
     binary = flags["b"]
     mode1 = True if options["mode"] == "mode1" else False
@@ -679,23 +799,28 @@ def main():
             "r.slope.aspect", elevation=elevation_input, quiet=True, **params
         )
 
+    # compute (or reuse) horizon maps instead of terrain shading in each run
+    horizon_basename = None
+    if horizon_step and not flags["p"]:
+        horizon_basename = horizon_cache(elevation_input, horizon_step)
+
+    if beam_rad:
+        grass.mapcalc("{beam} = 0".format(beam=beam_rad), quiet=True)
+    if diff_rad:
+        grass.mapcalc("{diff} = 0".format(diff=diff_rad), quiet=True)
+    if refl_rad:
+        grass.mapcalc("{refl} = 0".format(refl=refl_rad), quiet=True)
+    if glob_rad:
+        grass.mapcalc("{glob} = 0".format(glob=glob_rad), quiet=True)
+
     grass.info(_("Running r.sun in a loop..."))
-    count = 0
-    # Parallel processing
-    proc_list = []
-    proc_count = 0
-    suffixes = []
+    tasks = []
     suffixes_all = []
     if mode1:
         times = list(frange1(start_time, end_time, time_step))
     else:
         times = list(frange2(start_time, end_time, time_step))
-    num_times = len(times)
-    core.percent(0, num_times, 1)
     for time in times:
-        count += 1
-        core.percent(count, num_times, 10)
-
         coeff_bh_raster = coeff_bh
         if coeff_bh_strds:
             coeff_bh_raster = get_raster_from_strds(
@@ -708,10 +833,10 @@ def main():
             )
 
         suffix = "_" + format_time(time)
-        proc_list.append(
-            Process(
-                target=run_r_sun,
-                args=(
+        tasks.append(
+            (
+                suffix,
+                (
                     elevation_input,
                     aspect_input,
                     slope_input,
@@ -737,41 +862,35 @@ def main():
                     None if mode1 else time_step,
                     distance_step,
                     solar_constant,
+                    horizon_basename,
+                    horizon_step,
                     rsun_flags,
                 ),
             )
         )
-
-        proc_list[proc_count].start()
-        proc_count += 1
-        suffixes.append(suffix)
         suffixes_all.append(suffix)
 
-        if proc_count == nprocs or proc_count == num_times or count == num_times:
-            proc_count = 0
-            exitcodes = 0
-            for proc in proc_list:
-                proc.join()
-                exitcodes += proc.exitcode
-
-            if exitcodes != 0:
-                core.fatal(_("Error while r.sun computation"))
-
-            # Empty process list
-            proc_list = []
-            suffixes = []
+    # maps are added to the sums as they are computed,
+    # and removed unless the user asked for them
+    sums = [
+        (sum_, basename, not basename_user)
+        for sum_, basename, basename_user in (
+            (beam_rad, beam_rad_basename, beam_rad_basename_user),
+            (diff_rad, diff_rad_basename, diff_rad_basename_user),
+            (refl_rad, refl_rad_basename, refl_rad_basename_user),
+            (glob_rad, glob_rad_basename, glob_rad_basename_user),
+        )
+        if sum_
+    ]
+    run_r_sun_pool(tasks, nprocs, sums)
 
     if beam_rad:
-        sum_maps(beam_rad, beam_rad_basename, suffixes_all)
         set_color_table([beam_rad])
     if diff_rad:
-        sum_maps(diff_rad, diff_rad_basename, suffixes_all)
         set_color_table([diff_rad])
     if refl_rad:
-        sum_maps(refl_rad, refl_rad_basename, suffixes_all)
         set_color_table([refl_rad])
     if glob_rad:
-        sum_maps(glob_rad, glob_rad_basename, suffixes_all)
         set_color_table([glob_rad])
 
     if not any(
@@ -46,27 +46,185 @@
 #% required: yes
 #%end
 
-import atexit
-import multiprocessing as mp
-import random
-import string
 import sys
-from subprocess import PIPE
+from itertools import islice
 
 import grass.script as gs
 import numpy as np
 from grass.pygrass.gis.region import Region
-from grass.pygrass.modules.shortcuts import general as gg
 from grass.pygrass.modules.shortcuts import raster as gr
 from grass.pygrass.raster import RasterRow
-from grass.script import parse_key_val
+from grass.pygrass.raster.buffer import Buffer
 
-RAST_REMOVE = []
+# number of cells in a block of rows of the focal engine
+FOCAL_BLOCK_SIZE = 2 ** 20
+CNULL = -2147483648  # null value for CELL maps
 
 
-def cleanup():
-    for ras in RAST_REMOVE:
-        gg.remove(flags="f", type="raster", name=ras, quiet=True)
+def raster_window():
+    """Sets the raster window of this process to the current region
+
+    Returns
+    -------
+    region : pygrass.gis.region.Region
+        The current computational region.
+    """
+    current = gs.region()
+    region = Region()
+    region.north = current["n"]
+    region.south = current["s"]
+    region.east = current["e"]
+    region.west = current["w"]
+    region.nsres = current["nsres"]
+    region.ewres = current["ewres"]
+    region.adjust()
+    region.set_raster_region()
+
+    return region
+
+
+def get_row_or_nan(raster, row_num):
+    """Returns a row of a raster map as floats, with null cells as NaN"""
+    row = raster.get_row(row_num)
+    if raster.mtype != "CELL":
+        return row.astype(np.float64)
+    nans = row == CNULL
+    row = row.astype(np.float64)
+    row[nans] = np.nan
+
+    return row
+
+
+def focal_blocks(name, radius, region):
+    """Iterates over a raster map in blocks of rows surrounded by a halo
+
+    Each block holds a number of rows of the map and a halo of radius rows
+    and columns on each side, so that a moving window of this radius can be
+    applied to all the cells of the block. Cells outside of the region and
+    null cells are NaN. Successive blocks overlap by their halo rows, but
+    every row of the map is read only once.
+
+    Parameters
+    ----------
+    name : str
+        Name of the GRASS raster map.
+
+    radius : int
+        Radius of the moving window in cells.
+
+    region : pygrass.gis.region.Region
+        The computational region, as returned by raster_window.
+
+    Yields
+    ------
+    start : int
+        Index of the first row of the block in the map.
+
+    block : 2d ndarray
+        Array of shape (rows + 2 * radius, region.cols + 2 * radius).
+    """
+    # At least four times as many rows as the halo, so that the halo rows
+    # computed with each block stay a small part of it
+    block_rows = max(8 * radius, 1, FOCAL_BLOCK_SIZE // (region.cols + 2 * radius))
+    pad = np.full(region.cols + 2 * radius, np.nan)
+
+    def padded_rows(src):
+        for i in range(radius):
+            yield pad
+        for row_num in range(region.rows):
+            row = pad.copy()
+            row[radius : radius + region.cols] = get_row_or_nan(src, row_num)
+            yield row
+        for i in range(radius):
+            yield pad
+
+    with RasterRow(name) as src:
+        rows = padded_rows(src)
+        halo = list(islice(rows, 2 * radius))
+        for start in range(0, region.rows, block_rows):
+            halo.extend(islice(rows, block_rows))
+            yield start, np.array(halo)
+            del halo[: len(halo) - 2 * radius]
+
+
+def box_sum(values, height, width):
+    """Sums values over all the windows of height x width cells
+
+    Uses a summed-area table, so that the cost does not depend on the size
+    of the window.
+
+    Parameters
+    ----------
+    values : 2d ndarray
+        Array of numbers or booleans, without NaN.
+
+    height, width : int
+        Number of rows and columns of the window.
+
+    Returns
+    -------
+    sums : 2d ndarray
+        Array of shape (rows - height + 1, cols - width + 1) with the sum of
+        the window whose upper left cell is at each position.
+    """
+    sat = np.zeros(
+        (values.shape[0] + 1, values.shape[1] + 1),
+        dtype=np.result_type(values.dtype, np.int64),
+    )
+    np.cumsum(values, axis=0, out=sat[1:, 1:])
+    np.cumsum(sat[1:, 1:], axis=1, out=sat[1:, 1:])
+
+    return (
+        sat[height:, width:]
+        - sat[:-height, width:]
+        - sat[height:, :-width]
+        + sat[:-height, :-width]
+    )
+
+
+def put_rows(raster, rows):
+    """Writes the rows of a 2d array to a FCELL or DCELL raster map"""
+    dtype = np.float32 if raster.mtype == "FCELL" else np.float64
+    for row in rows.astype(dtype):
+        raster.put_row(Buffer(row.shape, raster.mtype, row))
+
+
+def tpi_block(block, halo, radius):
+    """Calculates the topographic position index for the cells of a block
+
+    The DEM is generalized by the mean of the non-null cells in a square
+    window, like r.neighbors method=average.
+
+    Parameters
+    ----------
+    block : 2d ndarray
+        Block of elevations with a halo of halo cells.
+
+    halo : int
+        Radius of the halo of the block, at least radius.
+
+    radius : int
+        Radius of the smoothing neighborhood in cells.
+
+    Returns
+    -------
+    tpi : 2d ndarray
+        Difference between the elevation and the generalized elevation.
+    """
+    size = radius * 2 + 1
+    trim = halo - radius
+    window = block[trim : block.shape[0] - trim, trim : block.shape[1] - trim]
+    valid = ~np.isnan(window)
+    centre = block[halo : block.shape[0] - halo, halo : block.shape[1] - halo]
+    if not valid.any():
+        return centre.copy()
+
+    # subtract the mean of the block to keep the summed-area table precise
+    offset = window[valid].mean()
+    sums = box_sum(np.where(valid, window - offset, 0), size, size)
+    counts = box_sum(valid, size, size)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return centre - offset - sums / counts
 
 
 def main():
@@ -78,9 +236,6 @@ def main():
     steps = int(options["steps"])
     output_raster = options["output"]
 
-    region = Region()
-    res = np.mean([region.nsres, region.ewres])
-
     # some checks
     if "@" in output_raster:
         output_raster = output_raster.split("@")[0]
@@ -91,85 +246,53 @@ def main():
     if steps < 2:
         gs.fatal("steps must be greater than 1")
 
-    # calculate radi for generalization
+    # calculate radi for generalization, starting at the largest one
     radi = np.logspace(
-        np.log(minradius), np.log(maxradius), steps, base=np.exp(1), dtype=np.int
+        np.log(minradius), np.log(maxradius), steps, base=np.exp(1), dtype=int
     )
-    radi = np.unique(radi)
-    sizes = radi * 2 + 1
-
-    # multiscale calculation
-    ztpi_maps = list()
-
-    for step, (radius, size) in enumerate(zip(radi[::-1], sizes[::-1])):
-        gs.message("Calculating the TPI at radius {radius}".format(radius=radius))
-
-        # generalize the dem
-        step_res = res * size
-        step_res_pretty = str(step_res).replace(".", "_")
-        generalized_dem = gs.tempname(4)
-
-        if size > 15:
-            step_dem = gs.tempname(4)
-            gg.region(res=str(step_res))
-            gr.resamp_stats(
-                input=input_raster,
-                output=step_dem,
-                method="average",
-                flags="w",
-            )
-            gr.resamp_rst(
-                input=step_dem,
-                ew_res=res,
-                ns_res=res,
-                elevation=generalized_dem,
-                quiet=True,
-            )
-            region.write()
-            gg.remove(type="raster", name=step_dem, flags="f", quiet=True)
-        else:
-            gr.neighbors(input=input_raster, output=generalized_dem, size=size)
-
-        # calculate the tpi
-        tpi = gs.tempname(4)
-        gr.mapcalc(
-            expression="{x} = {a} - {b}".format(
-                x=tpi, a=input_raster, b=generalized_dem
-            )
-        )
-        gg.remove(type="raster", name=generalized_dem, flags="f", quiet=True)
-
-        # standardize the tpi
-        raster_stats = gr.univar(map=tpi, flags="g", stdout_=PIPE).outputs.stdout
-        raster_stats = parse_key_val(raster_stats)
-        tpi_mean = float(raster_stats["mean"])
-        tpi_std = float(raster_stats["stddev"])
-        ztpi = gs.tempname(4)
-        ztpi_maps.append(ztpi)
-        RAST_REMOVE.append(ztpi)
-
-        gr.mapcalc(
-            expression="{x} = ({a} - {mean})/{std}".format(
-                x=ztpi, a=tpi, mean=tpi_mean, std=tpi_std
-            )
+    radi = np.unique(radi)[::-1]
+    halo = int(radi[0])
+    region = raster_window()
+
+    # first pass: statistics of the tpi at each radius for the standardization
+    gs.message(
+        "Calculating the TPI at radius {radi}".format(
+            radi=", ".join(str(radius) for radius in radi)
         )
-        gg.remove(type="raster", name=tpi, flags="f", quiet=True)
-
-        # integrate
-        if step > 1:
-            tpi_updated2 = gs.tempname(4)
-            gr.mapcalc(
-                "{x} = if(abs({a}) > abs({b}), {a}, {b})".format(
-                    a=ztpi_maps[step], b=tpi_updated1, x=tpi_updated2
-                )
-            )
-            RAST_REMOVE.append(tpi_updated2)
-            tpi_updated1 = tpi_updated2
-        else:
-            tpi_updated1 = ztpi_maps[0]
-
-    RAST_REMOVE.pop()
-    gg.rename(raster=(tpi_updated2, output_raster), quiet=True)
+    )
+    n = np.zeros(len(radi))
+    tpi_sum = np.zeros(len(radi))
+    tpi_sumsq = np.zeros(len(radi))
+
+    for start, block in focal_blocks(input_raster, halo, region):
+        gs.percent(start, region.rows, 1)
+        for step, radius in enumerate(radi):
+            tpi = tpi_block(block, halo, radius)
+            tpi = tpi[np.isfinite(tpi)]
+            n[step] += tpi.size
+            tpi_sum[step] += tpi.sum()
+            tpi_sumsq[step] += (tpi ** 2).sum()
+    gs.percent(1, 1, 1)
+
+    tpi_mean = tpi_sum / n
+    tpi_std = np.sqrt(tpi_sumsq / n - tpi_mean ** 2)
+
+    # second pass: standardize the tpi and integrate the radii
+    gs.message("Integrating the standardized TPI...")
+    with RasterRow(
+        output_raster, mode="w", mtype="DCELL", overwrite=gs.overwrite()
+    ) as out:
+        for start, block in focal_blocks(input_raster, halo, region):
+            gs.percent(start, region.rows, 1)
+            for step, radius in enumerate(radi):
+                ztpi = (tpi_block(block, halo, radius) - tpi_mean[step]) / tpi_std[step]
+                if step == 0:
+                    mtpi = ztpi
+                else:
+                    mtpi = np.where(np.abs(ztpi) > np.abs(mtpi), ztpi, mtpi)
+                    mtpi[np.isnan(ztpi)] = np.nan
+            put_rows(out, mtpi)
+    gs.percent(1, 1, 1)
 
     # set color theme
     with RasterRow(output_raster) as src:
@@ -184,5 +307,4 @@ def main():
 
 
 if __name__ == "__main__":
-    atexit.register(cleanup)
     sys.exit(main())
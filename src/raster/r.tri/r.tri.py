@@ -62,11 +62,19 @@
 import math
 import multiprocessing as mp
 import sys
+from collections import deque
+from itertools import islice
 
 import grass.script as gs
 import numpy as np
 from grass.pygrass.gis.region import Region
 from grass.pygrass.modules.shortcuts import raster as gr
+from grass.pygrass.raster import RasterRow
+from grass.pygrass.raster.buffer import Buffer
+
+# number of cells in a block of rows of the focal engine
+FOCAL_BLOCK_SIZE = 2 ** 20
+CNULL = -2147483648  # null value for CELL maps
 
 
 def focal_expr(radius, circular=False):
@@ -101,7 +109,7 @@ def focal_expr(radius, circular=False):
     if circular:
         mask = distance_from_centre(radius) <= radius
     else:
-        mask = np.ones((size, size), dtype=np.bool)
+        mask = np.ones((size, size), dtype=bool)
     mask[centre, centre] = False
 
     # mask and flatten the offsets
@@ -189,27 +197,195 @@ def idw_weights(radius, p, circular=False):
     return list(W[mask])
 
 
-def tile_shape(region, n_jobs):
-    """Calculates the number of tiles required for one tile per cpu
+def raster_window():
+    """Sets the raster window of this process to the current region
+
+    Modules run since this process started may have changed the
+    computational region, so it is read again from g.region.
+
+    Returns
+    -------
+    region : pygrass.gis.region.Region
+        The current computational region.
+    """
+    current = gs.region()
+    region = Region()
+    region.north = current["n"]
+    region.south = current["s"]
+    region.east = current["e"]
+    region.west = current["w"]
+    region.nsres = current["nsres"]
+    region.ewres = current["ewres"]
+    region.adjust()
+    region.set_raster_region()
+
+    return region
+
+
+def get_row_or_nan(raster, row_num):
+    """Returns a row of a raster map as floats, with null cells as NaN"""
+    row = raster.get_row(row_num)
+    if raster.mtype != "CELL":
+        return row.astype(np.float64)
+    nans = row == CNULL
+    row = row.astype(np.float64)
+    row[nans] = np.nan
+
+    return row
+
+
+def focal_blocks(name, radius, region, block_rows=None):
+    """Iterates over a raster map in blocks of rows surrounded by a halo
+
+    Each block holds a number of rows of the map and a halo of radius rows
+    and columns on each side, so that a moving window of this radius can be
+    applied to all the cells of the block. Cells outside of the region and
+    null cells are NaN. Successive blocks overlap by their halo rows, but
+    every row of the map is read only once.
+
+    Parameters
+    ----------
+    name : str
+        Name of the GRASS raster map.
+
+    radius : int
+        Radius of the moving window in cells.
+
+    region : pygrass.gis.region.Region
+        The computational region, as returned by raster_window.
+
+    block_rows : int. Optional
+        Number of rows of the map in a block, by default as many as fit into
+        FOCAL_BLOCK_SIZE cells, but at least four times the rows of the halo.
+
+    Yields
+    ------
+    start : int
+        Index of the first row of the block in the map.
+
+    block : 2d ndarray
+        Array of shape (rows + 2 * radius, region.cols + 2 * radius).
+    """
+    if block_rows is None:
+        # At least four times as many rows as the halo, so that the halo rows
+        # computed with each block stay a small part of it
+        block_rows = max(8 * radius, 1, FOCAL_BLOCK_SIZE // (region.cols + 2 * radius))
+    pad = np.full(region.cols + 2 * radius, np.nan)
+
+    def padded_rows(src):
+        for i in range(radius):
+            yield pad
+        for row_num in range(region.rows):
+            row = pad.copy()
+            row[radius : radius + region.cols] = get_row_or_nan(src, row_num)
+            yield row
+        for i in range(radius):
+            yield pad
+
+    with RasterRow(name) as src:
+        rows = padded_rows(src)
+        halo = list(islice(rows, 2 * radius))
+        for start in range(0, region.rows, block_rows):
+            halo.extend(islice(rows, block_rows))
+            yield start, np.array(halo)
+            del halo[: len(halo) - 2 * radius]
+
+
+def shifted(block, radius, row_offset, col_offset):
+    """Returns a view of the cells at an offset from the cells of a block
+
+    Parameters
+    ----------
+    block : 2d ndarray
+        Block of rows with a halo of radius cells, as yielded by focal_blocks.
+
+    radius : int
+        Radius of the halo of the block.
+
+    row_offset, col_offset : int
+        Offset in cells, between -radius and radius.
+
+    Returns
+    -------
+    cells : 2d ndarray
+        Array of the shape of the block without its halo.
+    """
+    rows = block.shape[0] - 2 * radius
+    cols = block.shape[1] - 2 * radius
+    row_start = radius + row_offset
+    col_start = radius + col_offset
+
+    return block[row_start : row_start + rows, col_start : col_start + cols]
+
+
+def put_rows(raster, rows):
+    """Writes the rows of a 2d array to a FCELL or DCELL raster map"""
+    dtype = np.float32 if raster.mtype == "FCELL" else np.float64
+    for row in rows.astype(dtype):
+        raster.put_row(Buffer(row.shape, raster.mtype, row))
+
+
+def ruggedness(block, radius, offsets, weights):
+    """Calculates the terrain ruggedness index for the cells of a block
+
+    Parameters
+    ----------
+    block : 2d ndarray
+        Block of elevations with a halo of radius cells.
+
+    radius : int
+        Radius of the moving window in cells.
+
+    offsets : list
+        List of pixel positions (row, col) relative to the center pixel.
+
+    weights : list
+        List of the weights of the pixel positions.
+
+    Returns
+    -------
+    tri : 2d ndarray
+        Weighted sum of the absolute differences between the cells and their
+        neighbours, NaN where any of the neighbours is null.
+    """
+    centre = shifted(block, radius, 0, 0)
+    tri = np.zeros(centre.shape)
+    for (i, j), w in zip(offsets, weights):
+        tri += w * np.abs(shifted(block, radius, i, j) - centre)
+
+    return tri
+
+
+def tile_rows(region, radius, n_jobs):
+    """Calculates the number of rows of the tiles processed in parallel
+
+    The tiles span the whole width of the region, so that they can be written
+    as they are and every row is read only once. They are small enough for
+    each processing core to get several of them, which balances the load,
+    but not larger than FOCAL_BLOCK_SIZE cells. A tile has at least four times
+    the rows of its halo, so that the halo rows, which are sent to the workers
+    twice, stay a small part of the work.
 
     Parameters
     ----------
     region : pygrass.gis.region.Region
         The computational region object.
 
+    radius : int
+        Radius of the moving window in cells (halo of the tiles).
+
     n_jobs : int
         The number of processing cores.
 
     Returns
     -------
-    width, height : tuple
-        The width and height of each tile.
+    rows : int
+        The number of rows of each tile, not counting the halo.
     """
-    n = math.sqrt(n_jobs)
-    width = int(math.ceil(region.cols / n))
-    height = int(math.ceil(region.rows / n))
+    max_rows = FOCAL_BLOCK_SIZE // (region.cols + 2 * radius)
+    rows = int(math.ceil(region.rows / (4.0 * n_jobs)))
 
-    return width, height
+    return max(1, 8 * radius, min(rows, max_rows))
 
 
 def main():
@@ -221,8 +397,6 @@ def main():
     circular = flags["c"]
     radius = int((size - 1) / 2)
 
-    region = Region()
-
     # Some checks
     if "@" in tri:
         tri = tri.split("@")[0]
@@ -234,12 +408,6 @@ def main():
         system_cores = mp.cpu_count()
         processes = system_cores + processes + 1
 
-    if processes > 1:
-        if gs.find_program("r.mapcalc.tiled") is False:
-            gs.fatal(
-                "The GRASS addon r.mapcalc.tiled must also be installed if n_jobs != 1. Run 'g.extension r.mapcalc.tiled'"
-            )
-
     if size <= 2 or size > 51:
         gs.fatal("size must be > 2 and <= 51")
 
@@ -249,37 +417,40 @@ def main():
     if exponent < 0 or exponent > 4.0:
         gs.fatal("exponent must be >= 0 and <= 4.0")
 
-    # Calculate TRI based on map calc statements
     gs.message("Calculating the Topographic Ruggedness Index...")
 
     # Generate a list of spatial neighbourhood offsets for the chosen radius
     # ignoring the center cell
     offsets = focal_expr(radius, circular)
     weights = idw_weights(radius, exponent, circular)
-    terms = []
-    for d, w in zip(offsets, weights):
-        d_str = ",".join(map(str, d))
-        terms.append("{w}*abs({dem}[{d}]-{dem})".format(dem=dem, d=d_str, w=w))
-
-    # Define the calculation expression
-    terms = "+".join(terms)
-
-    # Perform the r.mapcalc calculation with the moving window
-    expr = "{tri} = float({terms})".format(tri=tri, terms=terms)
-
-    width, height = tile_shape(region, processes)
-
-    if width < region.cols and height < region.rows and processes > 1:
-        gr.mapcalc_tiled(
-            expression=expr,
-            width=width,
-            height=height,
-            processes=processes,
-            overlap=int((size + 1) / 2),
-            output=tri,
-        )
-    else:
-        gs.mapcalc(expr)
+
+    # Moving window over tiles of rows with a halo of radius cells. The tiles
+    # are read once and in order, computed in parallel and written in order,
+    # so that no patching of the output is needed.
+    region = raster_window()
+    block_rows = tile_rows(region, radius, processes)
+    pool = mp.Pool(processes) if processes > 1 else None
+    try:
+        with RasterRow(tri, mode="w", mtype="FCELL", overwrite=gs.overwrite()) as out:
+            pending = deque()
+            for start, block in focal_blocks(dem, radius, region, block_rows):
+                args = (block, radius, offsets, weights)
+                if pool is None:
+                    put_rows(out, ruggedness(*args))
+                    continue
+                # Keep at most two tiles per process in memory
+                pending.append(pool.apply_async(ruggedness, args))
+                if len(pending) >= 2 * processes:
+                    put_rows(out, pending.popleft().get())
+            while pending:
+                put_rows(out, pending.popleft().get())
+        if pool is not None:
+            pool.close()
+            pool.join()
+    finally:
+        # Stops the workers if the computation failed, no-op otherwise
+        if pool is not None:
+            pool.terminate()
 
     # update metadata
     opts = ""
@@ -112,13 +112,21 @@ import os
 import random
 import string
 import sys
+from itertools import islice
 
 import grass.script as gs
+import numpy as np
 from grass.pygrass.gis.region import Region
 from grass.pygrass.modules.shortcuts import general as g
 from grass.pygrass.modules.shortcuts import raster as r
+from grass.pygrass.raster import RasterRow
+from grass.pygrass.raster.buffer import Buffer
 from grass.exceptions import ParameterError
 
+# number of cells in a block of rows of the focal engine
+FOCAL_BLOCK_SIZE = 2 ** 20
+CNULL = -2147483648  # null value for CELL maps
+
 
 if "GISBASE" not in os.environ:
     print("You must be in GRASS GIS to run this program.")
@@ -230,6 +238,160 @@ def focal_expr(radius, window_square=False):
     return offsets
 
 
+def raster_window():
+    """Sets the raster window of this process to the current region
+
+    The computational region is changed by g.region between the
+    generalization steps, so it is read again from g.region.
+
+    Returns
+    -------
+    region : pygrass.gis.region.Region
+        The current computational region.
+    """
+    current = gs.region()
+    region = Region()
+    region.north = current["n"]
+    region.south = current["s"]
+    region.east = current["e"]
+    region.west = current["w"]
+    region.nsres = current["nsres"]
+    region.ewres = current["ewres"]
+    region.adjust()
+    region.set_raster_region()
+
+    return region
+
+
+def get_row_or_nan(raster, row_num):
+    """Returns a row of a raster map as floats, with null cells as NaN"""
+    row = raster.get_row(row_num)
+    if raster.mtype != "CELL":
+        return row.astype(np.float64)
+    nans = row == CNULL
+    row = row.astype(np.float64)
+    row[nans] = np.nan
+
+    return row
+
+
+def focal_blocks(name, radius, region):
+    """Iterates over a raster map in blocks of rows surrounded by a halo
+
+    Each block holds a number of rows of the map and a halo of radius rows
+    and columns on each side, so that a moving window of this radius can be
+    applied to all the cells of the block. Cells outside of the region and
+    null cells are NaN. Successive blocks overlap by their halo rows, but
+    every row of the map is read only once.
+
+    Parameters
+    ----------
+    name : str
+        Name of the GRASS raster map.
+
+    radius : int
+        Radius of the moving window in cells.
+
+    region : pygrass.gis.region.Region
+        The computational region, as returned by raster_window.
+
+    Yields
+    ------
+    start : int
+        Index of the first row of the block in the map.
+
+    block : 2d ndarray
+        Array of shape (rows + 2 * radius, region.cols + 2 * radius).
+    """
+    # At least four times as many rows as the halo, so that the halo rows
+    # computed with each block stay a small part of it
+    block_rows = max(8 * radius, 1, FOCAL_BLOCK_SIZE // (region.cols + 2 * radius))
+    pad = np.full(region.cols + 2 * radius, np.nan)
+
+    def padded_rows(src):
+        for i in range(radius):
+            yield pad
+        for row_num in range(region.rows):
+            row = pad.copy()
+            row[radius : radius + region.cols] = get_row_or_nan(src, row_num)
+            yield row
+        for i in range(radius):
+            yield pad
+
+    with RasterRow(name) as src:
+        rows = padded_rows(src)
+        halo = list(islice(rows, 2 * radius))
+        for start in range(0, region.rows, block_rows):
+            halo.extend(islice(rows, block_rows))
+            yield start, np.array(halo)
+            del halo[: len(halo) - 2 * radius]
+
+
+def shifted(block, radius, row_offset, col_offset):
+    """Returns a view of the cells at an offset from the cells of a block
+
+    Parameters
+    ----------
+    block : 2d ndarray
+        Block of rows with a halo of radius cells, as yielded by focal_blocks.
+
+    radius : int
+        Radius of the halo of the block.
+
+    row_offset, col_offset : int
+        Offset in cells, between -radius and radius.
+
+    Returns
+    -------
+    cells : 2d ndarray
+        Array of the shape of the block without its halo.
+    """
+    rows = block.shape[0] - 2 * radius
+    cols = block.shape[1] - 2 * radius
+    row_start = radius + row_offset
+    col_start = radius + col_offset
+
+    return block[row_start : row_start + rows, col_start : col_start + cols]
+
+
+def put_rows(raster, rows):
+    """Writes the rows of a 2d array to a FCELL or DCELL raster map"""
+    dtype = np.float32 if raster.mtype == "FCELL" else np.float64
+    for row in rows.astype(dtype):
+        raster.put_row(Buffer(row.shape, raster.mtype, row))
+
+
+def percentile_block(block, radius, offsets):
+    """Calculates the elevation percentile for the cells of a block
+
+    Parameters
+    ----------
+    block : 2d ndarray
+        Block of elevations with a halo of radius cells.
+
+    radius : int
+        Neighborhood radius (in pixels).
+
+    offsets : list
+        List of pixel positions (row, col) relative to the center pixel.
+
+    Returns
+    -------
+    pctl : 2d ndarray
+        Proportion of the neighbours which are not higher than the cell, null
+        neighbours counting as not higher.
+    """
+    centre = shifted(block, radius, 0, 0)
+    lower = np.zeros(centre.shape)
+    for i, j in offsets:
+        neighbour = shifted(block, radius, i, j)
+        lower += np.isnan(neighbour) | (neighbour <= centre)
+    pctl = lower / len(offsets)
+    pctl[np.isnan(centre)] = np.nan
+
+    return pctl
+
+
 def elevation_percentile(input, radius=3, window_square=False):
     """Calculates the percentile whichj is the ratio of the number of points of
     lower elevation to the total number of points in the surrounding region
@@ -251,25 +413,14 @@ def elevation_percentile(input, radius=3, window_square=False):
     # get offsets for given neighborhood radius
     offsets = focal_expr(radius=radius, window_square=window_square)
 
-    # generate grass mapcalc terms and execute
-    n_pixels = float(len(offsets))
-
-    # create mapcalc expr focal function and fill null neighbors with centre cell
     PCTL = rand_id("PCTL{}".format(L + 1))
     TMP_RAST[L].append(PCTL)
 
-    terms = []
-    for d in offsets:
-        valid = ",".join(map(str, d))
-        terms.append(
-            "if( isnull({input}[{d}]), 1, {input}[{d}]<={input})".format(
-                input=input, d=valid
-            )
-        )
-
-    terms = "+".join(terms)
-    expr = "{x} = ({s}) / {n}".format(x=PCTL, s=terms, n=n_pixels)
-    gs.mapcalc(expr)
+    # moving window over blocks of rows of the current region
+    region = raster_window()
+    with RasterRow(PCTL, mode="w", mtype="DCELL", overwrite=True) as out:
+        for start, block in focal_blocks(input, radius, region):
+            put_rows(out, percentile_block(block, radius, offsets))
 
     return PCTL
 
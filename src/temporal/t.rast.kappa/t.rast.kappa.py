@@ -80,12 +80,10 @@ from grass.pygrass.raster import RasterRow
 from grass.pygrass.gis.region import Region
 from grass.script.utils import separator
 
-try:
-    from collections import OrderedDict
-except:
-    from types import DictType as OrderedDic
 import numpy as np
 
+BLOCK_SIZE = 2 ** 22  # count of values (maps x cells) in a block of rows
+
 
 def _load_skll():
     try:
@@ -100,8 +98,8 @@ def _load_skll():
 def _split_maps(maps, splitting):
     from datetime import datetime
 
-    before = OrderedDic()
-    after = OrderedDic()
+    before = []
+    after = []
     split = None
     if splitting.count("T") == 0:
         try:
@@ -123,43 +121,91 @@ def _split_maps(maps, splitting):
         )
     for mapp in maps:
         tempext = mapp.get_temporal_extent()
-        raster = RasterRow(mapp.get_name())
-        raster.open("r")
-        array = np.array(raster)
         if tempext.start_time <= split:
-            before[mapp.get_name()] = array
+            before.append(mapp.get_name())
         else:
-            after[mapp.get_name()] = array
+            after.append(mapp.get_name())
     return before, after
 
 
+def _dense_ranks(values):
+    """Return the rank of each value among the distinct values of its row"""
+    order = np.argsort(values, axis=1, kind="stable")
+    ordered = np.take_along_axis(values, order, axis=1)
+    ranks = np.zeros(values.shape, dtype=np.int64)
+    ranks[:, 1:] = np.cumsum(ordered[:, 1:] != ordered[:, :-1], axis=1)
+    dense = np.empty_like(ranks)
+    np.put_along_axis(dense, order, ranks, axis=1)
+    return dense
+
+
+def _kappa_block(vals1, vals2, method):
+    """Cohen's kappa of each pair of rows of vals1 and vals2, as
+    sklearn.metrics.cohen_kappa_score with the labels of the pair.
+
+    The weighted disagreement is computed for the observed pairs and for
+    all the pairs of the two rows, which gives the expected disagreement
+    without building a confusion matrix for each pixel.
+    """
+    count = vals1.shape[1]
+    if method is None:
+        observed = vals1 != vals2
+        expected = vals1[:, :, None] != vals2[:, None, :]
+    else:
+        ranks = _dense_ranks(np.concatenate((vals1, vals2), axis=1))
+        ranks1, ranks2 = ranks[:, :count], ranks[:, count:]
+        power = 1 if method == "linear" else 2
+        observed = np.abs(ranks1 - ranks2) ** power
+        expected = np.abs(ranks1[:, :, None] - ranks2[:, None, :]) ** power
+    observed = observed.sum(axis=1, dtype=np.float64)
+    expected = expected.sum(axis=(1, 2), dtype=np.float64) / count
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return 1 - observed / expected
+
+
+def _read_block(rasters, rows):
+    """Return the values of rows of the rasters, shaped (cells, rasters)"""
+    block = np.array(
+        [[raster.get_row(row) for row in rows] for raster in rasters],
+        dtype=np.float64,
+    )
+    return block.reshape((len(rasters), -1)).T
+
+
 def _kappa_pixel(maps1, maps2, out, method, over):
     from grass.pygrass.raster.buffer import Buffer
-    import sklearn
 
+    if len(maps1) != len(maps2):
+        gscript.fatal(
+            _(
+                "The number of maps before and after the splitting day "
+                "has to be the same ({b} and {a})".format(b=len(maps1), a=len(maps2))
+            )
+        )
+    rasters1 = [RasterRow(name) for name in maps1]
+    rasters2 = [RasterRow(name) for name in maps2]
     rasterout = RasterRow(out, overwrite=over)
+    for raster in rasters1 + rasters2:
+        raster.open("r")
     rasterout.open("w", "DCELL")
-    array1 = maps1.values()[0]
-    for row in range(len(array1)):
-        newrow = Buffer((len(array1[row]),), mtype="DCELL")
-        for col in range(len(array1[row])):
-            vals1 = np.ndarray(len(maps1.values()))
-            vals2 = np.ndarray(len(maps2.values()))
-            x = 0
-            for value in maps1.values():
-                vals1[x] = value[row][col]
-                x += 1
-            x = 0
-            for value in maps2.values():
-                vals2[x] = value[row][col]
-                x += 1
-            if sklearn.__version__ >= "0.18":
-                outval = sklearn.metrics.cohen_kappa_score(vals1, vals2, weights=method)
-            else:
-                outval = sklearn.metrics.cohen_kappa_score(vals1, vals2)
-            newrow[col] = outval
-        rasterout.put_row(newrow)
-    rasterout.close()
+    try:
+        current = Region()
+        cols = current.cols
+        # the expected disagreement holds maps x maps values per cell
+        block_rows = max(1, BLOCK_SIZE // (max(2, len(maps1)) * len(maps1) * cols))
+        newrow = Buffer((cols,), mtype="DCELL")
+        for start in range(0, current.rows, block_rows):
+            rows = range(start, min(start + block_rows, current.rows))
+            outvals = _kappa_block(
+                _read_block(rasters1, rows), _read_block(rasters2, rows), method
+            )
+            for outrow in outvals.reshape((len(rows), cols)):
+                newrow[:] = outrow
+                rasterout.put_row(newrow)
+    finally:
+        for raster in rasters1 + rasters2:
+            raster.close()
+        rasterout.close()
     return
 
 
@@ -144,46 +144,94 @@
 #% requires: final_date_column, date_column
 #%end
 
+import math
 from datetime import datetime
 from datetime import timedelta
+from multiprocessing import Pool
 from subprocess import PIPE as PI
 import numpy as np
 import grass.script as gscript
 from grass.exceptions import CalledModuleError
 
+CNULL = -2147483648  # null value for CELL maps
+
 
 def return_value(vals, met):
-    """Return the value according the choosen method"""
+    """Return the values according the choosen method, for each column
+    (point) of vals"""
     if met == "average":
-        return vals.mean()
+        return vals.mean(axis=0)
     elif met == "median":
-        return np.median(vals)
+        return np.median(vals, axis=0)
     elif met == "mode":
         try:
             from scipy import stats
 
-            m = stats.mode(vals)
-            return m.mode[0]
+            m = stats.mode(vals, axis=0)
+            return np.ravel(m.mode)
         except ImportError:
             gscript.fatal(_("For method 'mode' you need to install scipy"))
     elif met == "minimum":
-        return vals.min()
+        return vals.min(axis=0)
     elif met == "maximum":
-        return vals.max()
+        return vals.max(axis=0)
     elif met == "stddev":
-        return vals.std()
+        return vals.std(axis=0)
     elif met == "sum":
-        return vals.sum()
+        return vals.sum(axis=0)
     elif met == "variance":
-        return vals.var()
+        return vals.var(axis=0)
     elif met == "quart1":
-        return np.percentile(vals, 25)
+        return np.percentile(vals, 25, axis=0)
     elif met == "quart3":
-        return np.percentile(vals, 75)
+        return np.percentile(vals, 75, axis=0)
     elif met == "perc90":
-        return np.percentile(vals, 90)
+        return np.percentile(vals, 90, axis=0)
     elif met == "quantile":
-        return
+        return [None] * vals.shape[1]
+
+
+def read_points(invect):
+    """Return the categories, the rows and the columns in the current region
+    of the points of a vector map, -1 for points outside the region"""
+    from grass.pygrass.gis.region import Region
+    from grass.pygrass.vector import VectorTopo
+
+    region = Region()
+    cats = []
+    rows = []
+    cols = []
+    pymap = VectorTopo(invect)
+    pymap.open("r")
+    for pnt in pymap.viter("points"):
+        row = int(math.floor((region.north - pnt.y) / region.nsres))
+        col = int(math.floor((pnt.x - region.west) / region.ewres))
+        if not (0 <= row < region.rows and 0 <= col < region.cols):
+            row = col = -1
+        cats.append(str(pnt.cat))
+        rows.append(row)
+        cols.append(col)
+    pymap.close()
+    return cats, np.array(rows, dtype=int), np.array(cols, dtype=int)
+
+
+def sample_map(args):
+    """Return the values of a raster map at the given rows and columns,
+    reading each needed row only once"""
+    from grass.pygrass.raster import RasterRow
+
+    name, mapset, rows, cols = args
+    values = np.full(len(rows), np.nan)
+    raster = RasterRow(name, mapset=mapset)
+    raster.open("r")
+    for row in np.unique(rows[rows >= 0]):
+        inrow = rows == row
+        buf = np.array(raster.get_row(row), dtype=float)
+        if raster.mtype == "CELL":
+            buf[buf == CNULL] = np.nan
+        values[inrow] = buf[cols[inrow]]
+    raster.close()
+    return values
 
 
 def main(options, flags):
@@ -342,8 +390,29 @@ def main(options, flags):
         )
         myfeats = qfeat.outputs["stdout"].value.splitlines()
 
-    if stdout:
-        outtxt = ""
+    if incol:
+        # Group the features by their dates
+        if endcol:
+            mysql = "SELECT cat,{dc},{ec} from {vmap} order by cat".format(
+                vmap=invect, dc=incol, ec=endcol
+            )
+        else:
+            mysql = "SELECT cat,{dc} from {vmap} order by cat".format(
+                vmap=invect, dc=incol
+            )
+        try:
+            qfeat = pymod.Module(
+                "db.select", flags="c", stdout_=PI, stderr_=PI, sql=mysql
+            )
+        except CalledModuleError:
+            gscript.fatal(_("db.select returned an error"))
+        datefeats = {}
+        for line in qfeat.outputs["stdout"].value.splitlines():
+            vals = line.split("|")
+            datefeats.setdefault("|".join(vals[1:]), []).append(vals[0])
+
+    # Temporal windows and their features
+    windows = []
     for data in mydates:
         try:
             start, final = data.split("|")
@@ -361,123 +430,105 @@ def main(options, flags):
         else:
             sdata = fdata
             fdata = sdata - td
-        mwhere = "start_time >= '{inn}' and start_time < " "'{out}'".format(
-            inn=fdata, out=sdata
-        )
-        lines = None
-        try:
-            r_what = pymod.Module(
-                "t.rast.what",
-                points=invect,
-                strds=strds,
-                layout="timerow",
-                separator=separator,
-                flags="v",
-                where=mwhere,
-                quiet=True,
-                stdout_=PI,
-                stderr_=PI,
-                nprocs=nprocs,
-            )
-            lines = r_what.outputs["stdout"].value.splitlines()
-        except CalledModuleError:
-            gscript.warning("t.rast.what faild with where='{}'".format(mwhere))
-            pass
         if incol:
+            myfeats = datefeats.get(data, [])
+        windows.append((start, final, fdata, sdata, myfeats))
+
+    # Maps of each window, each needed map is sampled only once
+    maps = sp.get_registered_maps_as_objects(None, "start_time", dbif)
+    if maps is None:
+        maps = []
+    needed = {}
+    winmaps = []
+    for start, final, fdata, sdata, myfeats in windows:
+        idx = []
+        for mapp in maps:
+            start_time = mapp.get_temporal_extent_as_tuple()[0]
+            if fdata <= start_time < sdata:
+                idx.append(needed.setdefault(mapp.get_id(), len(needed)))
+        winmaps.append(idx)
+    dbif.close()
+
+    cats, rows, columns = read_points(invect)
+    ids = sorted(needed, key=needed.get)
+    args = [tuple(mapid.split("@")) + (rows, columns) for mapid in ids]
+    if int(nprocs) > 1 and len(args) > 1:
+        pool = Pool(int(nprocs))
+        samples = pool.map(sample_map, args)
+        pool.close()
+        pool.join()
+    else:
+        samples = [sample_map(arg) for arg in args]
+    samples = np.array(samples).reshape((len(ids), len(cats)))
+
+    if stdout:
+        outtxt = ""
+    else:
+        from grass.pygrass.vector import VectorTopo
+
+        pymap = VectorTopo(output)
+        pymap.open("r")
+        table = pymap.table
+        placeholder = "%s" if table.columns.is_pg() else "?"
+        mywhe = ["cat={}".format(placeholder)]
+        if incol:
+            mywhe.insert(0, "{dc}={ph}".format(dc=incol, ph=placeholder))
             if endcol:
-                mysql = (
-                    "SELECT DISTINCT cat from {vmap} where {dc}='{da}' "
-                    "AND {ec}='{ed}' order by cat".format(
-                        vmap=invect, da=start, dc=incol, ed=final, ec=endcol
-                    )
-                )
-            else:
-                mysql = (
-                    "SELECT DISTINCT cat from {vmap} where {dc}='{da}' "
-                    "order by cat".format(vmap=invect, da=start, dc=incol)
-                )
-            try:
-                qfeat = pymod.Module(
-                    "db.select", flags="c", stdout_=PI, stderr_=PI, sql=mysql
-                )
-                myfeats = qfeat.outputs["stdout"].value.splitlines()
-            except CalledModuleError:
-                gscript.fatal(
-                    _("db.select returned an error for date " "{da}".format(da=start))
+                mywhe.insert(1, "{ec}={ph}".format(ec=endcol, ph=placeholder))
+        sql = "UPDATE {tab} SET {cols} WHERE {whe}".format(
+            tab=table.name,
+            cols=", ".join("{}={}".format(col, placeholder) for col in cols),
+            whe=" AND ".join(mywhe),
+        )
+        updates = []
+    for (start, final, fdata, sdata, myfeats), idx in zip(windows, winmaps):
+        if not idx:
+            if stdout:
+                for feat in myfeats:
+                    outtxt += "{di}{sep}{da}".format(di=feat, da=start, sep=separator)
+                    for n in range(len(mets)):
+                        outtxt += "{sep}{val}".format(val="*", sep=separator)
+                    outtxt += "\n"
+            continue
+        myfeats = set(myfeats)
+        points = [i for i, cat in enumerate(cats) if cat in myfeats]
+        nvals = samples[idx][:, points]
+        valid = ~np.isnan(nvals).any(axis=0)
+        if len(idx) == 1:
+            results = [nvals[0]] * len(mets)
+        else:
+            results = [return_value(nvals, met) for met in mets]
+        for j, point in enumerate(points):
+            if stdout:
+                outtxt += "{di}{sep}{da}".format(
+                    di=cats[point], da=start, sep=separator
                 )
-        if not lines and stdout:
-            for feat in myfeats:
-                outtxt += "{di}{sep}{da}".format(di=feat, da=start, sep=separator)
                 for n in range(len(mets)):
-                    outtxt += "{sep}{val}".format(val="*", sep=separator)
+                    result = results[n][j] if valid[j] else None
+                    if not result:
+                        result = "*"
+                    outtxt += "{sep}{val}".format(val=result, sep=separator)
                 outtxt += "\n"
-        if not lines:
-            continue
-        x = 0
-        for line in lines:
-            vals = line.split(separator)
-            if vals[0] in myfeats:
-                try:
-                    nvals = np.array(vals[3:]).astype(float)
-                except ValueError:
-                    if stdout:
-                        outtxt += "{di}{sep}{da}".format(
-                            di=vals[0], da=start, sep=separator
-                        )
-                        for n in range(len(mets)):
-                            outtxt += "{sep}{val}".format(val="*", sep=separator)
-                        outtxt += "\n"
-                    continue
-                if stdout:
-                    outtxt += "{di}{sep}{da}".format(
-                        di=vals[0], da=start, sep=separator
-                    )
-                for n in range(len(mets)):
-                    result = None
-                    if len(nvals) == 1:
-                        result = nvals[0]
-                    elif len(nvals) > 1:
-                        result = return_value(nvals, mets[n])
-                    if stdout:
-                        if not result:
-                            result = "*"
-                        outtxt += "{sep}{val}".format(val=result, sep=separator)
-                    else:
-                        try:
-                            if incol:
-                                mywhe = "{dc}='{da}' AND ".format(da=start, dc=incol)
-                                if endcol:
-                                    mywhe += "{dc}='{da}' AND ".format(
-                                        da=final, dc=endcol
-                                    )
-
-                                mywhe += "cat={ca}".format(ca=vals[0])
-
-                                pymod.Module(
-                                    "v.db.update",
-                                    map=output,
-                                    column=cols[n],
-                                    value=str(result),
-                                    where=mywhe,
-                                )
-                            else:
-                                pymod.Module(
-                                    "v.db.update",
-                                    map=output,
-                                    column=cols[n],
-                                    value=str(result),
-                                    where="cat={ca}".format(ca=vals[0]),
-                                )
-                        except CalledModuleError:
-                            gscript.fatal(_("v.db.update return an error"))
-                if stdout:
-                    outtxt += "\n"
-                if x == len(myfeats):
-                    break
-                else:
-                    x += 1
+            elif valid[j]:
+                values = [
+                    None if results[n][j] is None else float(results[n][j])
+                    for n in range(len(mets))
+                ]
+                if incol:
+                    values.append(start)
+                    if endcol:
+                        values.append(final)
+                values.append(int(cats[point]))
+                updates.append(values)
     if stdout:
         print(outtxt)
+    else:
+        # Write all the results in one transaction
+        cur = table.conn.cursor()
+        cur.executemany(sql, updates)
+        table.conn.commit()
+        cur.close()
+        pymap.close()
 
 
 if __name__ == "__main__":
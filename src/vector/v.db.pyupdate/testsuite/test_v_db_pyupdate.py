@@ -75,6 +75,48 @@ class TestVDbPyUpdate(TestCase):
             else:
                 self.assertFalse(row["display_phone"].startswith("Phone num."))
 
+    def test_arithmetic(self):
+        """Check arithmetic expression which can be evaluated for many rows"""
+        self.runModule(
+            "v.db.addcolumn", map=self.vector_name, columns="double_cat integer"
+        )
+        self.assertModule(
+            "v.db.pyupdate",
+            map=self.vector_name,
+            column="double_cat",
+            expression="2 * cat + 1",
+            where="cat > 10",
+        )
+        table = json.loads(
+            gs.read_command("v.db.select", map=self.vector_name, flags="j")
+        )
+        for row in table:
+            if row["cat"] > 10:
+                self.assertEqual(row["double_cat"], 2 * row["cat"] + 1)
+            else:
+                self.assertNotEqual(row["double_cat"], 2 * row["cat"] + 1)
+
+    def test_arithmetic_large_product(self):
+        """Check that intermediate values of arithmetic do not overflow"""
+        self.runModule(
+            "v.db.addcolumn",
+            map=self.vector_name,
+            columns="large integer,remainder integer",
+        )
+        large = 2 ** 40
+        self.runModule("v.db.update", map=self.vector_name, column="large", value=large)
+        self.assertModule(
+            "v.db.pyupdate",
+            map=self.vector_name,
+            column="remainder",
+            expression="large * large % 1000",
+        )
+        table = json.loads(
+            gs.read_command("v.db.select", map=self.vector_name, flags="j")
+        )
+        for row in table:
+            self.assertEqual(row["remainder"], large * large % 1000)
+
 
 if __name__ == "__main__":
     test()
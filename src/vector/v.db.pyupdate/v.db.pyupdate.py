@@ -83,9 +83,11 @@ This executable script is a GRASS GIS module to run in a GRASS GIS session.
 #% requires: -s,packages
 #%end
 
+import ast
 import os
 import json
 import csv
+import operator
 
 # Importing so that it available to the expression.
 import math  # noqa: F401 pylint: disable=unused-import
@@ -112,6 +114,72 @@ SQL_FLOAT_TYPES = [
     "FLOATING POINT",
 ]
 
+# Drivers for which a Python database connection is available in pygrass
+STREAMING_DRIVERS = ["sqlite", "pg"]
+# Number of rows read, evaluated, and written at once
+CHUNK_SIZE = 10000
+
+# Syntax allowed in expressions evaluated for whole columns at once
+ARITHMETIC_NODES = (
+    ast.Expression,
+    ast.BinOp,
+    ast.UnaryOp,
+    ast.Name,
+    ast.Load,
+    ast.Add,
+    ast.Sub,
+    ast.Mult,
+    ast.Div,
+    ast.FloorDiv,
+    ast.Mod,
+    ast.Pow,
+    ast.UAdd,
+    ast.USub,
+)
+NUMBER_NODES = tuple(
+    getattr(ast, name) for name in ("Constant", "Num") if hasattr(ast, name)
+)
+ARITHMETIC_OPERATORS = {
+    ast.Add: operator.add,
+    ast.Sub: operator.sub,
+    ast.Mult: operator.mul,
+    ast.Div: operator.truediv,
+    ast.FloorDiv: operator.floordiv,
+    ast.Mod: operator.mod,
+    ast.Pow: operator.pow,
+}
+
+
+def fatal_evaluation_error(expression, kwargs, error):
+    """Report failed evaluation of expression for one row"""
+    attributes = []
+    for key, value in kwargs.items():
+        # Limit the number of attributes shown in the message.
+        max_attrs_show = 3
+        if len(attributes) >= max_attrs_show:
+            attributes.append("...")
+            break
+        # Try to show the relevant attributes. The "relevant" does not
+        # apply when they are misspelled.
+        # TODO: Merge with the case for all misspelled where this won't show
+        # any.
+        if key in expression:
+            attributes.append(f"{key}={value}")
+    if not attributes:
+        # TODO: needs to be more systematic regarding number of items and format str/int/float
+        attributes = [f"{key}={value}" for key, value in kwargs.items()][:3]
+        attributes.append("...")
+    gs.fatal(
+        _(
+            "Evaluation of expression <{expression}...>"
+            " where {attributes} failed with: {error}"
+        ).format(
+            expression=expression[:20],  # TODO: short expressions without ...
+            attributes=", ".join(attributes),
+            error=error,
+        )
+    )
+
 
 def python_to_transaction(
     table,
@@ -149,33 +217,7 @@ def python_to_transaction(
         try:
             value = expression_function(**kwargs)
         except Exception as error:  # pylint: disable=broad-except
-            attributes = []
-            for key, value in kwargs.items():
-                # Limit the number of attributes shown in the message.
-                max_attrs_show = 3
-                if len(attributes) >= max_attrs_show:
-                    attributes.append("...")
-                    break
-                # Try to show the relevant attributes. The "relevant" does not
-                # apply when they are misspelled.
-                # TODO: Merge with the case for all misspelled where this won't show
-                # any.
-                if key in expression:
-                    attributes.append(f"{key}={value}")
-            if not attributes:
-                # TODO: needs to be more systematic regarding number of items and format str/int/float
-                attributes = [f"{key}={value}" for key, value in kwargs.items()][:3]
-                attributes.append("...")
-            gs.fatal(
-                _(
-                    "Evaluation of expression <{expression}...>"
-                    " where {attributes} failed with: {error}"
-                ).format(
-                    expression=expression[:20],  # TODO: short expressions without ...
-                    attributes=", ".join(attributes),
-                    error=error,
-                )
-            )
+            fatal_evaluation_error(expression, kwargs, error)
         if value is None:
             # Translate None to SQL NULL
             value = "NULL"
@@ -190,6 +232,186 @@ def python_to_transaction(
     return cmd
 
 
+def arithmetic_names(expression):
+    """Return names used in an expression if it is only arithmetic
+
+    Returns None when the expression uses anything else than numbers,
+    names, and arithmetic operators, e.g., function calls or attributes.
+    """
+    try:
+        tree = ast.parse(expression, mode="eval")
+    except SyntaxError:
+        return None
+    names = set()
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Name):
+            names.add(node.id)
+        elif isinstance(node, NUMBER_NODES):
+            value = getattr(node, "value", getattr(node, "n", None))
+            if isinstance(value, bool) or not isinstance(value, (int, float)):
+                return None
+        elif not isinstance(node, ARITHMETIC_NODES):
+            return None
+    return names
+
+
+def evaluate_node(node, arrays, np):
+    """Evaluate an arithmetic expression node for arrays of values
+
+    Raises OverflowError when an integer value, including any intermediate
+    one, could overflow the NumPy integer type while a Python integer
+    would not.
+    """
+    if isinstance(node, ast.Expression):
+        return evaluate_node(node.body, arrays, np)
+    if isinstance(node, ast.Name):
+        return arrays[node.id]
+    if isinstance(node, NUMBER_NODES):
+        value = getattr(node, "value", getattr(node, "n", None))
+        if isinstance(value, int) and abs(value) >= 2 ** 62:
+            raise OverflowError(value)
+        return np.array(value)
+    if isinstance(node, ast.UnaryOp):
+        operand = evaluate_node(node.operand, arrays, np)
+        return -operand if isinstance(node.op, ast.USub) else +operand
+    operation = ARITHMETIC_OPERATORS[type(node.op)]
+    left = evaluate_node(node.left, arrays, np)
+    right = evaluate_node(node.right, arrays, np)
+    result = operation(left, right)
+    if result.dtype.kind in "iu":
+        # Python integers do not overflow, so the same operation is done
+        # with floats to see how large the exact result is.
+        check = operation(left.astype(float), right.astype(float))
+        if np.any(np.abs(check) >= 2 ** 62):
+            raise OverflowError(node.op)
+    return result
+
+
+def evaluate_arithmetic(tree, names, columns, rows):
+    """Evaluate arithmetic expression for a chunk of rows at once using NumPy
+
+    Returns a list of values or None when the chunk cannot be evaluated
+    this way (NULLs, non-numeric values, errors, overflows, NaNs) so that
+    the rows are evaluated one by one with the same result as the
+    expression would have in Python.
+    """
+    try:
+        import numpy as np  # pylint: disable=import-outside-toplevel
+    except ImportError:
+        return None
+    arrays = {}
+    for name in names:
+        index = columns.get(name)
+        if index is None:
+            return None
+        values = [row[index] for row in rows]
+        # Only columns of int or float values, NULLs are evaluated by rows
+        if {type(value) for value in values} not in ({int}, {float}):
+            return None
+        arrays[name] = np.array(values)
+    try:
+        with np.errstate(all="raise"):
+            result = evaluate_node(tree, arrays, np)
+            result = np.broadcast_to(result, (len(rows),))
+    except (ArithmeticError, ValueError, TypeError):
+        return None
+    if result.dtype.kind == "f" and not np.all(np.isfinite(result)):
+        return None
+    return result.tolist()
+
+
+def python_to_table(
+    connection,
+    driver,
+    table,
+    key,
+    where,
+    column,
+    column_type,
+    expression,
+    expression_code,
+    condition,
+    condition_code,
+    ensure_lowercase,
+):
+    """Read rows in chunks, apply Python code, and update the table
+
+    Rows are read in the order of the key column, one chunk at a time,
+    and the new values are written with a parametrized UPDATE statement
+    for each chunk. Returns number of updated rows.
+    """
+    placeholder = "?" if driver == "sqlite" else "%s"
+    not_quoted_types = SQL_INT_TYPES + SQL_FLOAT_TYPES
+    quote = column_type.upper() not in not_quoted_types
+    # Rows are selected after the last key of the previous chunk
+    select = f"SELECT * FROM {table}"
+    next_select = f"SELECT * FROM {table} WHERE {key} > {placeholder}"
+    if where:
+        select += f" WHERE ({where})"
+        next_select += f" AND ({where})"
+    select += f" ORDER BY {key} LIMIT {CHUNK_SIZE}"
+    next_select += f" ORDER BY {key} LIMIT {CHUNK_SIZE}"
+    update = f"UPDATE {table} SET {column} = {placeholder} WHERE {key} = {placeholder}"
+    gs.verbose(f'Using SQL: "{update}"')
+
+    names = None
+    if not condition:
+        names = arithmetic_names(expression)
+    if names is not None:
+        tree = ast.parse(expression, mode="eval")
+
+    cursor = connection.cursor()
+    updated = 0
+    last = None
+    while True:
+        if last is None:
+            cursor.execute(select)
+        else:
+            cursor.execute(next_select, (last,))
+        rows = cursor.fetchall()
+        if not rows:
+            break
+        columns = [description[0] for description in cursor.description]
+        key_index = columns.index(key)
+        last = rows[-1][key_index]
+        lowercase_columns = [name.lower() for name in columns]
+        indices = {name: index for index, name in enumerate(columns)}
+        if ensure_lowercase:
+            for index, name in enumerate(lowercase_columns):
+                indices[name] = index
+
+        values = None
+        if names is not None:
+            values = evaluate_arithmetic(tree, names, indices, rows)
+        if values is not None:
+            parameters = [(value, row[key_index]) for value, row in zip(values, rows)]
+        else:
+            parameters = []
+            for row in rows:
+                kwargs = dict(zip(columns, row))
+                if ensure_lowercase:
+                    kwargs.update(zip(lowercase_columns, row))
+                # pylint: disable=eval-used
+                if condition and not eval(condition_code, globals(), kwargs):
+                    # No Python condition or condition evaluates as False
+                    continue
+                try:
+                    value = eval(expression_code, globals(), kwargs)
+                except Exception as error:  # pylint: disable=broad-except
+                    fatal_evaluation_error(expression, kwargs, error)
+                parameters.append((value, row[key_index]))
+        if quote:
+            parameters = [
+                (None if value is None else f"{value}", cat)
+                for value, cat in parameters
+            ]
+        if parameters:
+            connection.cursor().executemany(update, parameters)
+            updated += len(parameters)
+    connection.commit()
+    return updated
+
+
 def csv_loads(text, delimeter, quotechar='"', null=None):
     """Load CSV from a string
 
@@ -274,11 +496,20 @@ def main():
     # Define Python functions
     # Here we need the full-deal eval and exec functions and can't sue less
     # general alternatives such as ast.literal_eval.
+    # The code is compiled only once and evaluated for each row.
+    try:
+        expression_code = compile(expression, "<expression>", "eval")
+        condition_code = None
+        if condition:
+            condition_code = compile(condition, "<condition>", "eval")
+    except SyntaxError as error:
+        gs.fatal(_("Invalid Python syntax: {error}").format(error=error))
+
     def expression_function(**kwargs):
-        return eval(expression, globals(), kwargs)  # pylint: disable=eval-used
+        return eval(expression_code, globals(), kwargs)  # pylint: disable=eval-used
 
     def condition_function(**kwargs):
-        return eval(condition, globals(), kwargs)  # pylint: disable=eval-used
+        return eval(condition_code, globals(), kwargs)  # pylint: disable=eval-used
 
     # TODO: Add error handling for failed imports.
     if options["packages"]:
@@ -294,6 +525,43 @@ def main():
         with open(functions_file) as file:
             exec(file.read(), globals(), globals())  # pylint: disable=exec-used
 
+    # Stream the table through a database connection when possible
+    if driver in STREAMING_DRIVERS:
+        # pylint: disable=import-outside-toplevel
+        from grass.pygrass.vector.table import Link
+
+        key = db_info["key"]
+        link = Link(
+            layer=int(layer),
+            name=table,
+            table=table,
+            key=key,
+            database=database,
+            driver=driver,
+        )
+        connection = link.connection()
+        updated = python_to_table(
+            connection=connection,
+            driver=driver,
+            table=table,
+            key=key,
+            where=where,
+            column=column,
+            column_type=column_type,
+            expression=expression,
+            expression_code=expression_code,
+            condition=condition,
+            condition_code=condition_code,
+            ensure_lowercase=not flags["u"],
+        )
+        connection.close()
+        if not updated:
+            gs.message(
+                "No rows to update. Try a different SQL where or Python condition."
+            )
+        gs.vector_history(vector)
+        return
+
     # Get table contents
     if not where:
         # The condition needs to be None, an empty string is passed through.
@@ -616,6 +616,91 @@ class TestBufferstats(TestCase):
         bufferstats.run()
         self.assertLooksLike(bufferstats.outputs.stdout, self.areas_attrs)
 
+    def test_overlapping_buffers(self):
+        """Test that overlapping buffers give the same results as single ones"""
+        self.runModule("g.region", vector=self.inpoint_tmp, align=self.inrast_cont_1)
+        bufferstats = SimpleModule(
+            "v.rast.bufferstats",
+            input=self.inpoint_tmp,
+            raster=self.inrast_cont_1,
+            buffers=[500, 5000],
+            type="points",
+            column_prefix="elev",
+            methods=["number", "minimum", "sum", "median"],
+            output="-",
+        )
+        bufferstats.run()
+        overlapping = bufferstats.outputs.stdout.splitlines()[1:]
+        for cat in self.inpoint_cats.split(","):
+            single_tmp = "{}_{}".format(self.inpoint_tmp, cat)
+            self.runModule(
+                "v.extract",
+                input=self.inpoint_tmp,
+                output=single_tmp,
+                cats=cat,
+                overwrite=True,
+            )
+            bufferstats = SimpleModule(
+                "v.rast.bufferstats",
+                input=single_tmp,
+                raster=self.inrast_cont_1,
+                buffers=[500, 5000],
+                type="points",
+                column_prefix="elev",
+                methods=["number", "minimum", "sum", "median"],
+                output="-",
+            )
+            bufferstats.run()
+            self.runModule("g.remove", flags="f", type="vector", name=single_tmp)
+            single = bufferstats.outputs.stdout.splitlines()[1:]
+            self.assertEqual(
+                single, [line for line in overlapping if line.split("|")[0] == cat]
+            )
+
+    def test_update_keeps_values(self):
+        """Test that columns without result are not overwritten with -u"""
+        self.runModule("g.region", vector=self.inpoint_tmp, align=self.inrast_label)
+        self.runModule(
+            "v.db.addcolumn", map=self.inpoint_tmp, columns="lcw_water_b30 double"
+        )
+        self.runModule(
+            "v.db.update", map=self.inpoint_tmp, column="lcw_water_b30", value=-1
+        )
+        bufferstats = SimpleModule(
+            "v.rast.bufferstats",
+            flags="tl",
+            input=self.inpoint_tmp,
+            raster=self.inrast_label,
+            buffers=[30],
+            type="points",
+            column_prefix="lcw",
+            output="-",
+        )
+        bufferstats.run()
+        water = {}
+        for line in bufferstats.outputs.stdout.splitlines()[1:]:
+            cat, raster_map, buf, statistic, value = line.split("|")
+            if statistic == "area water":
+                water[cat] = float(value)
+        self.assertModule(
+            "v.rast.bufferstats",
+            flags="tlu",
+            input=self.inpoint_tmp,
+            raster=self.inrast_label,
+            buffers=[30],
+            type="points",
+            column_prefix="lcw",
+        )
+        table = gscript.read_command(
+            "v.db.select",
+            map=self.inpoint_tmp,
+            columns="cat,lcw_water_b30",
+            flags="c",
+        )
+        for line in table.splitlines():
+            cat, value = line.split("|")
+            self.assertAlmostEqual(float(value), water.get(cat, -1))
+
 
 if __name__ == "__main__":
     test()
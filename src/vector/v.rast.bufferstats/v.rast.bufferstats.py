@@ -140,18 +140,18 @@ import sys
 import os
 import atexit
 import math
-from subprocess import PIPE
+import numpy as np
 import grass.script as grass
 from grass.pygrass.vector import VectorTopo
 from grass.pygrass.raster.abstract import RasterAbstractBase
 from grass.pygrass.raster import RasterRow
+from grass.pygrass.raster.buffer import Buffer
 from grass.pygrass.gis import Mapset
-from grass.pygrass.vector.geometry import Boundary
-from grass.pygrass.vector.geometry import Centroid
+from grass.pygrass.vector.geometry import Area
+from grass.pygrass.vector.geometry import Point
 from grass.pygrass.gis.region import Region
 
 # from grass.pygrass.vector.table import *
-from grass.pygrass.modules.interface.module import Module
 from itertools import chain
 
 # PY2/PY3 compat
@@ -164,6 +164,13 @@ if "GISBASE" not in os.environ.keys():
 
 TMP_MAPS = []
 
+# Null value of CELL raster maps
+CELL_NULL = -2147483648
+
+# Maximum number of buffer cells (summed over all buffer distances)
+# that are indexed and read at once
+MAX_CELLS = 5000000
+
 
 def cleanup():
     """Remove temporary data"""
@@ -182,8 +189,6 @@ def cleanup():
     except:
         pass
 
-    if RasterRow("MASK", Mapset().name).exist():
-        grass.run_command("r.mask", flags="r", quiet=True)
     reset_mask()
 
 
@@ -254,12 +259,315 @@ def random_name(length):
     return randomname
 
 
-def is_number(s):
+def bbox_cells(region, xmin, xmax, ymin, ymax):
+    """Count the cells of the bounding box aligned to the region
+
+    :param region: PyGRASS Region object defining the cell grid
+    :param xmin, xmax, ymin, ymax: extent of the bounding box
+    :returns: number of cells in the aligned bounding box
+    :rtype: int
+    """
+    rows = math.ceil((region.north - ymin) / region.nsres) - math.floor(
+        (region.north - ymax) / region.nsres
+    )
+    cols = math.ceil((xmax - region.west) / region.ewres) - math.floor(
+        (xmin - region.west) / region.ewres
+    )
+    return max(rows, 1) * max(cols, 1)
+
+
+def polygon_cells(region, rings):
+    """Get the cells with their centre inside a polygon
+
+    Like v.to.rast, the polygon is rasterised by scanlines through the
+    cell centres. Boundary and isles are combined using the even-odd rule.
+
+    :param region: PyGRASS Region object defining the cell grid
+    :param rings: coordinate arrays of the boundary and the isles
+    :type rings: list of numpy arrays with shape (n, 2)
+    :returns: row and column indices of the cells inside the polygon
+    :rtype: tuple of numpy arrays
+    """
+    north = region.north
+    west = region.west
+    nsres = region.nsres
+    ewres = region.ewres
+
+    outer = rings[0]
+    row_start = max(int(math.ceil((north - outer[:, 1].max()) / nsres - 0.5)), 0)
+    row_end = min(
+        int(math.floor((north - outer[:, 1].min()) / nsres - 0.5)), region.rows - 1
+    )
+    if row_end < row_start:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+
+    # All edges of boundary and isles
+    x_1 = np.concatenate([ring[:-1, 0] for ring in rings])
+    y_1 = np.concatenate([ring[:-1, 1] for ring in rings])
+    x_2 = np.concatenate([ring[1:, 0] for ring in rings])
+    y_2 = np.concatenate([ring[1:, 1] for ring in rings])
+
+    # Intersect the edges with the scanlines through the cell centres
+    rows = np.arange(row_start, row_end + 1)
+    y = (north - (rows + 0.5) * nsres)[:, None]
+    crossing = (y_1 > y) != (y_2 > y)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        x = np.where(crossing, x_1 + (y - y_1) * (x_2 - x_1) / (y_2 - y_1), np.inf)
+    x.sort(axis=1)
+
+    # Consecutive pairs of intersections enclose the inside of the polygon
+    pairs = x_1.size // 2
+    x_start = x[:, 0 : 2 * pairs : 2]
+    x_end = x[:, 1 : 2 * pairs : 2]
+    inside = np.isfinite(x_end)
+    col_start = np.ceil((x_start[inside] - west) / ewres - 0.5).astype(np.int64)
+    col_end = np.floor((x_end[inside] - west) / ewres - 0.5).astype(np.int64)
+    col_start = np.maximum(col_start, 0)
+    col_end = np.minimum(col_end, region.cols - 1)
+    run_rows = np.broadcast_to(rows[:, None], inside.shape)[inside]
+
+    # Expand runs of cells
+    lengths = np.maximum(col_end - col_start + 1, 0)
+    offsets = np.arange(lengths.sum()) - np.repeat(
+        np.cumsum(lengths) - lengths, lengths
+    )
+    return np.repeat(run_rows, lengths), np.repeat(col_start, lengths) + offsets
+
+
+def geometry_cells(region, geom, buf):
+    """Get the cells covered by a buffer around a geometry
+
+    Without buffer, areas cover the cells with their centre inside the
+    area, points the cell they fall in and lines the cells they cross.
+
+    :param region: PyGRASS Region object defining the cell grid
+    :param geom: PyGRASS geometry (Point, Line or Area)
+    :param buf: buffer distance in map units
+    :returns: row and column indices of the cells covered by the buffer and
+              the number of cells in the bounding box of the buffer
+    :rtype: tuple
+    """
+    if buf > 0 or isinstance(geom, Area):
+        if buf > 0:
+            buffer_geom = geom.buffer(buf)
+            rings = [buffer_geom[0].to_list()]
+            if len(buffer_geom) > 2:
+                rings.extend(isle.to_list() for isle in buffer_geom[2])
+        else:
+            rings = [geom.points().to_list()]
+            rings.extend(isle.points().to_list() for isle in geom.isles())
+        rings = [np.asarray(ring, dtype=np.float64)[:, :2] for ring in rings]
+        rings = [
+            ring if (ring[0] == ring[-1]).all() else np.vstack((ring, ring[:1]))
+            for ring in rings
+        ]
+        rows, cols = polygon_cells(region, rings)
+        coords = rings[0]
+    else:
+        if isinstance(geom, Point):
+            coords = np.array([[geom.x, geom.y]])
+            samples = coords
+        else:
+            # Sample lines densely enough to hit every cell crossed
+            coords = np.asarray(geom.to_list(), dtype=np.float64)[:, :2]
+            step = min(region.nsres, region.ewres) / 2.0
+            samples = [coords[-1:]]
+            for start, end in zip(coords[:-1], coords[1:]):
+                n = int(math.ceil(np.hypot(*(end - start)) / step)) + 1
+                samples.append(np.linspace(start, end, n, endpoint=False))
+            samples = np.concatenate(samples)
+        rows = np.floor((region.north - samples[:, 1]) / region.nsres).astype(np.int64)
+        cols = np.floor((samples[:, 0] - region.west) / region.ewres).astype(np.int64)
+        inside = (rows >= 0) & (rows < region.rows) & (cols >= 0) & (cols < region.cols)
+        cells = np.unique(rows[inside] * region.cols + cols[inside])
+        rows, cols = np.divmod(cells, region.cols)
+
+    n_bbox = bbox_cells(
+        region,
+        coords[:, 0].min(),
+        coords[:, 0].max(),
+        coords[:, 1].min(),
+        coords[:, 1].max(),
+    )
+    return rows, cols, n_bbox
+
+
+def cell_areas(region):
+    """Get the area of the cells in every row of the region
+
+    In latitude-longitude locations the area is computed on a sphere with
+    the authalic radius of the WGS84 ellipsoid.
+
+    :param region: PyGRASS Region object
+    :returns: cell area for every row
+    :rtype: numpy array
+    """
+    if not grass.locn_is_latlong():
+        return np.full(region.rows, region.nsres * region.ewres)
+    radius = 6371007.181
+    edges = np.radians(region.north - np.arange(region.rows + 1) * region.nsres)
+    return (
+        radius ** 2
+        * np.radians(region.ewres)
+        * (np.sin(edges[:-1]) - np.sin(edges[1:]))
+    )
+
+
+def read_cells(region, raster_maps, rows, cols):
+    """Read the values of a set of cells from raster maps
+
+    Every raster row containing at least one of the cells is read only
+    once per map.
+
+    :param region: PyGRASS Region object the cells are indexed in
+    :param raster_maps: names of the raster maps to read
+    :param rows: row indices of the cells
+    :param cols: column indices of the cells
+    :returns: values of the cells for every map, NaN for no data
+    :rtype: list of numpy arrays
+    """
+    values = [np.full(rows.size, np.nan) for rmap in raster_maps]
+    if not rows.size:
+        return values
+
+    # Group the cells by row
+    order = np.argsort(rows, kind="mergesort")
+    sorted_rows = rows[order]
+    bounds = np.flatnonzero(np.diff(sorted_rows)) + 1
+    starts = np.concatenate(([0], bounds))
+    stops = np.concatenate((bounds, [sorted_rows.size]))
+
+    maps = []
     try:
-        float(s)
-        return True
-    except ValueError:
-        return False
+        for rmap in raster_maps:
+            r_map = RasterRow(rmap)
+            r_map.open("r")
+            maps.append((r_map, Buffer((region.cols,), mtype=r_map.mtype)))
+        for start, stop in zip(starts, stops):
+            idx = order[start:stop]
+            row_cols = cols[idx]
+            for (r_map, row_buffer), vals in zip(maps, values):
+                r_map.get_row(int(sorted_rows[start]), row_buffer)
+                row_vals = np.asarray(row_buffer)[row_cols]
+                if r_map.mtype == "CELL":
+                    row_vals = np.where(row_vals == CELL_NULL, np.nan, row_vals)
+                vals[idx] = row_vals
+    finally:
+        for r_map, row_buffer in maps:
+            r_map.close()
+
+    return values
+
+
+def univar_stats(values, zones, n_zones, percentile=None):
+    """Compute univariate statistics of values grouped by zones
+
+    Statistics are computed like in r.univar (population variance,
+    quartiles and percentiles taken from the sorted values).
+
+    :param values: values of the cells, NaN for no data
+    :param zones: zone index of every cell
+    :param n_zones: number of zones
+    :param percentile: percentiles to compute
+    :returns: statistics for every zone by method name and percentiles
+    :rtype: tuple of dict and list
+    """
+    valid = ~np.isnan(values)
+    n = np.bincount(zones[valid], minlength=n_zones)
+    stats = {
+        "number": n,
+        "number_null": np.bincount(zones[~valid], minlength=n_zones),
+    }
+
+    # Sort values by zone and value
+    vals = values[valid]
+    zone = zones[valid]
+    order = np.lexsort((vals, zone))
+    vals = vals[order]
+    zone = zone[order]
+    starts = np.cumsum(n) - n
+    has_data = n > 0
+    starts = starts[has_data]
+    counts = n[has_data]
+
+    def ranked(idx):
+        result = np.full(n_zones, np.nan)
+        result[has_data] = vals[starts + idx]
+        return result
+
+    def quantile(perc):
+        return ranked(np.maximum(np.trunc(counts * perc - 0.5).astype(np.int64), 0))
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        total = np.bincount(zone, weights=vals, minlength=n_zones)
+        mean = total / n
+        deviation = vals - mean[zone]
+        variance = np.bincount(zone, weights=deviation ** 2, minlength=n_zones) / n
+        stats["minimum"] = ranked(0)
+        stats["maximum"] = ranked(counts - 1)
+        stats["range"] = stats["maximum"] - stats["minimum"]
+        stats["sum"] = np.where(has_data, total, np.nan)
+        stats["average"] = mean
+        stats["average_abs"] = (
+            np.bincount(zone, weights=np.abs(vals), minlength=n_zones) / n
+        )
+        stats["variance"] = variance
+        stats["stddev"] = np.sqrt(variance)
+        stats["coeff_var"] = 100.0 * stats["stddev"] / mean
+        stats["first_quartile"] = quantile(0.25)
+        stats["median"] = (ranked((counts - 1) // 2) + ranked(counts // 2)) / 2.0
+        stats["third_quartile"] = quantile(0.75)
+        percentiles = [quantile(perc / 100.0) for perc in percentile or []]
+
+    return stats, percentiles
+
+
+def tabulate_stats(values, zones, n_zones, areas):
+    """Tabulate the categories of values grouped by zones
+
+    :param values: category values of the cells, NaN for no data
+    :param zones: zone index of every cell
+    :param n_zones: number of zones
+    :param areas: area of every cell
+    :returns: categories, cell counts and areas (sorted by zone and
+              category) with the index of the first category of every zone,
+              and cell counts and areas of no data for every zone
+    :rtype: tuple
+    """
+    valid = ~np.isnan(values)
+    zone = zones[valid]
+    cats = values[valid].astype(np.int64)
+
+    # Index the unique combinations of zone and category
+    order = np.lexsort((cats, zone))
+    zone = zone[order]
+    cats = cats[order]
+    new = np.ones(zone.size, dtype=bool)
+    new[1:] = (zone[1:] != zone[:-1]) | (cats[1:] != cats[:-1])
+    group = np.cumsum(new) - 1
+    n_groups = int(new.sum())
+
+    counts = np.bincount(group, minlength=n_groups)
+    cat_areas = np.bincount(group, weights=areas[valid][order], minlength=n_groups)
+    first = np.searchsorted(zone[new], np.arange(n_zones + 1))
+    null_counts = np.bincount(zones[~valid], minlength=n_zones)
+    null_areas = np.bincount(zones[~valid], weights=areas[~valid], minlength=n_zones)
+    return cats[new], counts, cat_areas, first, null_counts, null_areas
+
+
+def db_value(value):
+    """Convert a statistic to a value for the attribute table
+
+    :param value: statistic (NumPy or Python number or None)
+    :returns: Python number or None for missing and non-finite values
+    """
+    if value is None:
+        return None
+    if isinstance(value, (int, np.integer)):
+        return int(value)
+    if not np.isfinite(value):
+        return None
+    return float(value)
 
 
 def raster_type(raster, tabulate, use_label):
@@ -330,7 +638,7 @@ def main():
     percentile = (
         None
         if options["percentile"] == ""
-        else map(float, options["percentile"].split(","))
+        else list(map(float, options["percentile"].split(",")))
     )
     column_prefix = tuple(options["column_prefix"].split(","))
     buffers = options["buffers"].split(",")
@@ -421,12 +729,14 @@ def main():
     # Generate list of required column names and types
     col_names = []
     valid_labels = []
+    raster_cats = []
     col_types = []
     for p in column_prefix:
         rmaptype, val_lab, rcats = raster_type(
             raster_maps[column_prefix.index(p)], tabulate, use_label
         )
         valid_labels.append(val_lab)
+        raster_cats.append(rcats)
 
         for b in buffers:
             b_str = str(b).replace(".", "_")
@@ -478,36 +788,6 @@ def main():
     global TMP_MAPS
     TMP_MAPS.append(tmp_map)
 
-    # Setup stats collectors
-    if tabulate:
-        # Collector for raster category statistics
-        stats = Module("r.stats", run_=False, stdout_=PIPE)
-        stats.inputs.sort = "desc"
-        stats.inputs.null_value = "null"
-        stats.flags.quiet = True
-        stats.flags.l = True
-        if percent:
-            stats.flags.p = True
-            stats.flags.n = True
-        else:
-            stats.flags.a = True
-    else:
-        # Collector for univariat statistics
-        univar = Module("r.univar", run_=False, stdout_=PIPE)
-        univar.inputs.separator = sep
-        univar.flags.g = True
-        univar.flags.quiet = True
-
-        # Add extended statistics if requested
-        if set(methods).intersection(
-            set(["first_quartile", "median", "third_quartile"])
-        ):
-            univar.flags.e = True
-
-        if percentile is not None:
-            univar.flags.e = True
-            univar.inputs.percentile = percentile
-
     # Check if attribute table exists
     if not output:
         if not in_vect.table:
@@ -533,6 +813,7 @@ def main():
                 grass.warning(
                     "Column(s) {} already exist!".format(",".join(existing_cols))
                 )
+        update_cols = list(col_names)
         for e in existing_cols:
             idx = col_names.index(e)
             del col_names[idx]
@@ -542,7 +823,9 @@ def main():
         conn = tab.conn
         cur = conn.cursor()
 
-        sql_str_start = "UPDATE {} SET ".format(tab_name)
+        # UPDATE statements are prepared per set of result columns
+        placeholder = "%s" if tab_cols.is_pg() else "?"
+        update_idx = {col: idx for idx, col in enumerate(update_cols)}
 
     elif output == "-":
         print("cat{0}raster_map{0}buffer{0}statistic{0}value".format(sep))
@@ -551,325 +834,250 @@ def main():
             "cat{0}raster_map{0}buffer{0}statistic{0}value{1}".format(sep, os.linesep)
         )
 
-    # Get computational region
+    # Get computational region and extend it to the buffers around all
+    # geometries, keeping the alignment of the current region
     grass.use_temp_region()
     r = Region()
     r.read()
+    bbox = in_vect.bbox()
+    max_buf = max(buffers)
+    bbox.north = bbox.north + max_buf
+    bbox.south = bbox.south - max_buf
+    bbox.east = bbox.east + max_buf
+    bbox.west = bbox.west - max_buf
+    r = align_current(r, bbox)
+    r.write()
+    r.set_raster_region()
+    row_areas = cell_areas(r)
+
+    # Cells outside of a user MASK are not part of the buffers
+    read_maps = list(raster_maps)
+    if user_mask:
+        read_maps.append("{}_MASK".format(tmp_map))
+
+    # Names (labels or category numbers) of raster categories
+    cat_names = []
+    for rm, rcats in enumerate(raster_cats):
+        cat_names.append(
+            {
+                int(float(rcat[1])): rcat[0] if valid_labels[rm] else str(rcat[1])
+                for rcat in rcats
+            }
+        )
 
-    # Adjust region extent to buffer around geometry
-    # reg = deepcopy(r)
-
-    # Create iterator for geometries of all selected types
-    geoms = chain()
-    geoms_n = 0
-    n_geom = 1
-    for geom_type in types:
-        geoms_n += in_vect.number_of(geom_type)
-        if in_vect.number_of(geom_type) > 0:
-            geoms = chain(in_vect.viter(geom_type))
-
-    # Loop over geometries
-    for geom in geoms:
-        # Get cat
-        cat = geom.cat
+    def write_results(cats, cells):
+        """Compute and write statistics for a chunk of geometries
 
-        # Add where clause to UPDATE statement
-        sql_str_end = " WHERE cat = {};".format(cat)
+        :param cats: category of every geometry in the chunk
+        :param cells: per buffer distance, list of rows, columns and
+                      number of cells in the bounding box of every geometry
+        """
+        n_zones = len(cats)
+        lines = [[] for cat in cats]
+        if not output:
+            updates = [{} for cat in cats]
 
-        # Loop over ser provided buffer distances
         for buf in buffers:
             b_str = str(buf).replace(".", "_")
-            # Buffer geometry
-            if buf <= 0:
-                buffer_geom = geom
-            else:
-                buffer_geom = geom.buffer(buf)
-            # Create temporary vector map with buffered geometry
-            tmp_vect = VectorTopo(tmp_map, quiet=True)
-            tmp_vect.open(mode="w")
-            tmp_vect.write(Boundary(points=buffer_geom[0].to_list()))
-            # , c_cats=int(cat), set_cats=True
-            if callable(buffer_geom[1]):
-                tmp_vect.write(
-                    Centroid(x=buffer_geom[1]().x, y=buffer_geom[1]().y), cat=int(cat)
-                )
-            else:
-                tmp_vect.write(
-                    Centroid(x=buffer_geom[1].x, y=buffer_geom[1].y), cat=int(cat)
-                )
+            rows = np.concatenate([cell[0] for cell in cells[buf]])
+            cols = np.concatenate([cell[1] for cell in cells[buf]])
+            n_bbox = np.array([cell[2] for cell in cells[buf]])
+            zones = np.repeat(np.arange(n_zones), [cell[0].size for cell in cells[buf]])
 
-            #################################################
-            # How to silence VectorTopo???
-            #################################################
-
-            # Save current stdout
-            # original = sys.stdout
-
-            # f = open(os.devnull, 'w')
-            # with open('output.txt', 'w') as f:
-            # sys.stdout = io.BytesIO()
-            # sys.stdout.fileno() = os.devnull
-            # sys.stderr = f
-            # os.environ.update(dict(GRASS_VERBOSE='0'))
-            tmp_vect.close(build=False)
-            grass.run_command("v.build", map=tmp_map, quiet=True)
-            # os.environ.update(dict(GRASS_VERBOSE='1'))
-
-            # reg = Region()
-            # reg.read()
-            # r.from_vect(tmp_map)
-            r = align_current(r, buffer_geom[0].bbox())
-            r.write()
-
-            # Check if the following is needed
-            # needed specially with r.stats -p
-            # grass.run_command('g.region', vector=tmp_map, flags='a')
-
-            # Create a MASK from buffered geometry
+            # Read all raster maps in one pass over the rows of the buffers
+            values = read_cells(r, read_maps, rows, cols)
             if user_mask:
-                grass.run_command(
-                    "v.to.rast",
-                    input=tmp_map,
-                    output=tmp_map,
-                    use="val",
-                    value=int(cat),
-                    quiet=True,
-                )
-                mc_expression = (
-                    "MASK=if(!isnull({0}) && !isnull({0}_MASK), {1}, null())".format(
-                        tmp_map, cat
-                    )
-                )
-                grass.run_command("r.mapcalc", expression=mc_expression, quiet=True)
-            else:
-                grass.run_command(
-                    "v.to.rast",
-                    input=tmp_map,
-                    output="MASK",
-                    use="val",
-                    value=int(cat),
-                    quiet=True,
-                )
-
-            # reg.write()
+                keep = ~np.isnan(values.pop())
+                rows = rows[keep]
+                zones = zones[keep]
+                values = [vals[keep] for vals in values]
 
-            updates = []
-            # Compute statistics for every raster map
             for rm, rmap in enumerate(raster_maps):
-                # rmap = raster_maps[rm]
                 prefix = column_prefix[rm]
+                results = [[] for cat in cats]
 
                 if tabulate:
-                    # Get statistics on occurrence of raster categories within buffer
-                    stats.inputs.input = rmap
-                    stats.run()
-                    t_stats = (
-                        stats.outputs["stdout"]
-                        .value.rstrip(os.linesep)
-                        .replace("  ", " ")
-                        .replace("no data", "no_data")
-                        .replace(" ", "_b{} = ".format(b_str))
-                        .split(os.linesep)
-                    )
-                    if t_stats == [""]:
-                        grass.warning(empty_buffer_warning.format(rmap, buf, cat))
-                        continue
-                    if (
-                        t_stats[0].split("_b{} = ".format(b_str))[0].split("_")[-1]
-                        != "null"
-                    ):
-                        mode = (
-                            t_stats[0].split("_b{} = ".format(b_str))[0].split("_")[-1]
-                        )
-                    elif len(t_stats) == 1:
-                        mode = "NULL"
-                    else:
-                        mode = (
-                            t_stats[1].split("_b{} = ".format(b_str))[0].split("_")[-1]
-                        )
-
-                    if not output:
-                        updates.append(
-                            "\t{}_{}_b{} = {}".format(
-                                prefix, "ncats", b_str, len(t_stats)
-                            )
-                        )
-                        updates.append(
-                            "\t{}_{}_b{} = {}".format(prefix, "mode", b_str, mode)
+                    (
+                        rcats,
+                        counts,
+                        areas,
+                        first,
+                        null_counts,
+                        null_areas,
+                    ) = tabulate_stats(values[rm], zones, n_zones, row_areas[rows])
+                    for z in range(n_zones):
+                        # Categories sorted by decreasing area
+                        t_stats = sorted(
+                            zip(
+                                counts[first[z] : first[z + 1]],
+                                areas[first[z] : first[z + 1]],
+                                rcats[first[z] : first[z + 1]],
+                            ),
+                            key=lambda t_stat: (-t_stat[0], t_stat[2]),
                         )
-
-                        area_tot = 0
-                        for l in t_stats:
-                            # check if raster maps has category or not
-                            if len(l.split("=")) == 2:
-                                updates.append("\t{}_{}".format(prefix, l.rstrip("%")))
-                            elif not l.startswith("null"):
-                                vals = l.split("=")
-                                updates.append(
-                                    "\t{}_{} = {}".format(
-                                        prefix,
-                                        vals[-2].strip()
-                                        if valid_labels[rm]
-                                        else vals[0].strip(),
-                                        vals[-1].strip().rstrip("%"),
-                                    )
-                                )
-                            if not l.startswith("null"):
-                                area_tot += float(l.rstrip("%").split("= ")[-1])
-                        if not percent:
-                            updates.append(
-                                "\t{}_{}_b{} = {}".format(
-                                    prefix, "area_tot", b_str, area_tot
+                        mode = t_stats[0][2] if t_stats else None
+                        if percent:
+                            t_stats = [
+                                (rcat, round(100.0 * count / n_bbox[z], 2))
+                                for count, area, rcat in t_stats
+                            ]
+                        else:
+                            t_stats = [(rcat, area) for count, area, rcat in t_stats]
+                            if null_counts[z] > 0:
+                                t_stats.insert(
+                                    np.searchsorted(
+                                        [-t_stat[1] for t_stat in t_stats],
+                                        -null_areas[z],
+                                    ),
+                                    (None, null_areas[z]),
                                 )
+                        if not t_stats:
+                            grass.warning(
+                                empty_buffer_warning.format(rmap, buf, cats[z])
                             )
+                            continue
 
-                    else:
-                        out_str = "{1}{0}{2}{0}{3}{0}{4}{0}{5}{6}".format(
-                            sep, cat, prefix, buf, "ncats", len(t_stats), os.linesep
+                        result = results[z]
+                        result.append(
+                            ("ncats", "ncats", len(t_stats), str(len(t_stats)))
                         )
-                        out_str += "{1}{0}{2}{0}{3}{0}{4}{0}{5}{6}".format(
-                            sep, cat, prefix, buf, "mode", mode, os.linesep
+                        result.append(
+                            ("mode", "mode", mode, "NULL" if mode is None else mode)
                         )
                         area_tot = 0
-                        for l in t_stats:
-                            rcat = (
-                                l.split("= ")[1].rstrip("_b{} = ".format(b_str))
-                                if valid_labels[rm]
-                                else l.split("_")[0]
+                        for rcat, area in t_stats:
+                            area_str = (
+                                "{:.2f}%".format(area)
+                                if percent
+                                else "{:f}".format(area)
                             )
-                            area = l.split("= ")[-1]
-                            out_str += "{1}{0}{2}{0}{3}{0}{4}{0}{5}{6}".format(
-                                sep,
-                                cat,
-                                prefix,
-                                buf,
-                                "area {}".format(rcat),
-                                area,
-                                os.linesep,
-                            )
-                            if rcat != "null":
-                                area_tot = area_tot + float(
-                                    l.rstrip("%").split("= ")[-1]
+                            if rcat is None:
+                                result.append(("null", "area null", area, area_str))
+                                continue
+                            area_tot += area
+                            rcat_name = cat_names[rm].get(rcat, str(rcat))
+                            result.append(
+                                (
+                                    rcat_name.replace(" ", "_"),
+                                    "area {}".format(rcat_name),
+                                    area,
+                                    area_str,
                                 )
+                            )
                         if not percent:
-                            out_str += "{1}{0}{2}{0}{3}{0}{4}{0}{5}{6}".format(
-                                sep,
-                                cat,
-                                prefix,
-                                buf,
-                                "area total",
-                                area_tot,
-                                os.linesep,
+                            result.append(
+                                ("area_tot", "area total", area_tot, str(area_tot))
                             )
-
-                        if output == "-":
-                            print(out_str.rstrip(os.linesep))
-                        else:
-                            out.write(out_str)
-
                 else:
-                    # Get univariate statistics within buffer
-                    univar.inputs.map = rmap
-                    univar.run()
-                    u_stats = (
-                        univar.outputs["stdout"]
-                        .value.rstrip(os.linesep)
-                        .replace("=", "_b{} = ".format(b_str))
-                        .split(os.linesep)
+                    stats, percentiles = univar_stats(
+                        values[rm], zones, n_zones, percentile
                     )
-
-                    # Test if u_stats is empty and give warning
-                    # Needs to be adjusted to number of requested stats?
-                    if (
-                        (percentile and len(u_stats) < 14)
-                        or (univar.flags.e and len(u_stats) < 13)
-                        or len(u_stats) < 12
-                    ):
-                        grass.warning(empty_buffer_warning.format(rmap, buf, cat))
-                        break
-
-                    # Extract statistics for selected methods
-                    for m in methods:
-                        if not output:
-                            # Add to list of UPDATE statements
-                            updates.append(
-                                "\t{}_{}".format(
-                                    prefix,
-                                    u_stats[int_dict[m][0]]
-                                    if is_number(
-                                        u_stats[int_dict[m][0]].split(" = ")[1]
-                                    )
-                                    else " = ".join(
-                                        [
-                                            u_stats[int_dict[m][0]].split(" = ")[0],
-                                            "NULL",
-                                        ]
-                                    ),
+                    for z in range(n_zones):
+                        if stats["number"][z] == 0:
+                            grass.warning(
+                                empty_buffer_warning.format(rmap, buf, cats[z])
+                            )
+                            continue
+                        result = results[z]
+                        for m in methods:
+                            result.append(
+                                (
+                                    int_dict[m][2],
+                                    m,
+                                    stats[m][z],
+                                    "{:.15g}".format(stats[m][z]),
                                 )
                             )
-                        else:
-                            out_str = "{1}{0}{2}{0}{3}{0}{4}{0}{5}".format(
-                                sep,
-                                cat,
-                                prefix,
-                                buf,
-                                m,
-                                u_stats[int_dict[m][0]].split("= ")[1],
+                        for perc, perc_stats in zip(percentile or [], percentiles):
+                            perc_str = "percentile_{}".format(
+                                int(perc) if perc.is_integer() else perc
                             )
-                            if output == "-":
-                                print(out_str)
-                            else:
-                                out.write("{}{}".format(out_str, os.linesep))
-
-                    if percentile:
-                        perc_count = 0
-                        for perc in percentile:
-                            if not output:
-                                updates.append(
-                                    "{}_percentile_{}_b{} = {}".format(
-                                        p,
-                                        int(perc) if (perc).is_integer() else perc,
-                                        b_str,
-                                        u_stats[15 + perc_count].split("= ")[1],
-                                    )
+                            result.append(
+                                (
+                                    perc_str,
+                                    perc_str,
+                                    perc_stats[z],
+                                    "{:.15g}".format(perc_stats[z]),
                                 )
-                            else:
-                                out_str = "{1}{0}{2}{0}{3}{0}{4}{0}{5}".format(
-                                    sep,
-                                    cat,
-                                    prefix,
-                                    buf,
-                                    "percentile_{}".format(
-                                        int(perc) if (perc).is_integer() else perc
-                                    ),
-                                    u_stats[15 + perc_count].split("= ")[1],
+                            )
+
+                # Collect results per geometry
+                for z, result in enumerate(results):
+                    for col, statistic, value, value_str in result:
+                        if output:
+                            lines[z].append(
+                                "{1}{0}{2}{0}{3}{0}{4}{0}{5}".format(
+                                    sep, cats[z], prefix, buf, statistic, value_str
                                 )
-                                if output == "-":
-                                    print(out_str)
-                                else:
-                                    out.write(out_str)
-                            perc_count = perc_count + 1
-
-            if not output and len(updates) > 0:
-                cur.execute(
-                    "{}{}{}".format(sql_str_start, ",\n".join(updates), sql_str_end)
+                            )
+                            continue
+                        idx = update_idx.get("{}_{}_b{}".format(prefix, col, b_str))
+                        if idx is not None and col != "null":
+                            updates[z][idx] = db_value(value)
+
+        # Write results in the order of the input geometries
+        if output == "-":
+            for line in chain(*lines):
+                print(line)
+        elif output:
+            for line in chain(*lines):
+                out.write("{}{}".format(line, os.linesep))
+        else:
+            # Only columns with a result are updated, so that existing
+            # values are kept for geometries or statistics without result
+            groups = {}
+            for cat, update in zip(cats, updates):
+                if update:
+                    idxs = tuple(sorted(update))
+                    groups.setdefault(idxs, []).append(
+                        [update[idx] for idx in idxs] + [cat]
+                    )
+            for idxs, rows in groups.items():
+                sql_str = "UPDATE {} SET {} WHERE cat = {};".format(
+                    tab_name,
+                    ", ".join(
+                        "{} = {}".format(update_cols[idx], placeholder) for idx in idxs
+                    ),
+                    placeholder,
                 )
+                cur.executemany(sql_str, rows)
+            conn.commit()
 
-            # Remove temporary maps
-            # , stderr=os.devnull, stdout_=os.devnull)
-            grass.run_command(
-                "g.remove", flags="f", type="raster", name="MASK", quiet=True
-            )
-            grass.run_command(
-                "g.remove", flags="f", type="vector", name=tmp_map, quiet=True
-            )
+    # Create iterator for geometries of all selected types
+    geoms_n = 0
+    geom_iters = []
+    for geom_type in types:
+        if in_vect.number_of(geom_type) > 0:
+            geoms_n += in_vect.number_of(geom_type)
+            geom_iters.append(in_vect.viter(geom_type))
+    geoms = chain(*geom_iters)
+
+    # Index the cells covered by the buffers of a chunk of geometries
+    # and compute their statistics at once
+    chunk_cats = []
+    chunk_cells = {buf: [] for buf in buffers}
+    n_cells = 0
+    for n_geom, geom in enumerate(geoms, 1):
+        if geom.cat is None:
+            continue
+        chunk_cats.append(geom.cat)
+        for buf in buffers:
+            cell = geometry_cells(r, geom, buf)
+            chunk_cells[buf].append(cell)
+            n_cells += cell[0].size
+        if n_cells >= MAX_CELLS:
+            write_results(chunk_cats, chunk_cells)
+            chunk_cats = []
+            chunk_cells = {buf: [] for buf in buffers}
+            n_cells = 0
 
         # Give progress information
         grass.percent(n_geom, geoms_n, 1)
-        n_geom = n_geom + 1
 
-        if not output:
-            conn.commit()
+    if chunk_cats:
+        write_results(chunk_cats, chunk_cells)
+
+    in_vect.close()
 
     # Close cursor and DB connection
     if not output and not output == "-":
@@ -14,6 +14,7 @@ for details.
 """
 
 from grass.gunittest.case import TestCase
+from grass.gunittest.gmodules import SimpleModule
 from grass.pygrass.vector import VectorTopo
 
 
@@ -208,9 +209,9 @@ class TestStreamOrderFails(TestCase):
             verbose=True,
         )
 
-    def test_error_handling_4(self):
-        # Recursion limit is below 1000
-        self.assertModuleFail(
+    def test_recursionlimit(self):
+        # The recursion limit is deprecated and ignored
+        module = SimpleModule(
             "v.stream.order",
             input="stream_network",
             points="stream_network_outlets",
@@ -219,8 +220,9 @@ class TestStreamOrderFails(TestCase):
             order=["strahler", "shreve", "drwal", "scheidegger"],
             recursionlimit=0,
             overwrite=True,
-            verbose=True,
         )
+        self.assertModule(module)
+        self.assertIn("recursionlimit", module.outputs.stderr)
 
     def test_error_handling_5(self):
         # Horton order is not implemented
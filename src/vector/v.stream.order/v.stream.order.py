@@ -66,16 +66,16 @@
 #%option
 #% key: recursionlimit
 #% type: integer
-#% description:The Python recursion limit that should be used (Python default is 1000)
+#% description: Deprecated and ignored, the stream networks are traversed without recursion
 #% required : no
-#% answer: 10000
 #% multiple: no
 #%end
-
 import os
-import sys
+import ctypes
+from array import array
 from grass.script import core as grass
 from grass.pygrass.vector import VectorTopo
+import grass.lib.vector as libvect
 import math
 
 # for Python 3 compatibility
@@ -88,212 +88,173 @@ ORDER_STRAHLER = 1
 ORDER_SHREVE = 2
 ORDER_SCHEIDEGGER = 3
 ORDER_DRWAL = 4
-ORDER_HORTON = 5
 
 ORDER_DICT = {
     ORDER_STRAHLER: "strahler",
     ORDER_SHREVE: "shreve",
     ORDER_SCHEIDEGGER: "scheidegger",
     ORDER_DRWAL: "drwal",
-    ORDER_HORTON: "horton",
 }
 
 
-class GraphEdge(object):
+class StreamGraph(object):
     """
-    This class defines a single edge of the stream network graph
+    This class stores the line-node topology of the stream network vector
+    map in compressed sparse row arrays: the ids of the lines at node n
+    are node_lines[node_ptr[n]:node_ptr[n + 1]], in the order of the
+    topology, and the start and end node of line l are line_start[l] and
+    line_end[l]
     """
 
-    def __init__(self, id_, id_pol, start, end, start_edges, end_edges, reverse=False):
-        self.id = id_  # Line id
-        self.id_pol = id_pol  # Polarity of line positive integer or negative integer
-        self.start = start  # Start Node id
-        self.end = end  # End Node id
-        self.start_edges = start_edges  # A list of edge ids at the start node
-        self.end_edges = end_edges  # A list of edge ids at the end node
-        self.reverse = reverse  # If the edge should be reversed
-        self.stream_order = {
-            ORDER_STRAHLER: 0,
-            ORDER_SHREVE: 0,
-            ORDER_SCHEIDEGGER: 0,
-            ORDER_DRWAL: 0,
-        }  # stream_order for each algorithm
-
-    def __str__(self):
-        return (
-            "Line id: %i (%i) start node: %i "
-            "end node: %i num start edges %i "
-            "num end edges %i   reverse: %s stream_order: %s"
-            % (
-                self.id,
-                self.id_pol,
-                self.start,
-                self.end,
-                len(self.start_edges),
-                len(self.end_edges),
-                self.reverse,
-                str(self.stream_order),
-            )
-        )
-
-
-class GraphNode(object):
-    """
-    This class defines a single node of the node network graph
+    def __init__(self, vector):
+        """
+        Read the topology of the opened vector map in one pass
+
+        :param vector: The opened vector input file
+        """
+        mapinfo = vector.c_mapinfo
+        num_nodes = libvect.Vect_get_num_nodes(mapinfo)
+        num_lines = libvect.Vect_get_num_lines(mapinfo)
+
+        self.node_ptr = array("l", [0, 0])
+        self.node_lines = array("l")
+        for node in xrange(1, num_nodes + 1):
+            if libvect.Vect_node_alive(mapinfo, node):
+                for i in xrange(libvect.Vect_get_node_n_lines(mapinfo, node)):
+                    line = libvect.Vect_get_node_line(mapinfo, node, i)
+                    self.node_lines.append(abs(line))
+            self.node_ptr.append(len(self.node_lines))
+
+        self.line_start = array("l", [0]) * (num_lines + 1)
+        self.line_end = array("l", [0]) * (num_lines + 1)
+        n1 = ctypes.c_int()
+        n2 = ctypes.c_int()
+        for line in xrange(1, num_lines + 1):
+            if libvect.Vect_get_line_type(mapinfo, line) & libvect.GV_LINES:
+                libvect.Vect_get_line_nodes(
+                    mapinfo, line, ctypes.byref(n1), ctypes.byref(n2)
+                )
+                self.line_start[line] = n1.value
+                self.line_end[line] = n2.value
+
+    def lines(self, node):
+        """
+        Return the ids of the lines at a node
+
+        :param node: The node id
+        :return: A list of line ids
+        """
+        return self.node_lines[self.node_ptr[node] : self.node_ptr[node + 1]].tolist()
+
+    def network(self, start_node):
+        """
+        Collect the lines of the stream network connected to a node with
+        depth-first search. The lines are listed in the order in which
+        they are discovered, an explicit stack is used, so that there is
+        no limit on the size of the network.
+
+        :param start_node: The start node id
+        :return: A list of line ids
+        """
+        nodes = set([start_node])
+        discovered = set()
+        lines = []
+
+        def visit(node):
+            # Put each new line of the node into the list, then
+            # yield its start and end node for traversing
+            for line in self.lines(node):
+                if line not in discovered:
+                    discovered.add(line)
+                    lines.append(line)
+                yield self.line_start[line]
+                yield self.line_end[line]
+
+        stack = [visit(start_node)]
+        while stack:
+            node = next(stack[-1], None)
+            if node is None:
+                stack.pop()
+            elif node not in nodes:
+                nodes.add(node)
+                stack.append(visit(node))
+
+        return lines
+
+
+def traverse_graph_create_stream_order(graph, start_id):
     """
+    Traverse the graph upstream from the outlet edge, reverse lines that
+    are not in the outflow direction and compute the stream orders.
 
-    def __init__(self, id_, edge_ids):
-        self.id = id_  # Node id
-        self.edge_ids = edge_ids  # Line ids
-
-    def __str__(self):
-        return "Node id: %i line ids: %s" % (self.id, self.edge_ids)
-
-
-def traverse_graph_create_stream_order(
-    start_id,
-    edges,
-    checked_edges,
-    reversed_edges,
-    order_types=[ORDER_STRAHLER, ORDER_SHREVE],
-):
-    """
-    Traverse the graph, reverse lines that are not in
-    the outflow direction and compute the required orders
+    The edges are visited in depth-first order with an explicit stack,
+    the orders of an edge are computed when all its upstream edges are
+    done. Only the Strahler and Shreve orders are stored, the Scheidegger
+    and Drwal orders are derived from the Shreve order.
 
+    :param graph: The StreamGraph of the stream network vector map
     :param start_id: The id of the edge to start the traversing from
-    :param edges: A dictionary of edge objects
-    :param checked_edges: A list with edge ids that have been checked already
-    :param reversed_edges: A list of edges that have been checked for
-                           reversion and corrected if necessary
-    :param order_types: The type of the ordering scheme as a list of ints
-                      * ORDER_STRAHLER = 1
-                      * ORDER_SHREVE = 2
-                      * ORDER_SCHEIDEGGER = 3
-                      * ORDER_DRWAL = 4
-                      * ORDER_HORTON = 5 -> Not correct implemented
-
-    :return:
+    :return: A tuple with the set of reversed edge ids and two
+             dictionaries with the Strahler and Shreve order of each
+             visited edge id
     """
-    current_edge = edges[start_id]
-
-    # Check for direction reversion
-    for edge_id in current_edge.start_edges:
-        if edge_id not in reversed_edges:
-            reversed_edges.append(edge_id)
-            edge = edges[edge_id]
-
-            # Reverse the edge if it is not in the outflow direction
-            if current_edge.start != edge.end:
-                start = edge.start
-                start_edges = edge.start_edges
-                edge.start = edge.end
-                edge.start_edges = edge.end_edges
-                edge.end = start
-                edge.end_edges = start_edges
-                edge.reverse = True
-
-    # Set the stream_order to one, if the edge is a leaf and return
-    if len(current_edge.start_edges) == 0:
-        for order in current_edge.stream_order:
-            current_edge.stream_order[order] = 1
-        return
-
-    stream_orders = {
-        ORDER_STRAHLER: [],
-        ORDER_SHREVE: [],
-        ORDER_SCHEIDEGGER: [],
-        ORDER_HORTON: [],
-        ORDER_DRWAL: [],
-    }
-
-    # Traverse the graph if its not a leaf
-    for edge_id in current_edge.start_edges:
-        if edge_id not in checked_edges:
-            checked_edges.append(edge_id)
-            traverse_graph_create_stream_order(
-                edge_id, edges, checked_edges, reversed_edges, order_types
-            )
-
-        for order in order_types:
-            stream_orders[order].append(edges[edge_id].stream_order[order])
-
-    # Compute the stream orders
-    if ORDER_STRAHLER in order_types:
-        maximum = max(stream_orders[ORDER_STRAHLER])
-        if stream_orders[ORDER_STRAHLER].count(maximum) > 1:
-            current_edge.stream_order[ORDER_STRAHLER] = maximum + 1
+    reversed_edges = set()
+    # Edges that have been checked for reversion
+    direction_checked = set()
+    checked_edges = set()
+    strahler = {}
+    shreve = {}
+
+    def start_edges(edge_id):
+        # The edges at the start node of the edge, in outflow direction.
+        # Reverse the edges that are not in the outflow direction.
+        if edge_id in reversed_edges:
+            start = graph.line_end[edge_id]
         else:
-            current_edge.stream_order[ORDER_STRAHLER] = maximum
-    if ORDER_SHREVE in order_types:
-        current_edge.stream_order[ORDER_SHREVE] = sum(stream_orders[ORDER_SHREVE])
-    if ORDER_SCHEIDEGGER in order_types:
-        current_edge.stream_order[ORDER_SCHEIDEGGER] = sum(
-            stream_orders[ORDER_SCHEIDEGGER]
-        )
-    if ORDER_DRWAL in order_types:
-        current_edge.stream_order[ORDER_DRWAL] = sum(stream_orders[ORDER_DRWAL])
-    # Horton is wrong implemented
-    if ORDER_HORTON in order_types:
-        maximum = max(stream_orders[ORDER_HORTON])
-        current_edge.stream_order[ORDER_HORTON] = maximum + 1
-
-
-def traverse_network_create_graph(vector, start_node, graph_nodes, graph_edges):
-    """
-    Traverse a stream network vector map layer with depth-first search
-    and create a graphs structures for nodes and edges
-
-    :param vector: The opened vector input file
-    :param start_node: The start node object
-    :param graph_nodes: A dictionary of discovered nodes
-    :param graph_edges: A dictionary of Edge objects
-    :return:
-    """
-
-    # Count line ids
-    edge_ids = start_node.ilines()
-
-    # For each line at that node
-    for line_id in edge_ids:
-
-        line_id_abs = abs(line_id)
-        line = vector.read(line_id_abs)
-        nodes = line.nodes()
-
-        # If the line id is not in the edge list, create a new entry
-        if line_id_abs not in graph_edges:
-            start_edges = [abs(lid) for lid in nodes[0].ilines()]
-            end_edges = [abs(lid) for lid in nodes[1].ilines()]
-
-            start_edges.remove(line_id_abs)
-            end_edges.remove(line_id_abs)
-
-            e = GraphEdge(
-                line_id_abs,
-                line_id,
-                nodes[0].id,
-                nodes[1].id,
-                start_edges,
-                end_edges,
-                False,
-            )
-            graph_edges[line_id_abs] = e
-
-        # For start and end node
-        for node in nodes:
-            # If the node was not yet discovered, put it
-            # into the node dict and call traverse
-            if node.id not in graph_nodes:
-                graph_nodes[node.id] = GraphNode(
-                    node.id, [lid for lid in node.ilines()]
-                )
-                # Recursive call
-                traverse_network_create_graph(vector, node, graph_nodes, graph_edges)
+            start = graph.line_start[edge_id]
+        edges = graph.lines(start)
+        edges.remove(edge_id)
+        for edge in edges:
+            if edge not in direction_checked:
+                direction_checked.add(edge)
+                if start != graph.line_end[edge]:
+                    reversed_edges.add(edge)
+        return edges
+
+    stack = [[start_id, start_edges(start_id), 0]]
+    while stack:
+        frame = stack[-1]
+        edge_id, edges, i = frame
+
+        # Traverse the next edge upstream that was not yet checked
+        while i < len(edges) and edges[i] in checked_edges:
+            i += 1
+        if i < len(edges):
+            frame[2] = i + 1
+            checked_edges.add(edges[i])
+            stack.append([edges[i], start_edges(edges[i]), 0])
+            continue
+        stack.pop()
+
+        # Set the stream_order to one, if the edge is a leaf
+        if not edges:
+            strahler[edge_id] = 1
+            shreve[edge_id] = 1
+            continue
+
+        # Compute the stream orders
+        orders = [strahler.get(edge, 0) for edge in edges]
+        maximum = max(orders)
+        if orders.count(maximum) > 1:
+            maximum += 1
+        strahler[edge_id] = maximum
+        shreve[edge_id] = sum(shreve.get(edge, 0) for edge in edges)
+
+    return reversed_edges, strahler, shreve
 
 
 def graph_to_vector(
-    name, mapset, graphs, output, order_types, outlet_cats, copy_columns
+    name, mapset, graphs, orders, output, order_types, outlet_cats, copy_columns
 ):
     """
     Write the Graph as vector map. Attach the network id,
@@ -303,7 +264,9 @@ def graph_to_vector(
 
     :param name: Name of the input stream vector map
     :param mapset: Mapset name of the input stream vector map
-    :param graphs: The list of computed graphs
+    :param graphs: The list of the line ids of each network
+    :param orders: The list of the reversed edges and stream orders of
+                   each network, see traverse_graph_create_stream_order()
     :param output: The name of the output vector map
     :param order_types: The order algorithms
     :param outlet_cats: Categories of the outlet points
@@ -325,17 +288,32 @@ def graph_to_vector(
         cols.append((ORDER_DICT[order], "INTEGER"))
 
     # Add the columns of the table from the input map
+    # and read the rows to be copied at once
+    copy_rows = {}
     if copy_columns:
         for entry in copy_columns:
             cols.append((entry[1], entry[2]))
+        names = streams.table.columns.names()
+        key = names.index(streams.table.key)
+        cur = streams.table.execute(
+            "SELECT %s FROM %s" % (", ".join(names), streams.table.name)
+        )
+        for row in cur.fetchall():
+            copy_rows[row[key]] = row
+        cur.close()
 
     out_streams = VectorTopo(output)
     grass.message(_("Writing vector map <%s>" % output))
     out_streams.open("w", tab_cols=cols)
 
+    attributes = []
     count = 0
     for graph in graphs:
         outlet_cat = outlet_cats[count]
+        if count < len(orders):
+            reversed_edges, strahler, shreve = orders[count]
+        else:
+            reversed_edges, strahler, shreve = set(), {}, {}
         count += 1
 
         grass.message(
@@ -347,46 +325,49 @@ def graph_to_vector(
 
         # Write each edge as line
         for edge_id in graph:
-            edge = graph[edge_id]
-
             line = streams.read(edge_id)
+            reverse = edge_id in reversed_edges
             # Reverse the line if required
-            if edge.reverse is True:
+            if reverse:
                 line.reverse()
 
             # Orders derived from shreve algorithm
-            if ORDER_SCHEIDEGGER in order_types:
-                edge.stream_order[ORDER_SCHEIDEGGER] *= 2
-            if ORDER_DRWAL in order_types:
-                if edge.stream_order[ORDER_DRWAL] != 0:
-                    edge.stream_order[ORDER_DRWAL] = int(
-                        math.log(edge.stream_order[ORDER_DRWAL], 2) + 1
-                    )
+            stream_order = {
+                ORDER_STRAHLER: strahler.get(edge_id, 0),
+                ORDER_SHREVE: shreve.get(edge_id, 0),
+                ORDER_SCHEIDEGGER: 2 * shreve.get(edge_id, 0),
+                ORDER_DRWAL: 0,
+            }
+            if shreve.get(edge_id, 0) != 0:
+                stream_order[ORDER_DRWAL] = int(math.log(shreve[edge_id], 2) + 1)
 
             # Create attributes
-            attrs = []
+            attrs = [edge_id]
             # Append the outlet point category
             attrs.append(outlet_cat)
             # Append the network id
             attrs.append(count)
             # The reverse flag
-            attrs.append(edge.reverse)
+            attrs.append(int(reverse))
             # Then the stream orders defined at the command line
             for order in order_types:
-                val = int(edge.stream_order[order])
+                val = int(stream_order[order])
                 if val == 0:
                     val = None
                 attrs.append(val)
             # Copy attributes from original streams if the table exists
             if copy_columns:
+                row = copy_rows.get(line.cat)
                 for entry in copy_columns:
                     # First entry is the column index
-                    attrs.append(line.attrs.values()[entry[0]])
+                    attrs.append(row[entry[0]] if row else None)
+            attributes.append(attrs)
 
             # Write the feature
-            out_streams.write(line, cat=edge_id, attrs=attrs)
+            out_streams.write(line, cat=edge_id)
 
-    # Commit the database entries
+    # Write and commit the database entries at once
+    out_streams.table.insert(attributes, many=True)
     out_streams.table.conn.commit()
     # Close the input and output map
     out_streams.close()
@@ -540,16 +521,12 @@ def detect_compute_networks(
         grass.fatal(_("Unable to find start nodes"))
 
     # We create a graph representation for further computations
+    graph = StreamGraph(v)
     graphs = []
 
     # Traverse each network from the outflow node on
     for node in start_nodes:
-        graph_nodes = {}
-        graph_edges = {}
-        graph_nodes[node.id] = GraphNode(node.id, [lid for lid in node.ilines()])
-        traverse_network_create_graph(v, node, graph_nodes, graph_edges)
-        # For now we only use the edges graph
-        graphs.append(graph_edges)
+        graphs.append(graph.network(node.id))
 
     # Close the vector map, since we have our own graph representation
     v.close()
@@ -563,23 +540,17 @@ def detect_compute_networks(
         order_types.append(ORDER_SCHEIDEGGER)
     if order.find("drwal") >= 0:
         order_types.append(ORDER_DRWAL)
-    if order.find("horton") >= 0:
-        order_types.append(ORDER_HORTON)
     if order.find("shreve") >= 0:
         order_types.append(ORDER_SHREVE)
 
     # Compute the stream orders
+    orders = []
     for i in xrange(len(start_edges)):
-        edge_id = start_edges[i]
-        checked_edges = []
-        reversed_edges = []
-        traverse_graph_create_stream_order(
-            edge_id, graphs[i], checked_edges, reversed_edges, order_types
-        )
+        orders.append(traverse_graph_create_stream_order(graph, start_edges[i]))
 
     # Write the graphs as vector map
     graph_to_vector(
-        vname, vmapset, graphs, output, order_types, outlet_cats, copy_columns
+        vname, vmapset, graphs, orders, output, order_types, outlet_cats, copy_columns
     )
 
 
@@ -590,15 +561,14 @@ def main():
     order = options["order"]
     threshold = options["threshold"]
     columns = options["columns"]
-    recursionlimit = options["recursionlimit"]
-
-    # We are using a recursive tree traversing algorithm, that may exceed
-    # the 1000 recursion length for huge networks.
-    # The default is 10000 in the option section
-    if int(recursionlimit) < 1000:
-        grass.fatal(_("The Python recursion limit should be equal or larger than 1000"))
 
-    sys.setrecursionlimit(int(recursionlimit))
+    if options["recursionlimit"]:
+        grass.warning(
+            _(
+                "The recursionlimit option is deprecated and ignored, "
+                "the stream networks are traversed without recursion"
+            )
+        )
 
     # Check map names for mapsets
     vname = input
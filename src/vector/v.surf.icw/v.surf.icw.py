@@ -31,10 +31,9 @@
 # Notes:
 #  A cost surface containing molasses barrier data may be used as well.
 #  Input data points need not have direct line of sight to each other.
-#  Try and keep the number of input sites to under a few dozen, as the
-#  process is very computationally expensive. You might consider creating
-#  a few hundred MB RAM-disk for a temporary mapset to avoid thrashing your
-#  hard drive (r.cost is heavy on disk IO).
+#  The cost distances from the sites are computed in memory, for batches
+#  of sites at a time, and only the weighted sums are kept, so no temporary
+#  maps are written.
 
 
 #%Module
@@ -125,20 +124,111 @@ from builtins import str
 from builtins import range
 import sys
 import os
-import atexit
-import grass.script as grass
-from grass.exceptions import CalledModuleError
+import math
+from multiprocessing import Pool
 
-TMP_FILE = None
+import numpy as np
+import grass.script as grass
+from grass.pygrass.raster import RasterRow
+from grass.pygrass.raster.buffer import Buffer
+
+# number of cells of the cost distances of a batch of sites kept in memory
+BATCH_SIZE = 2 ** 22
+
+# moves of r.cost -k: (rows, columns), the opposite moves are added below
+KNIGHT_MOVES = [(0, 1), (1, 0), (1, 1), (1, -1), (1, 2), (1, -2), (2, 1), (2, -1)]
+
+
+def read_raster(name, rows):
+    "Read a raster map of the current region into an array, nulls as NaN"
+    with RasterRow(name) as raster:
+        values = np.array([raster.get_row(i) for i in range(rows)])
+        if raster.mtype == "CELL":
+            nulls = values == -2147483648
+            values = values.astype(np.float64)
+            values[nulls] = np.nan
+    return values
+
+
+def moves_and_steps(region):
+    """The 16 moves of r.cost -k and the cost of each on a uniform cost
+    surface, in units of the east-west resolution as in r.cost"""
+    ns_fac = region["nsres"] / region["ewres"]
+    moves = []
+    for di, dj in KNIGHT_MOVES:
+        step = math.hypot(di * ns_fac, dj)
+        moves.append(((di, dj), step))
+        moves.append(((-di, -dj), step))
+    return moves
+
+
+def shift(values, di, dj, fill):
+    "Move the last two axes by di rows and dj columns, filling the gap"
+    result = np.full_like(values, fill)
+    rows, cols = values.shape[-2:]
+    if abs(di) >= rows or abs(dj) >= cols:
+        return result
+    result[
+        ..., max(di, 0) : rows + min(di, 0), max(dj, 0) : cols + min(dj, 0)
+    ] = values[..., max(-di, 0) : rows + min(-di, 0), max(-dj, 0) : cols + min(-dj, 0)]
+    return result
+
+
+def sweep(cost, passable, di, dj, step):
+    """Relax the cost distances along all the straight lines of one move.
+
+    The lines are followed by doubling spans, after the pass with span s
+    each cell knows the cheapest way in from up to 2s - 1 moves behind,
+    over passable cells only."""
+    rows, cols = passable.shape
+    span = 1
+    # cells with passable cells all the way back over span moves
+    open_line = passable & shift(passable, di, dj, False)
+    while abs(di) * span < rows and abs(dj) * span < cols and open_line.any():
+        reached = shift(cost, di * span, dj * span, np.inf) + span * step
+        np.minimum(cost, np.where(open_line, reached, np.inf), out=cost)
+        open_line = open_line & shift(open_line, di * span, dj * span, False)
+        span *= 2
+
+
+def cost_distances(passable, site_rows, site_cols, moves):
+    """Cumulative cost from each site to every cell of a uniform cost
+    surface (sites, rows, cols), unreachable cells are inf"""
+    cost = np.full((len(site_rows),) + passable.shape, np.inf)
+    cost[np.arange(len(site_rows)), site_rows, site_cols] = 0
+    while True:
+        previous = cost.copy()
+        for (di, dj), step in moves:
+            sweep(cost, passable, di, dj, step)
+        if np.array_equal(cost, previous):
+            return cost
+
+
+def weighted_sums(
+    passable, site_rows, site_cols, values, moves, friction, divisor, rbf
+):
+    "Sum of the weights and of the weighted values of a batch of sites"
+    cost = cost_distances(passable, site_rows, site_cols, moves)
+    # we do this so the divisor exists and the weighting is huge at the exact sample spots
+    cost[cost == 0] = 0.1
+    with np.errstate(divide="ignore", invalid="ignore", over="ignore"):
+        if not rbf:
+            weight = 1.0 / np.power(cost / divisor, friction)
+        else:
+            weight = 1.0 / (np.power(cost, friction) * np.log(cost))
+    # unreachable cells and undefined weights are null, as with r.mapcalc
+    valid = np.isfinite(weight) & np.isfinite(cost)
+    weight = np.where(valid, weight, 0)
+    return (
+        weight.sum(axis=0),
+        np.tensordot(values, weight, axes=1),
+        valid.any(axis=0),
+    )
 
 
-def cleanup():
-    grass.verbose(_("Cleanup.."))
-    tmp_base = "tmp_icw_" + str(os.getpid()) + "_"
-    grass.run_command(
-        "g.remove", flags="f", type="raster", pattern=tmp_base + "*", quiet=True
-    )
-    grass.try_remove(TMP_FILE)
+def batch_sums(args):
+    "Unpack the arguments of weighted_sums for Pool.imap_unordered"
+    return weighted_sums(*args)
 
 
 def main():
@@ -158,9 +248,6 @@ def main():
     if workers < 1:
         workers = 1
 
-    pid = str(os.getpid())
-    tmp_base = "tmp_icw_" + pid + "_"
-
     # do the maps exist?
     if not grass.find_file(pts_input, element="vector")["file"]:
         grass.fatal(_("Vector map <%s> not found") % pts_input)
@@ -207,13 +294,10 @@ def main():
         grass.fatal(_("Data column must be numberic"))
 
     # cleanse cost area mask to a flat =1 for my porpoises
-    area_mask = tmp_base + "area"
-    grass.mapcalc(
-        "$result = if($cost_map, 1, null())",
-        result=area_mask,
-        cost_map=cost_map,
-        quiet=True,
-    )
+    region = grass.region()
+    cost = read_raster(cost_map, region["rows"])
+    passable = np.isfinite(cost) & (cost != 0)
+    del cost
 
     ## done with prep work,
     ########################################################################
@@ -238,313 +322,118 @@ def main():
     for i in range(len(points_list)):
         points_list[i] = points_list[i].split("|")
 
-    # count number of starting points (n). This value will later be decremented
-    #  if points are found to be off the cost map or out of region.
+    # count number of starting points (n).
     n = len(points_list)
 
-    if n > 200:
-        grass.warning(
-            _(
-                "Computation is expensive! Please consider "
-                + "fewer points or get ready to wait a while ..."
-            )
-        )
-        import time
-
-        time.sleep(5)
-
-    #### generate cost maps for each site in range
-    grass.message(_("Generating cost maps ..."))
+    # retrieve all the data values from vector's attribute table at once
+    data_values = grass.vector_db_select(pts_input, layer=layer, columns=column)[
+        "values"
+    ]
 
-    # avoid do-it-yourself brain surgery
-    points_list_orig = list(points_list)
+    grass.message(_("Checking sites ..."))
 
-    proc = {}
-    num = 1
-    for i in range(n):
-        position = points_list_orig[i]
-        easting = position[0]
-        northing = position[1]
+    site_rows = []
+    site_cols = []
+    site_values = []
+    for num, position in enumerate(points_list, start=1):
+        easting = float(position[0])
+        northing = float(position[1])
         cat = int(position[-1])
-
-        # retrieve data value from vector's attribute table:
-        data_value = grass.vector_db_select(pts_input, columns=column)["values"][cat][0]
+        data_value = data_values.get(cat, [""])[0]
 
         if not data_value:
-            grass.message(
+            grass.verbose(
                 _("Site %d of %d,  e=%.4f  n=%.4f  cat=%d  data=?")
-                % (num, n, float(easting), float(northing), cat)
+                % (num, n, easting, northing, cat)
             )
-            grass.message(_(" -- Skipping, no data here."))
-            del points_list[num - 1]
-            n -= 1
+            grass.verbose(_(" -- Skipping, no data here."))
             continue
         else:
-            grass.message(
+            grass.verbose(
                 _("Site %d of %d,  e=%.4f  n=%.4f  cat=%d  data=%.8g")
-                % (num, n, float(easting), float(northing), cat, float(data_value))
+                % (num, n, easting, northing, cat, float(data_value))
             )
 
         # we know the point is in the region, but is it in a non-null area of the cost surface?
-        rast_val = (
-            grass.read_command(
-                "r.what",
-                map=area_mask,
-                coordinates="%s,%s" % (position[0], position[1]),
-            )
-            .strip()
-            .split("|")[-1]
-        )
-        if rast_val == "*":
-            grass.message(_(" -- Skipping, point lays outside of cost_map."))
-            del points_list[num - 1]
-            n -= 1
+        row = min(int((region["n"] - northing) / region["nsres"]), region["rows"] - 1)
+        col = min(int((easting - region["w"]) / region["ewres"]), region["cols"] - 1)
+        if not passable[row, col]:
+            grass.verbose(_(" -- Skipping, point lays outside of cost_map."))
             continue
 
         # it's ok to proceed
         try:
             data_value = float(data_value)
-        except:
+        except ValueError:
             grass.fatal("Data value [%s] is non-numeric" % data_value)
 
-        cost_site_name = tmp_base + "cost_site." + "%05d" % num
-        proc[num - 1] = grass.start_command(
-            "r.cost",
-            flags="k",
-            input=area_mask,
-            output=cost_site_name,
-            start_coordinates=easting + "," + northing,
-            quiet=True,
-        )
-        # stall to wait for the nth worker to complete,
-        if num % workers == 0:
-            proc[num - 1].wait()
-
-        num += 1
-
-    # make sure everyone is finished
-    for i in range(n):
-        if proc[i].wait() != 0:
-            grass.fatal(_("Problem running %s") % "r.cost")
-
-    grass.message(_("Removing anomalies at site positions ..."))
-
-    proc = {}
-    for i in range(n):
-        cost_site_name = tmp_base + "cost_site." + "%05d" % (i + 1)
-        # max_cost="$GIS_OPT_MAX_COST"  : commented out until r.null cleansing/continue code is sorted out
-        # start_points=tmp_idw_cost_site_$$
-
-        # we do this so the divisor exists and the weighting is huge at the exact sample spots
-        # more efficient to reclass to 1?
-        proc[i] = grass.mapcalc_start(
-            "$cost_n_cleansed = if($cost_n == 0, 0.1, $cost_n)",
-            cost_n_cleansed=cost_site_name + ".cleansed",
-            cost_n=cost_site_name,
-            quiet=True,
-        )
-        # stall to wait for the nth worker to complete,
-        if (i + 1) % workers == 0:
-            # print 'stalling ...'
-            proc[i].wait()
-
-    # make sure everyone is finished
-    for i in range(n):
-        if proc[i].wait() != 0:
-            grass.fatal(_("Problem running %s") % "r.mapcalc")
+        site_rows.append(row)
+        site_cols.append(col)
+        site_values.append(data_value)
 
-    grass.message(_("Applying radial decay ..."))
-
-    proc = {}
-    for i in range(n):
-        cost_site_name = tmp_base + "cost_site." + "%05d" % (i + 1)
-        grass.run_command(
-            "g.remove", flags="f", type="raster", name=cost_site_name, quiet=True
-        )
-        grass.run_command(
-            "g.rename",
-            raster=cost_site_name + ".cleansed" + "," + cost_site_name,
-            quiet=True,
-        )
-
-        # r.to.vect then r.patch output
-        # v.to.rast in=tmp_idw_cost_site_29978 out=tmp_idw_cost_val_$$ use=val val=10
-
-        if not flags["r"]:
-            #  exp(3,2) is 3^2  etc.  as is pow(3,2)
-            # r.mapcalc "1by_cost_site_sqrd.$NUM =  1.0 / exp(cost_site.$NUM , $FRICTION)"
-            #      EXPRESSION="1.0 / pow(cost_site.$NUM $DIVISOR, $FRICTION )"
-            expr = "1.0 / pow($cost_n / " + str(divisor) + ", $friction)"
-        else:
-            # use log10() or ln() ?
-            #      EXPRESSION="1.0 / ( pow(cost_site.$NUM, $FRICTION) * log (cost_site.$NUM) )"
-            expr = '1.0 / ( pow($cost_n, $friction) * log($cost_n) )"'
-
-        grass.debug("r.mapcalc expression is: [%s]" % expr)
-
-        one_by_cost_site_sq_n = tmp_base + "1by_cost_site_sq." + "%05d" % (i + 1)
-
-        proc[i] = grass.mapcalc_start(
-            "$result = " + expr,
-            result=one_by_cost_site_sq_n,
-            cost_n=cost_site_name,
-            friction=friction,
-            quiet=True,
-        )
-        # stall to wait for the nth worker to complete,
-        if (i + 1) % workers == 0:
-            # print 'stalling ...'
-            proc[i].wait()
-
-        # r.patch in=1by_cost_site_sqrd.${NUM},tmp_idw_cost_val_$$ out=1by_cost_site_sqrd.${NUM} --o
-        # g.remove type=rast name=cost_site.$NUM -f
-
-    # make sure everyone is finished
-    for i in range(n):
-        if proc[i].wait() != 0:
-            grass.fatal(_("Problem running %s") % "r.mapcalc")
-
-    grass.run_command(
-        "g.remove",
-        flags="f",
-        type="raster",
-        pattern=tmp_base + "cost_site.*",
-        quiet=True,
-    )
-    # grass.run_command('g.list', type = 'raster', mapset = '.')
-
-    #######################################################
-    #### Step 3) find sum(cost^2)
-    grass.verbose("")
-    grass.verbose(_("Finding sum of squares ..."))
-
-    # todo: test if MASK exists already, fatal exit if it does?
-    if post_mask:
-        grass.message(_("Setting post_mask <%s>"), post_mask)
-        grass.mapcalc("MASK = $maskmap", maskmap=post_mask, overwrite=True)
+    n = len(site_values)
+    if not n:
+        grass.fatal(_("No sites with data inside the cost_map"))
+    grass.message(_("Using %d of %d sites") % (n, len(points_list)))
 
+    #### cost distances and weights for batches of sites
     grass.message(_("Summation of cost weights ..."))
 
-    input_maps = tmp_base + "1by_cost_site_sq.%05d" % 1
-
-    global TMP_FILE
-    TMP_FILE = grass.tempfile()
-    with open(TMP_FILE, "w") as maplist:
-        for i in range(2, n + 1):
-            mapname = "%s1by_cost_site_sq.%05d" % (tmp_base, i)
-            maplist.write(mapname + "\n")
-
-    # grass.run_command('g.list', type = 'raster', mapset = '.')
-
-    sum_of_1by_cost_sqs = tmp_base + "sum_of_1by_cost_sqs"
-    try:
-        grass.run_command(
-            "r.series", method="sum", file=TMP_FILE, output=sum_of_1by_cost_sqs
-        )
-    except CalledModuleError:
-        grass.fatal(_("Problem running %s") % "r.series")
-
-    if post_mask:
-        grass.message(_("Removing post_mask <%s>"), post_mask)
-        grass.run_command("g.remove", flags="f", name="MASK", quiet=True)
-
-    #######################################################
-    #### Step 4) ( 1/di^2 / sum(1/d^2) ) *  ai
-    grass.verbose("")
-    grass.message(_("Creating partial weights ..."))
-
-    proc = {}
-    num = 1
-    for position in points_list:
-        easting = position[0]
-        northing = position[1]
-        cat = int(position[-1])
-        data_value = grass.vector_db_select(pts_input, columns=column)["values"][cat][0]
-        data_value = float(data_value)
-
-        # failsafe: at this point the data values should all be valid
-        if not data_value:
-            grass.message(_("Site %d of %d,  cat = %d, data value = ?") % (num, n, cat))
-            grass.message(_(" -- Skipping, no data here. [Probably programmer error]"))
-            n -= 1
-            continue
-        else:
-            grass.message(
-                _("Site %d of %d,  cat = %d, data value = %.8g")
-                % (num, n, cat, data_value)
-            )
-
-        # we know the point is in the region, but is it in a non-null area of the cost surface?
-        rast_val = (
-            grass.read_command(
-                "r.what",
-                map=area_mask,
-                coordinates="%s,%s" % (position[0], position[1]),
-            )
-            .strip()
-            .split("|")[-1]
+    site_rows = np.array(site_rows)
+    site_cols = np.array(site_cols)
+    site_values = np.array(site_values)
+    moves = moves_and_steps(region)
+    batch = max(1, BATCH_SIZE // passable.size)
+    batches = [
+        (
+            passable,
+            site_rows[i : i + batch],
+            site_cols[i : i + batch],
+            site_values[i : i + batch],
+            moves,
+            friction,
+            divisor,
+            flags["r"],
         )
-        if rast_val == "*":
-            grass.message(
-                _(
-                    " -- Skipping, point lays outside of cost_map. [Probably programmer error]"
-                )
-            )
-            n -= 1
-            continue
-
-        partial_n = tmp_base + "partial." + "%05d" % num
-        one_by_cost_site_sq = tmp_base + "1by_cost_site_sq." + "%05d" % num
-
-        # "( $DATA_VALUE / $N ) * (1.0 - ( cost_sq_site.$NUM / sum_of_cost_sqs ))"
-        # "( cost_sq_site.$NUM / sum_of_cost_sqs ) * ( $DATA_VALUE / $N )"
-
-        proc[num - 1] = grass.mapcalc_start(
-            "$partial_n = ($data * $one_by_cost_sq) / $sum_of_1by_cost_sqs",
-            partial_n=partial_n,
-            data=data_value,
-            one_by_cost_sq=one_by_cost_site_sq,
-            sum_of_1by_cost_sqs=sum_of_1by_cost_sqs,
-            quiet=True,
-        )
-
-        # stall to wait for the nth worker to complete,
-        if num % workers == 0:
-            proc[num - 1].wait()
-
-        # free up disk space ASAP
-        # grass.run_command('g.remove', flags = 'f', type = 'raster', name = one_by_cost_site_sq, quiet = True)
-
-        num += 1
-        if num > n:
-            break
-
-    # make sure everyone is finished
-    for i in range(n):
-        proc[i].wait()
-
-    # free up disk space ASAP
-    grass.run_command(
-        "g.remove",
-        flags="f",
-        type="raster",
-        pattern=tmp_base + "1by_cost_site_sq.*",
-        quiet=True,
-    )
-    # grass.run_command('g.list', type = 'raster', mapset = '.')
+        for i in range(0, n, batch)
+    ]
+
+    sum_of_weights = np.zeros(passable.shape)
+    sum_of_values = np.zeros(passable.shape)
+    reached = np.zeros(passable.shape, dtype=bool)
+    if workers > 1 and len(batches) > 1:
+        pool = Pool(min(workers, len(batches)))
+        results = pool.imap_unordered(batch_sums, batches)
+    else:
+        pool = None
+        results = map(batch_sums, batches)
+    for done, (weights, values, valid) in enumerate(results, start=1):
+        grass.percent(done, len(batches), 1)
+        sum_of_weights += weights
+        sum_of_values += values
+        reached |= valid
+    if pool:
+        pool.close()
+        pool.join()
 
     #######################################################
-    grass.message("")
+    #### ( 1/di^2 / sum(1/d^2) ) *  ai
     grass.message(_("Calculating final values ..."))
 
-    input_maps = tmp_base + "partial.%05d" % 1
-    for i in range(2, n + 1):
-        input_maps += ",%spartial.%05d" % (tmp_base, i)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        result = sum_of_values / sum_of_weights
+    result[~(reached & passable & np.isfinite(result))] = np.nan
 
-    try:
-        grass.run_command("r.series", method="sum", input=input_maps, output=output)
-    except CalledModuleError:
-        grass.fatal(_("Problem running %s") % "r.series")
+    if post_mask:
+        grass.message(_("Applying post_mask <%s>") % post_mask)
+        mask = read_raster(post_mask, region["rows"])
+        result[~(np.isfinite(mask) & (mask != 0))] = np.nan
+
+    with RasterRow(
+        output, mode="w", mtype="DCELL", overwrite=grass.overwrite()
+    ) as raster:
+        for row in result:
+            raster.put_row(Buffer(row.shape, "DCELL", row))
 
     # TODO: r.patch in v.to.rast of values at exact seed site locations. currently set to null
 
@@ -582,15 +471,10 @@ def main():
     # save layer #? to metadata?   command line hist?
 
     #######################################################
-    # Step 5) rm cost and cost_sq maps, tmp_icw_points, etc
-    cleanup()
-
-    #######################################################
-    # Step 6) done!
+    # done!
     grass.message(_("Done! Results written to <%s>." % output))
 
 
 if __name__ == "__main__":
     options, flags = grass.parser()
-    atexit.register(cleanup)
     main()